@@ -1 +1 @@
-from .sed import Sed, SedException, main
+from .sed import Sed, SedException, SedRunStopped, SedLimitExceeded, SedCancelled, CancelToken, Tracer, main
@@ -3,16 +3,24 @@
 
 from __future__ import print_function, unicode_literals
 from io import open, StringIO, BytesIO
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryFile
 
 import argparse
+import bisect
 import codecs
+import collections
 import locale
+import mmap
+import numbers
 import os
 import re
+import stat
 import sys
+import threading
+import time
 import traceback
 import webbrowser
+from timeit import default_timer
 
 
 __updated__ = '2022-09-12 17:58:11'
@@ -70,6 +78,8 @@ THE SOFTWARE.
 
 DEFAULT_ENCODING = locale.getpreferredencoding()
 PY2 = sys.version_info[0] == 2
+# str.isascii is available from Python 3.7, without it flag I is left to module re
+STR_ISASCII = getattr(str, 'isascii', None)
 if PY2:
 
     def make_unicode(strg, encoding):
@@ -204,6 +214,13 @@ class ScriptLine (object):
             DEBUG('get_char returning \\x00 from {pos}', pos=self.position)
         return '\0'
 
+    def skip_to(self, pos):
+        # continues after the character before pos, as if it was read by get_char
+        self.last_source = self.source
+        self.last_pos = pos - 1
+        self.last_char = self.line[pos - 1]
+        self.pos = pos
+
     def continue_on_next_line(self):
         if self.pos == len(self.line) and self.next:
             if self.debug >= 3:
@@ -323,26 +340,26 @@ class Script(object):
         self.referenced_labels = {}
         self.defined_labels = {}
         self.started_blocks = []
-        self.first_command_entry = None
+        self.ranges = []
+        self.write_commands = []
+        # compiled scripts with and without optimization
+        self.compiled = {}
+        self.compile_lock = threading.Lock()
         self.cmd_idx = 0
 
     def __str__(self):
-        if self.first_command_entry is None:  # pragma: no cover  (only used within IDE)
+        if self.sed.optimize not in self.compiled:  # pragma: no cover  (only used within IDE)
             return '<nothing compiled yet>'
-        result = ''
-        command = self.first_command_entry
-        while command:
-            result += str(command) + '\n'
-            if command.function == '{':
-                command = command.branch
-            else:
-                command = command.next
-        return result
+        return str(self.compiled[self.sed.optimize])
 
     def command_index(self):
         self.cmd_idx += 1
         return self.cmd_idx
 
+    @property
+    def analysis(self):
+        return self.get_compiled().analysis
+
     # convenience methods that are
     # all delegated to script_line
     @property
@@ -430,7 +447,7 @@ class Script(object):
                                  self.script_idx, self.obj_idx, None))
 
     def _add(self, script_line):
-        self.first_command_entry = None
+        self.compiled = {}
         if self.last_line:
             self.last_line = self.last_line.add_next(script_line)
         else:
@@ -442,13 +459,19 @@ class Script(object):
             raise SedException(self.last_line.source,
                                'Invalid line continuation on last script line')
 
-    def get_first_command(self):
-        if self.first_command_entry is None:
-            self.compile()
-        return self.first_command_entry
+    def get_compiled(self, optimize=None):
+        # the lock makes sure that concurrent calls of Sed.apply
+        # do not compile the same script more than once
+        if optimize is None:
+            optimize = self.sed.optimize
+        optimize = bool(optimize)
+        with self.compile_lock:
+            if optimize not in self.compiled:
+                self.compiled[optimize] = self.compile(optimize)
+            return self.compiled[optimize]
 
     # methods to parse and compile the script
-    def compile(self):
+    def compile(self, optimize):
         if not self.first_line:
             raise SedException('', 'No script specified.')
         self._check_continuation()  # in case the last -e ended in continuation
@@ -456,16 +479,21 @@ class Script(object):
         self.referenced_labels = {}
         self.defined_labels = {}
         self.started_blocks = []
+        self.ranges = []
+        self.write_commands = []
+        self.needs_last_line = False
         self.parse_flags()
-        self.first_command_entry = None
+        first_command = None
         last_command = None
+        commands = []
         self.script_line = self.first_line.copy()
         command = self.get_command()
         while command is not None:
             if self.sed.debug >= 2:
                 DEBUG('{cmd}', cmd=command)
+            commands.append(command)
             if not last_command:
-                self.first_command_entry = command
+                first_command = command
             else:
                 last_command.next = command
             last_command = command
@@ -482,6 +510,45 @@ class Script(object):
                                      for (_, ref_list) in
                                      sorted(self.referenced_labels.items())
                                      for ref in ref_list))
+        empty = first_command is None
+        self.share_regexps(commands)
+        AddressScan.build(commands)
+        analysis = ScriptAnalysis(commands)
+        optimizations = []
+        # the listing of the debug output shows the script as it was written
+        listing = CompiledScript.list_commands(first_command) if self.sed.debug else None
+        if not empty and optimize:
+            optimizer = Optimizer(first_command)
+            first_command = optimizer.optimize()
+            optimizations = optimizer.optimizations
+            if self.sed.debug >= 2:
+                for optimization in optimizations:
+                    DEBUG('optimized {opt}', opt=optimization)
+        return CompiledScript(first_command,
+                              empty,
+                              self.needs_last_line,
+                              self.ranges,
+                              self.write_commands,
+                              analysis,
+                              optimizations,
+                              listing,
+                              self.sed.debug)
+
+    @staticmethod
+    def share_regexps(commands):
+        # regexps with the same pattern and flags share one compiled
+        # pattern and memoize their results, so that testing the same
+        # pattern space again does not search it again
+        shared = {}
+        for command in commands:
+            for regexp in command.regexps():
+                if isinstance(regexp, SedRegexp):
+                    shared.setdefault(regexp.compiled.pattern, []).append(regexp)
+        for regexps in shared.values():
+            if len(regexps) > 1:
+                for regexp in regexps:
+                    regexp.compiled = regexps[0].compiled
+                    regexp.memoized = True
 
     def parse_flags(self):
         # get flags from first line of script
@@ -803,11 +870,44 @@ class Script(object):
         # keep everything else as it was
         return '\\' + char, '\\' + char, char
 
+    @staticmethod
+    def regexp_end(line, start, delim):
+        # returns the position after the first delimiter not escaped by a
+        # backslash in line from start on or None, if there is none
+        pos = start
+        while pos < len(line):
+            char = line[pos]
+            if char == '\\':
+                pos += 2
+            elif char == delim:
+                return pos + 1
+            else:
+                pos += 1
+        return None
+
     def get_regexp(self, delim, address=True):
         position = self.position
         swap_escapes = not self.sed.regexp_extended and self.sed.sed_compatible
-        char = self.get_char()
-        if char == delim:
+        # the translation of a regexp only depends on its text up to the closing
+        # delimiter, so it is looked up in the REGEXP_CACHE first (unless tracing
+        # the compile or the text is continued on the next line)
+        script_line = self.script_line
+        line, source, start = script_line.line, script_line.source, script_line.pos
+        end = self.regexp_end(line, start, delim)
+        key = None
+        if end is not None:
+            key = ('translation', line[start:end], delim, script_line.encoding,
+                   self.sed.regexp_extended, self.sed.sed_compatible)
+        translation = None
+        if key is not None and script_line.debug < 3 and not self.look_ahead(delim):
+            translation = REGEXP_CACHE.get(key)
+        char = delim if translation is not None else self.get_char()
+        if translation is not None:
+            (pattern, py_pattern, dollars) = translation
+            script_line.skip_to(end)
+            regexp = SedRegexp(position, delim, pattern,
+                               py_pattern, list(dollars), address=address)
+        elif char == delim:
             regexp = SedRegexpEmpty(position, delim, address=address)
         else:
             # we use this to keep track of $ characters
@@ -902,6 +1002,10 @@ class Script(object):
                     self.position,
                     'Invalid regex: expected closing delimiter {delim}',
                     delim=delim)
+            if key is not None and script_line.line is line and script_line.source == source \
+                    and script_line.pos == end:
+                # not continued on the next line and ending where the text of the key ends
+                REGEXP_CACHE.put(key, (pattern, py_pattern, tuple(dollars)))
             regexp = SedRegexp(position, delim, pattern,
                                py_pattern, dollars, address=address)
         if address:
@@ -1015,23 +1119,23 @@ class Script(object):
             char, regexp = self.get_regexp(char, address=True)
             # make sure we keep sed compatibility
             regexp.process_flags_and_dollars()
-            from_addr = AddressRegexp(self.sed, regexp)
+            from_addr = AddressRegexp(regexp)
         elif char in '0123456789':
             char, num = self.get_number(char)
             if char == '~':
                 char, step = self.get_number()
                 if step > 0:
-                    from_addr = AddressStep(self.sed, num, step)
+                    from_addr = AddressStep(num, step)
                 elif num == 0:
-                    from_addr = AddressZero(self.sed)
+                    from_addr = AddressZero()
                 else:
-                    from_addr = AddressNum(self.sed, num)
+                    from_addr = AddressNum(num)
             elif num == 0:
-                from_addr = AddressZero(self.sed)
+                from_addr = AddressZero()
             else:
-                from_addr = AddressNum(self.sed, num)
+                from_addr = AddressNum(num)
         elif char == '$':
-            from_addr = AddressLast(self.sed)
+            from_addr = AddressLast()
             char = self.get_char()
             self.needs_last_line = True
         else:  # no address found
@@ -1102,11 +1206,20 @@ class Script(object):
             not isinstance(addr_range,
                            AddressRangeZeroToRegexp)):
             raise SedException(position, 'Invalid use of zero address')
+        if isinstance(addr_range, AddressRange):
+            # the state of the range is kept per run and found by this index
+            addr_range.index = len(self.ranges)
+            self.ranges.append(addr_range)
         if char == '!':
             char = self.get_non_space_char_within_continued_lines()
             addr_range.set_negate(True)
         return position, addr_range, char
 
+    def register_write_file(self, command):
+        # output files are opened by the run, since a compiled
+        # script may be run more than once and with different writers
+        self.write_commands.append(command)
+
     def reference_to_label(self, label_ref_command):
         label = label_ref_command.label
         if label in self.defined_labels:
@@ -1158,12 +1271,31 @@ class Sed(object):
     sed.separate = True/False
     sed.debug = debug level (0=no debug, 1=debug execution,
                              2=debug compile, 3=trace compile)
+    sed.engine = 'auto'/'interpreter'/'codegen'/'batch'/'window'/'rope'/'kernel'
+                 (execution engine to use)
+    sed.optimize = True/False (simplify the compiled script)
+    sed.tracer = None/Tracer instance (receives execution events)
+    sed.shadow = True/False (check the engine against the reference interpreter)
+    sed.shadow_rate = fraction of the cycles checked in shadow mode
+    sed.line_memo = 0/number of input lines whose output is memoized
+    sed.spill_threshold = 0/size of the hold or pattern space spilled to disk
+    sed.callbacks = {name: function} (Python functions called by command @name)
+    sed.max_space = 0/number of characters the pattern or hold space may hold
+    sed.max_commands = 0/number of commands a cycle may execute
+    sed.max_line_time = 0/number of seconds a cycle may take
+    sed.statistics                        RunStatistics of the last call of apply
+    sed.error                             SedException of the last call of apply or None
+    PythonSed.sed.REGEXP_CACHE            translated and compiled regexps of all instances
     sed.load_script(myscript)             file name or open file or stream
     sed.load_string(mystring)             literal string
     sed.load_scripts(myscripts)           list of file names, files or streams
+    compiled = sed.compile()              compile the script (done by apply otherwise)
+    plan = sed.explain(myinput)           print the engine chosen for myinput and why
     lines = sed.apply(myinput)            print lines to stdout
     lines = sed.apply(myinput, None)      do not print lines
     lines = sed.apply(myinput, myoutput)  print lines to myoutput
+    lines = sed.apply(myinput, myoutput, cancel_token=token, deadline=time.time() + 10)
+                                          stop when token.cancel() is called or after 10 s
     myinput and myoutput may be:
     * strings, in that case they are interpreted as file names
     * file-like objects (including streams)
@@ -1179,7 +1311,18 @@ class Sed(object):
                  sed_compatible=True,
                  in_place=None,
                  separate=False,
-                 debug=0):
+                 debug=0,
+                 engine='auto',
+                 tracer=None,
+                 optimize=True,
+                 shadow=False,
+                 shadow_rate=0.01,
+                 line_memo=0,
+                 spill_threshold=0,
+                 callbacks=None,
+                 max_space=0,
+                 max_commands=0,
+                 max_line_time=0):
         self.encoding = encoding
         self.line_length = line_length
         self.no_autoprint = no_autoprint
@@ -1188,52 +1331,21 @@ class Sed(object):
         self.in_place = in_place
         self.separate = separate
         self.debug = debug
-        self.writer = None
-        self.reader = None
-        self.PS = ''
-        self.HS = ''
-        self.subst_successful = False
-        self.append_buffer = []
+        self.engine = engine
+        self.tracer = tracer
+        self.optimize = optimize
+        self.shadow = shadow
+        self.shadow_rate = shadow_rate
+        self.line_memo = line_memo
+        self.spill_threshold = spill_threshold
+        self.callbacks = {} if callbacks is None else callbacks
+        self.max_space = max_space
+        self.max_commands = max_commands
+        self.max_line_time = max_line_time
         self.script = Script(self)
         self.exit_code = 0
-
-    def normalize_string(self, strng, line_length):
-        if strng is None:  # pragma: no cover (debug only)
-            yield ''
-            return
-        byteArray = bytearray(strng, self.writer.current_encoding)
-        x = ''
-        for c in byteArray:
-            if 32 <= c <= 127:
-                c = unichr(c)
-                if c == '\\':
-                    x += c
-                x += c
-            elif c == ord('\a'):
-                x += '\\a'
-            elif c == ord('\f'):
-                x += '\\f'
-            elif c == ord('\n'):
-                x += '\\n'
-            elif c == ord('\r'):
-                x += '\\r'
-            elif c == ord('\t'):
-                x += '\\t'
-            elif c == ord('\v'):
-                x += '\\v'
-            else:
-                o = oct(c)
-                if o.startswith('0o'):
-                    o = o[2:]
-                x += '\\' + ('000'+o)[-3:]
-        width = line_length - 1
-        while len(x) > width:
-            yield (x[:width] + '\\')
-            x = x[width:]
-        yield (x + '$')
-
-    def write_state(self, title):
-        self.stateWriter.writeState(title)
+        self.statistics = None
+        self.error = None
 
     def load_script(self,
                     filename,
@@ -1266,28 +1378,6 @@ class Sed(object):
                 buffer.write('\n')
         self.script.add_string(buffer.getvalue(), encoding)
 
-    def readline(self):
-        self.subst_successful = False
-        return self.reader.readline()
-
-    def is_last_line(self):
-        return self.reader.is_last_line()
-
-    def file_line_no(self):
-        return self.reader.line_number
-
-    def printline(self, source, line):
-        self.writer.printline(line)
-        if self.debug > 0:
-            prefix = 'printing (' + source + '): '
-            for lne in line.split('\n'):
-                DEBUG('{prefix}{lne}', prefix=prefix, lne=lne.replace(' ', '\N{MIDDLE DOT}'))
-
-    def flush_append_buffer(self):
-        for line in self.append_buffer:
-            self.printline('appnd', line)
-        self.append_buffer = []
-
     def getReader(self,
                   inputs,
                   encoding,
@@ -1308,95 +1398,702 @@ class Sed(object):
         else:
             return ReaderUnbufferedOneStream(inputs, encoding)
 
-    def apply(self, inputs, output=sys.stdout):
+    def get_tracer(self):
+        if self.tracer is not None:
+            return self.tracer
+        elif self.debug > 0:
+            return DebugTracer()
+        else:
+            return None
+
+    def compile(self):
+        """ Compiles the script (if not done yet) and returns the CompiledScript,
+            which can be run by multiple threads at the same time.
+        """
+        compiled = self.script.get_compiled()
+        if compiled.empty:
+            raise SedException('', 'Empty script specified.')
+        return compiled
+
+    def explain(self, inputs=None, output=sys.stdout):
+        """ Prints the plan apply would use for the given inputs: the engine
+            chosen and the reasons for not choosing the others.
+        """
+        plan = Planner(self, self.compile(), inputs, self.get_tracer()).plan()
+        if output is not None:
+            output.write(make_unicode(str(plan), self.encoding))
+        return plan
+
+    def apply(self, inputs, output=sys.stdout, cancel_token=None, deadline=None):
+        writer = None
+        reader = None
+        state = None
+        tracer = None
+        self.error = None
         try:
             DEBUG_ENCODING = self.encoding  # in case it was changed since object instantiation
-            self.writer = Writer(output,
-                                 self.encoding,
-                                 self.in_place,
-                                 self.debug)
-            first_cmd = self.script.get_first_command()
-            if first_cmd is None:
-                raise SedException('', 'Empty script specified.')
-            if self.debug > 0:
-                DEBUG('Configuration:')
-                DEBUG('  debug={dbg}', dbg=self.debug)
-                DEBUG('  encoding={enc}', enc=self.encoding)
-                DEBUG('  line_length={len}', len=self.line_length)
-                DEBUG('  no_autoprint={np}', np=self.no_autoprint)
-                DEBUG('  regexp_extended={ext}', ext=self.regexp_extended)
-                DEBUG('  sed_compatible={comp}', comp=self.sed_compatible)
-                DEBUG('  in_place={inp}', inp=('<off>' if self.in_place is None
-                                               else u"'"+self.in_place+u"'"))
-                DEBUG('  separate={sep}', sep=self.separate)
-                DEBUG('')
-                DEBUG('{scr}', scr=self.script)
-                self.stateWriter = StateWriter(self)
-            self.reader = self.getReader(
+            writer = Writer(output,
+                            self.encoding,
+                            self.in_place,
+                            self.debug)
+            compiled = self.compile()
+            tracer = self.get_tracer()
+            cancellation = Cancellation.create(cancel_token, deadline)
+            plan = Planner(self, compiled, inputs, tracer, cancellation).plan()
+            if plan.shadow:
+                engine = EngineShadow(compiled.get_engine(plan.engine),
+                                      EngineInterpreter(self.script.get_compiled(False)),
+                                      plan.shadow)
+            elif plan.sampled:
+                engine = EngineAdaptive([compiled.get_engine(name) for name in plan.sampled])
+            elif plan.line_memo:
+                engine = EngineLineMemo(compiled.get_engine(plan.engine), plan.line_memo)
+            else:
+                engine = compiled.get_engine(plan.engine)
+            compiled.open_write_files(writer, self.encoding)
+            reader = self.getReader(
                             inputs,
                             self.encoding,
-                            self.writer,
+                            writer,
                             self.separate,
-                            self.script.needs_last_line)
-            self.exit_code = 0
-            self.HS = ''
-            self.subst_successful = False
-            self.append_buffer = []
-            SedRegexp.last_regexp = None
-            self.PS = self.readline()
-
-            while self.PS is not None:
-                matched, command = False, first_cmd
-                if self.debug > 0:
-                    DEBUG('############### new cycle '.ljust(self.line_length, '#'))
-                    DEBUG('Auto Print: {ap}', ap='Off' if self.no_autoprint else 'On')
-                    DEBUG('Input File: {fle}[{idx}]',
-                          fle=self.reader.source_file_name,
-                          idx=self.reader.line_number)
-                    DEBUG('Output To : {fle}', fle=self.writer.current_filename)
-                    self.write_state('current')
-                last_relevant_command = ' '
-                while command:
-                    prev_command = command
-                    matched, command = command.apply_func(self)
-                    if matched:
-                        last_relevant_command = prev_command.function
-
-                if self.debug > 0:
-                    DEBUG('############### cycle end '.ljust(self.line_length, '#'))
-                    DEBUG('Auto Print: {ap}', ap='Off' if self.no_autoprint else 'On')
-                    DEBUG('Input File: {fle}[{idx}]',
-                          fle=self.reader.source_file_name,
-                          idx=self.reader.line_number)
-                    DEBUG('Output To : {fle}', fle=self.writer.current_filename)
-                    DEBUG('Last Command: {cmd}', cmd=last_relevant_command)
-                    DEBUG('Pattern space is None: {flag}', flag=(self.PS is None))
-                if not (self.no_autoprint
-                        or last_relevant_command in 'DQ'
-                        or self.PS is None):
-                    self.printline('autop', self.PS)
-                self.flush_append_buffer()
-                if last_relevant_command in 'qQ':
-                    self.exit_code = prev_command.exit_code or 0
-                    break
-                if last_relevant_command != 'D':
-                    self.PS = self.readline()
+                            compiled.needs_last_line)
+            state = ExecutionState(self, compiled, reader, writer, tracer)
+            state.governor = plan.governor
+            if plan.spill:
+                state.spill_file = SpillFile(plan.spill, state.statistics)
+            if plan.exhaustion:
+                state.reader = ExhaustionReader(reader, state, plan.exhaustion)
+            if cancellation is not None:
+                state.reader = CancellationReader(state.reader, state, cancellation)
+            if tracer is not None:
+                tracer.start(state)
+            self.statistics = state.statistics
+            start = default_timer()
+            state.PS = state.readline()
+            if plan.sampled:
+                engine.run(state)
+            else:
+                state.statistics.engine = plan.engine
+                state.statistics.cycles = engine.run(state)
+            state.statistics.elapsed = default_timer() - start
+            self.exit_code = state.exit_code
         except SedException as e:
             sys.stderr.write(e.message+'\n')
+            self.error = e
             self.exit_code = 1
         except:  # noqa: E722  # pragma: no cover
             traceback.print_exception(*sys.exc_info(), file=sys.stderr)
             self.exit_code = 1
         finally:
-            if self.reader:
-                self.reader.close()
-            return self.writer.finish()
+            if tracer is not None and state is not None:
+                tracer.finish(state)
+            if state is not None and state.spill_file is not None:
+                state.spill_file.close()
+            if reader:
+                reader.close()
+            return writer.finish() if writer else []
+
+
+class CompiledScript(object):
+    """ The result of the compilation of a script: the linked list of command
+        instances and what is known about them. A compiled script is never changed
+        while the input is processed. Everything that changes during a run is kept
+        in an ExecutionState, so one compiled script can be run any number of times
+        and by multiple threads at once.
+    """
 
+    def __init__(self, first_command, empty, needs_last_line, ranges, write_commands,
+                 analysis, optimizations, listing, debug):
+        self.first_command = first_command
+        self.empty = empty
+        self.needs_last_line = needs_last_line
+        self.ranges = ranges
+        self.write_commands = write_commands
+        self.analysis = analysis
+        self.exhaustion = ExhaustionReader.find_exhaustion(first_command, analysis)
+        self.optimizations = optimizations
+        self.listing = listing
+        self.debug = debug
+        self.engines = {}
+        self.engines_lock = threading.Lock()
 
-class StateWriter(object):
+    def __str__(self):
+        # the commands as written, followed by what the optimizer changed
+        if self.listing is None:
+            return CompiledScript.list_commands(self.first_command)
+        result = self.listing
+        for optimization in self.optimizations:
+            result += 'optimized {opt}\n'.format(opt=optimization)
+        return result
 
-    def __init__(self, sed):
+    @staticmethod
+    def list_commands(first_command):
+        result = ''
+        command = first_command
+        while command:
+            result += '{cmd}\n'.format(cmd=command)
+            if command.function == '{':
+                command = command.branch
+            else:
+                command = command.next
+        return result
+
+    def get_engine(self, name):
+        # engines are built once per compiled script, since
+        # some of them (like codegen) are expensive to create
+        with self.engines_lock:
+            engine = self.engines.get(name)
+            if engine is None:
+                if name not in ENGINES:
+                    raise SedException('', 'Unknown execution engine {name}. Use one of {names}.',
+                                       name=name, names=', '.join(sorted(ENGINES)))
+                engine = ENGINES[name](self)
+                self.engines[name] = engine
+            return engine
+
+    def open_write_files(self, writer, encoding):
+        for command in self.write_commands:
+            command.open_write_file(writer, encoding)
+
+    def new_range_states(self):
+        return [addr_range.new_state() for addr_range in self.ranges]
+
+
+class ScriptAnalysis(object):
+    """ The static properties of a script, found by looking at its commands and
+        addresses without running it. For every property the positions of the
+        commands causing it are kept in the dictionary reasons. A script without
+        any of these properties is line-local: each input line is turned into its
+        output without depending on any other line of the input.
+    """
+
+    PROPERTIES = [
+        ('uses_hold_space', 'uses the hold space (commands g, G, h, H, x or @)'),
+        ('multi_line', 'works on more than one line (commands n, N or D)'),
+        ('line_number_dependent', 'depends on line numbers or file names '
+                                  '(line number addresses, commands = or F)'),
+        ('uses_last_line', 'depends on the last line (address $)'),
+        ('has_range_state', 'has address ranges spanning multiple lines'),
+        ('has_early_exit', 'may stop before the end of input (commands q or Q)'),
+        ('has_side_files', 'reads or writes other files (commands r, R, w, W or s///w)'),
+        ('uses_empty_regexp', 'reuses the last regexp of a previous line (empty regexp)'),
+        ]
+
+    def __init__(self, commands):
+        self.reasons = dict((name, []) for (name, _) in self.PROPERTIES)
+        for command in commands:
+            self.analyze_command(command)
+        for (name, positions) in self.reasons.items():
+            setattr(self, name, len(positions) > 0)
+        self.line_local = not any(self.reasons.values())
+
+    def __str__(self):
+        result = 'line_local: {}\n'.format(self.line_local)
+        for (name, _) in self.PROPERTIES:
+            result += '{}: {}'.format(name, getattr(self, name))
+            if self.reasons[name]:
+                result += ' (' + ', '.join(self.reasons[name]) + ')'
+            result += '\n'
+        return result
+
+    def add_reason(self, name, command):
+        if command.position not in self.reasons[name]:
+            self.reasons[name].append(command.position)
+
+    def analyze_command(self, command):
+        function = command.function
+        if function in 'gGhHx@':
+            # callbacks get the hold space and may keep state of their own
+            self.add_reason('uses_hold_space', command)
+        elif function in 'nND':
+            self.add_reason('multi_line', command)
+        elif function in '=F':
+            self.add_reason('line_number_dependent', command)
+        elif function in 'qQ':
+            self.add_reason('has_early_exit', command)
+        elif function in 'rRwW' or (function == 's' and command.filename):
+            self.add_reason('has_side_files', command)
+        addr_range = command.addr_range
+        if isinstance(addr_range, AddressRange):
+            self.add_reason('has_range_state', command)
+        from_addr = getattr(addr_range, 'from_addr', None)
+        if (isinstance(from_addr, (AddressNum, AddressStep))
+                or (isinstance(addr_range, AddressRangeToNum)
+                    and not isinstance(addr_range, AddressRangeToCount))):
+            self.add_reason('line_number_dependent', command)
+        if (isinstance(from_addr, AddressLast)
+                or isinstance(addr_range, AddressRangeToLastLine)):
+            self.add_reason('uses_last_line', command)
+        if any(isinstance(regexp, SedRegexpEmpty) for regexp in command.regexps()):
+            self.add_reason('uses_empty_regexp', command)
+
+
+class Optimizer(object):
+    """ Simplifies the linked list of command instances of a compiled script
+        before any engine gets to see it:
+        - labels and block ends are dropped from the list, since they only
+          forward to the next command
+        - blocks without an address are flattened and empty blocks are removed
+        - jumps to an unconditional b command are threaded to the final target
+        - commands that can never be reached are removed
+        - loops appending the rest of the input to the pattern space with N
+          (like :a;N;$!ba or :a;$!{N;ba}) are replaced by a Command_slurp
+        Apart from the loops replaced, the commands themselves are left untouched,
+        only their next and branch links are changed. Every change is reported in
+        the list optimizations.
+    """
+
+    def __init__(self, first_command):
+        self.first_command = first_command
+        self.optimizations = []
+
+    def report(self, command, message, **params):
+        self.optimizations.append((command.num, '{pos}: {msg}'.format(
+            pos=command.position, msg=message.format(**params))))
+
+    def optimize(self):
+        commands = []
+        command = self.first_command
+        while command:
+            commands.append(command)
+            command = command.branch if command.function == '{' else command.next
+        if not commands:
+            return None
+        commands = self.slurp_loops(commands)
+        self.commands = commands
+        self.index = dict((id(command), idx) for (idx, command) in enumerate(commands))
+        self.next = dict((id(command), command.next) for command in commands)
+        self.branch = dict((id(command), command.branch) for command in commands)
+        # a block can only be removed if evaluating its address has no effect
+        # on the rest of the script, i.e. there is no empty regexp depending
+        # on the last regexp used
+        uses_empty_regexp = any(isinstance(regexp, SedRegexpEmpty)
+                                for command in commands
+                                for regexp in command.regexps())
+        self.removed = set()
+        for command in commands:
+            if command.function == ':':
+                self.removed.add(id(command))
+                self.report(command, 'dropped label {lbl}', lbl=command.label)
+            elif command.function == '}':
+                self.removed.add(id(command))
+                self.report(command, 'dropped block end')
+            elif command.function == '{':
+                if isinstance(command.addr_range, AddressRangeNone):
+                    self.removed.add(id(command))
+                    self.report(command, 'flattened block without address')
+                elif (command.branch is command.next
+                      and not (uses_empty_regexp and command.regexps())):
+                    self.removed.add(id(command))
+                    self.report(command, 'removed empty block')
+
+        # the target of a jump is the command following the label. If
+        # that is an unconditional b command, we jump to its target instead.
+        self.targets = {}
+        for command in commands:
+            if command.function == ':':
+                target = self.thread(self.following(self.next[id(command)]))
+                if target is not self.following(self.next[id(command)]):
+                    self.report(command, 'threaded jumps to label {lbl} to {tgt}',
+                                lbl=command.label,
+                                tgt=('end of cycle' if target is None
+                                     else 'command ' + target.function +
+                                     ' at ' + target.position))
+                self.targets[id(command)] = target
+
+        reachable = set()
+        todo = [self.following(commands[0])]
+        while todo:
+            command = todo.pop()
+            if command is not None and id(command) not in reachable:
+                reachable.add(id(command))
+                todo.extend(self.successors(command))
+        for command in commands:
+            if id(command) not in self.removed and id(command) not in reachable:
+                self.removed.add(id(command))
+                self.report(command, 'removed unreachable command {cmd}', cmd=command.function)
+
+        for command in commands:
+            command.next = self.following(self.next[id(command)])
+            if command.function == '{':
+                command.branch = self.following(self.branch[id(command)])
+            elif command.function == ':':
+                command.next = self.targets[id(command)]
+        self.optimizations = [message for (_, message) in sorted(self.optimizations)]
+        return self.following(commands[0])
+
+    def slurp_loops(self, commands):
+        # returns the commands with the loops reading the rest of the
+        # input replaced by a Command_slurp following their label
+        def not_last_line(command):
+            addr_range = command.addr_range
+            return (isinstance(addr_range, AddressRangeFake)
+                    and isinstance(addr_range.from_addr, AddressLast)
+                    and not addr_range.active_return)
+
+        def is_N(command):
+            return (command.function == 'N'
+                    and (isinstance(command.addr_range, AddressRangeNone)
+                         or not_last_line(command)))
+
+        def is_b(command, label, condition):
+            return command.function == 'b' and command.branch is label and condition
+
+        result = []
+        idx = 0
+        while idx < len(commands):
+            label = commands[idx]
+            result.append(label)
+            idx += 1
+            loop = commands[idx:idx + 4]
+            if label.function != ':' or len(loop) < 2:
+                continue
+            if (is_N(loop[0])
+                    and is_b(loop[1], label, not_last_line(loop[1]))):
+                # :a;N;$!ba
+                slurp = Command_slurp(loop[0], not_last_line(loop[0]))
+                slurp.next = loop[1].next
+                idx += 2
+            elif (len(loop) == 4
+                  and loop[0].function == '{' and not_last_line(loop[0])
+                  and is_N(loop[1])
+                  and is_b(loop[2], label, isinstance(loop[2].addr_range, AddressRangeNone))
+                  and loop[3] is loop[0].next):
+                # :a;$!{N;ba}
+                slurp = Command_slurp(loop[1], True)
+                slurp.next = loop[3].next
+                idx += 4
+            else:
+                continue
+            label.next = slurp
+            result.append(slurp)
+            self.report(label, 'replaced loop reading the rest of the input '
+                               'with N by reading it at once')
+        return result
+
+    def following(self, command):
+        # the first command at or behind command that is not removed
+        if command is None:
+            return None
+        idx = self.index[id(command)]
+        while idx < len(self.commands) and id(self.commands[idx]) in self.removed:
+            idx += 1
+        return self.commands[idx] if idx < len(self.commands) else None
+
+    def thread(self, target):
+        seen = set()
+        while (target is not None
+               and target.function == 'b'
+               and isinstance(target.addr_range, AddressRangeNone)
+               and id(target) not in seen):
+            seen.add(id(target))
+            if target.branch is None:
+                return None
+            target = self.following(self.next[id(target.branch)])
+        return target
+
+    def successors(self, command):
+        unconditional = isinstance(command.addr_range, AddressRangeNone)
+        if command.function == '{':
+            return [self.following(self.branch[id(command)]),
+                    self.following(self.next[id(command)])]
+        elif isinstance(command, Command_b):
+            result = [self.targets[id(command.branch)] if command.branch else None]
+            if not (command.function == 'b' and unconditional):
+                result.append(self.following(self.next[id(command)]))
+            return result
+        elif command.function in 'cdDqQ' and unconditional:
+            return []
+        else:
+            return [self.following(self.next[id(command)])]
+
+
+class ExecutionState(object):
+    """ Holds everything that changes while a compiled script processes its input:
+        pattern space, hold space, append buffer, substitution flag, the state of
+        all address ranges and the last regexp used (for empty regexps). Commands
+        and addresses get the state passed into their apply and matches methods.
+        A new instance is created for every call of Sed.apply.
+    """
+
+    def __init__(self, sed, compiled, reader, writer, tracer=None):
         self.sed = sed
+        self.compiled = compiled
+        self.reader = reader
+        self.writer = writer
+        self.tracer = tracer
+        # configuration needed while running
+        self.encoding = sed.encoding
+        self.line_length = sed.line_length
+        self.no_autoprint = sed.no_autoprint
+        self.sed_compatible = sed.sed_compatible
+        # the state itself
+        self.PS = None
+        self.HS = ''
+        self.subst_successful = False
+        self.append_buffer = []
+        self.exit_code = 0
+        self.last_regexp = None
+        # compiled pattern -> (pattern space, result of the last search)
+        self.match_memo = {}
+        # the pattern space last scanned by the AddressScan and the literals found
+        self.scanned = None
+        self.scan_found = frozenset()
+        self.ranges = compiled.new_range_states()
+        self.statistics = RunStatistics()
+        # the file the rope engine spills large hold and pattern spaces to
+        self.spill_file = None
+        # the Governor enforcing the resource limits, if any are set
+        self.governor = None
+
+    def normalize_string(self, strng, line_length):
+        if strng is None:  # pragma: no cover (debug only)
+            yield ''
+            return
+        byteArray = bytearray(strng, self.writer.current_encoding)
+        x = ''
+        for c in byteArray:
+            if 32 <= c <= 127:
+                c = unichr(c)
+                if c == '\\':
+                    x += c
+                x += c
+            elif c == ord('\a'):
+                x += '\\a'
+            elif c == ord('\f'):
+                x += '\\f'
+            elif c == ord('\n'):
+                x += '\\n'
+            elif c == ord('\r'):
+                x += '\\r'
+            elif c == ord('\t'):
+                x += '\\t'
+            elif c == ord('\v'):
+                x += '\\v'
+            else:
+                o = oct(c)
+                if o.startswith('0o'):
+                    o = o[2:]
+                x += '\\' + ('000'+o)[-3:]
+        width = line_length - 1
+        while len(x) > width:
+            yield (x[:width] + '\\')
+            x = x[width:]
+        yield (x + '$')
+
+    def readline(self):
+        self.subst_successful = False
+        return self.reader.readline()
+
+    def is_last_line(self):
+        return self.reader.is_last_line()
+
+    def file_line_no(self):
+        return self.reader.line_number
+
+    def printline(self, source, line):
+        self.writer.printline(line)
+        if self.tracer is not None:
+            self.tracer.printing(self, source, line)
+
+    def flush_append_buffer(self):
+        for line in self.append_buffer:
+            self.printline('appnd', line)
+        self.append_buffer = []
+
+    def snapshot(self):
+        return (self.PS, self.HS, self.subst_successful, list(self.append_buffer),
+                self.exit_code, self.last_regexp,
+                [range_state.copy() for range_state in self.ranges])
+
+    def restore(self, snapshot):
+        (self.PS, self.HS, self.subst_successful, append_buffer,
+         self.exit_code, self.last_regexp, ranges) = snapshot
+        self.append_buffer[:] = append_buffer
+        for (range_state, saved) in zip(self.ranges, ranges):
+            range_state.restore(saved)
+
+
+class RunStatistics(object):
+    """ Numbers collected while running a compiled script. After a call of
+        Sed.apply they are available as Sed.statistics.
+    """
+
+    def __init__(self):
+        self.engine = None
+        self.cycles = 0
+        self.elapsed = 0.0
+        # list of (cycle number, engine name, reason) for every change of engine
+        self.switches = []
+        # cycles checked against the reference interpreter in shadow mode
+        self.shadow_checks = 0
+        self.divergence = None
+        # the line, after which no command could be active anymore
+        self.exhausted_at = None
+        # regexp searches answered from the match memo
+        self.memo_hits = 0
+        # cycles answered from the line memo and cycles run to fill it
+        self.line_memo_hits = 0
+        self.line_memo_misses = 0
+        # the name of the kernel run by the kernel engine
+        self.kernel = None
+        # bytes written to the spill file by the rope engine and the largest
+        # size of the file
+        self.spilled_bytes = 0
+        self.spill_file_size = 0
+        # regexp searches checked for the required literals and rejected by them
+        self.prefilter_checks = 0
+        self.prefilter_rejections = 0
+        # pattern spaces searched for all regexp addresses at once and the
+        # ones none of them matched
+        self.address_scans = 0
+        self.address_scan_misses = 0
+
+    def __str__(self):
+        result = 'engine: {}\n'.format(self.engine)
+        if self.kernel is not None:
+            result += 'kernel: {}\n'.format(self.kernel)
+        result += 'cycles: {}\n'.format(self.cycles)
+        result += 'elapsed: {:.3f}s\n'.format(self.elapsed)
+        for (cycle, engine, reason) in self.switches:
+            result += 'switch at cycle {}: {} ({})\n'.format(cycle, engine, reason)
+        if self.exhausted_at is not None:
+            result += 'exhausted at line: {}\n'.format(self.exhausted_at)
+        if self.memo_hits:
+            result += 'memoized matches: {}\n'.format(self.memo_hits)
+        if self.line_memo_hits or self.line_memo_misses:
+            result += 'line memo: {} hits, {} misses\n'.format(self.line_memo_hits,
+                                                              self.line_memo_misses)
+        if self.spilled_bytes:
+            result += 'spilled: {} bytes (file size at most {} bytes)\n'.format(
+                self.spilled_bytes, self.spill_file_size)
+        if self.prefilter_checks:
+            result += 'prefilter: {} of {} searches rejected\n'.format(
+                self.prefilter_rejections, self.prefilter_checks)
+        if self.address_scans:
+            result += 'address scans: {} ({} matching no address)\n'.format(
+                self.address_scans, self.address_scan_misses)
+        if self.shadow_checks:
+            result += 'shadow checks: {}\n'.format(self.shadow_checks)
+        if self.divergence:
+            result += self.divergence
+        return result
+
+    def switch(self, engine, reason):
+        self.engine = engine
+        self.switches.append((self.cycles, engine, reason))
+
+
+# The following classes implement the tracing of the script execution. The
+# interpreter notifies the active tracer about every cycle and every command.
+# Without a tracer, a loop without any instrumentation is used instead.
+
+
+class Tracer(object):
+    """ Base class for tracers. A tracer instance can be handed to the Sed object
+        (attribute tracer) and is then notified by the interpreter through the
+        following hook methods. They all do nothing here, so derived classes only
+        need to implement the events they are interested in.
+
+        start(state)                   before the first line of input is read
+        cycle_start(state)             before the first command of a cycle
+        command_executed(state, cmd)   the address of cmd matched, cmd is executed next
+        command_done(state, cmd)       cmd was executed
+        command_skipped(state, cmd)    the address of cmd did not match
+        cycle_end(state, last_cmd)     all commands of the cycle were processed and
+                                       last_cmd is the last command executed
+        printing(state, source, line)  line was printed by source (a command or autoprint)
+        finish(state)                  the input is processed or an error occurred
+
+        state is the ExecutionState of the run, its attribute sed the Sed object.
+    """
+
+    def start(self, state):
+        pass
+
+    def cycle_start(self, state):
+        pass
+
+    def command_executed(self, state, command):
+        pass
+
+    def command_done(self, state, command):
+        pass
+
+    def command_skipped(self, state, command):
+        pass
+
+    def cycle_end(self, state, last_command):
+        pass
+
+    def printing(self, state, source, line):
+        pass
+
+    def finish(self, state):
+        pass
+
+
+class DebugTracer(Tracer):
+    """ This tracer produces the output of the debug option on stderr: the
+        configuration and the compiled script, and for every cycle and command
+        the contents of pattern space, hold space and append buffer.
+    """
+
+    def start(self, state):
+        sed = state.sed
+        DEBUG('Configuration:')
+        DEBUG('  debug={dbg}', dbg=sed.debug)
+        DEBUG('  encoding={enc}', enc=sed.encoding)
+        DEBUG('  line_length={len}', len=sed.line_length)
+        DEBUG('  no_autoprint={np}', np=sed.no_autoprint)
+        DEBUG('  regexp_extended={ext}', ext=sed.regexp_extended)
+        DEBUG('  sed_compatible={comp}', comp=sed.sed_compatible)
+        DEBUG('  in_place={inp}', inp=('<off>' if sed.in_place is None
+                                       else u"'"+sed.in_place+u"'"))
+        DEBUG('  separate={sep}', sep=sed.separate)
+        DEBUG('')
+        DEBUG('{scr}', scr=state.compiled)
+        self.stateWriter = StateWriter(state)
+
+    def write_header(self, state, title):
+        DEBUG('{tit}', tit=title.ljust(state.line_length, '#'))
+        DEBUG('Auto Print: {ap}', ap='Off' if state.no_autoprint else 'On')
+        DEBUG('Input File: {fle}[{idx}]',
+              fle=state.reader.source_file_name,
+              idx=state.reader.line_number)
+        DEBUG('Output To : {fle}', fle=state.writer.current_filename)
+
+    def cycle_start(self, state):
+        self.write_header(state, '############### new cycle ')
+        self.stateWriter.writeState('current')
+
+    def command_executed(self, state, command):
+        DEBUG(' =============== executing '.ljust(state.line_length, '='))
+        DEBUG('{cmd}', cmd=command.toString())
+
+    def command_done(self, state, command):  # @UnusedVariable
+        self.stateWriter.writeState('after')
+
+    def command_skipped(self, state, command):
+        DEBUG(' =============== skipping '.ljust(state.line_length, '='))
+        DEBUG('{cmd}', cmd=command.toString())
+        self.stateWriter.writeState('current')
+
+    def cycle_end(self, state, last_command):
+        self.write_header(state, '############### cycle end ')
+        DEBUG('Last Command: {cmd}', cmd=last_command.function if last_command else ' ')
+        DEBUG('Pattern space is None: {flag}', flag=(state.PS is None))
+
+    def printing(self, state, source, line):  # @UnusedVariable
+        prefix = 'printing (' + source + '): '
+        for lne in line.split('\n'):
+            DEBUG('{prefix}{lne}', prefix=prefix, lne=lne.replace(' ', '\N{MIDDLE DOT}'))
+
+
+class StateWriter(object):
+
+    def __init__(self, state):
+        self.state = state
         self.last_PS = []
         self.last_HS = []
         self.last_append_buffer = []
@@ -1410,7 +2107,7 @@ class StateWriter(object):
                 # remove newline from last line
                 splitted[-1] = splitted[-1][:-1]
                 for line in splitted:
-                    for normalized in self.sed.normalize_string(line, width):
+                    for normalized in self.state.normalize_string(line, width):
                         result.append('|{lne:<{width}s}|'.format(
                             lne=normalized.replace(' ', '\N{MIDDLE DOT}'),
                             width=width))
@@ -1427,24 +2124,24 @@ class StateWriter(object):
             DEBUG('{flg}{lne}', flg=flag, lne=new_list[i])
 
     def writeState(self, title):
-        width = self.sed.line_length - 4
-        DEBUG('{tit}', tit=('--------------- ' + title + ' ').ljust(self.sed.line_length, '-'))
-        new = self._create_printable([self.sed.PS], width)
+        width = self.state.line_length - 4
+        DEBUG('{tit}', tit=('--------------- ' + title + ' ').ljust(self.state.line_length, '-'))
+        new = self._create_printable([self.state.PS], width)
         self._write_list('Pattern Space', self.last_PS, new)
         self.last_PS = new
 
-        new = self._create_printable([self.sed.HS], width)
+        new = self._create_printable([self.state.HS], width)
         self._write_list('Hold Space', self.last_HS, new)
         self.last_HS = new
 
-        new = self._create_printable(self.sed.append_buffer, width)
+        new = self._create_printable(self.state.append_buffer, width)
         self._write_list('Append Buffer', self.last_append_buffer, new)
         self.last_append_buffer = new
 
-        new = ('' if self.last_subst_successful == self.sed.subst_successful
+        new = ('' if self.last_subst_successful == self.state.subst_successful
                else '*')
-        DEBUG('{flg}Substitution successful: {sub}', flg=new, sub=self.sed.subst_successful)
-        self.last_subst_successful = self.sed.subst_successful
+        DEBUG('{flg}Substitution successful: {sub}', flg=new, sub=self.state.subst_successful)
+        self.last_subst_successful = self.state.subst_successful
 
 
 class Writer (object):
@@ -1804,6 +2501,29 @@ class ReaderBufferedOneStream(ReaderUnbufferedOneStream):
     def is_last_line(self):
         return self.nextline == '' and len(self.inputs) == 0
 
+    def read_to_last_line(self):
+        # returns the lines following the current line up to and including
+        # the last line, as readline would return them one after the other,
+        # followed by None if the input ends before (because the remaining
+        # inputs are empty)
+        lines = []
+        while not self.is_last_line():
+            if self.nextline == '':
+                # the next line is in the next input
+                lines.append(self.readline())
+                if lines[-1] is None:
+                    break
+                continue
+            rest = self.nextline + make_unicode(self.input_stream.read(),
+                                                self.current_input_encoding)
+            self.nextline = ''
+            rest_lines = rest.split('\n')
+            if rest.endswith('\n'):
+                rest_lines.pop()
+            self.line_number += len(rest_lines)
+            lines.extend(rest_lines)
+        return lines
+
 
 class ReaderBufferedSeparateInputs(ReaderBufferedOneStream):
     """ This reader class is just like ReaderUnbufferedSeparateInputs except
@@ -1838,24 +2558,1997 @@ class ReaderBufferedSeparateInputsInplace(ReaderBufferedSeparateInputs):
         return self.input_stream
 
 
-# The following classes implement the various sed commands. Each command
-# found in the script is translated into an instance of one of those classes
-# and the Sed.apply function that justs 'plays' down the list of these command
-# instances.
+class ExhaustionReader(object):
+    """ Stands in for the reader of a run of a script, whose commands all stop
+        being active for good after a certain line: single line numbers, ranges
+        starting at a line number and 0,/regexp/ ranges. Once a line beyond the
+        last line any command can start on is read and none of the ranges is
+        active anymore, no command can ever be active again. The line and all
+        the remaining input is then copied to the output (if autoprint is on)
+        and the end of the input is reported instead.
+    """
 
+    def __init__(self, reader, state, exhaustion):
+        self.reader = reader
+        self.state = state
+        (self.last_line, self.ranges) = exhaustion
 
-class Command(object):
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
 
-    def __init__(self, script, addr_range, function):
-        self.position = script.position
-        self.num = script.command_index()
-        if (function in [':', '}'] and not isinstance(addr_range, AddressRangeNone)):
-            raise SedException(self.position,
-                               'No address can be specified for command {cmd}',
-                               cmd=function)
-        elif (function == 'q'
-              and not (isinstance(addr_range, AddressRangeFake)
-                       or isinstance(addr_range, AddressRangeNone))):
+    @staticmethod
+    def find_exhaustion(first_command, analysis):
+        # returns (last line any command can start on, list of range indexes)
+        # or None if some command may be active on any line
+        if first_command is None or analysis.multi_line:
+            # n and N read lines in the middle of a cycle
+            return None
+        last_line = 0
+        ranges = []
+        command = first_command
+        while command:
+            addr_range = command.addr_range
+            if not getattr(addr_range, 'active_return', False):
+                return None
+            from_addr = addr_range.from_addr
+            if isinstance(addr_range, AddressRangeZeroToRegexp):
+                ranges.append(addr_range.index)
+            elif isinstance(from_addr, AddressNum):
+                last_line = max(last_line, from_addr.num)
+                if isinstance(addr_range, AddressRange):
+                    ranges.append(addr_range.index)
+            else:
+                return None
+            # the commands within a block can only run, if the block is active
+            command = command.next
+        return (last_line, ranges)
+
+    def readline(self):
+        line = self.reader.readline()
+        if (line is not None
+                and self.reader.line_number > self.last_line
+                and not any(self.state.ranges[index].active for index in self.ranges)):
+            self.state.statistics.exhausted_at = self.reader.line_number
+            if not self.state.no_autoprint:
+                printline = self.state.writer.printline
+                while line is not None:
+                    printline(line)
+                    line = self.reader.readline()
+            return None
+        return line
+
+
+# The following classes implement the execution engines. An engine takes the
+# compiled script and runs its cycles against the input, starting with the line
+# already read into the pattern space. The classic interpreter walks the linked
+# list of command instances, while the code generating engine translates the
+# script into the source of one Python function, that is compiled only once.
+
+
+class LineIndex(object):
+    """ An index over the commands, whose address only depends on the line
+        number: single line numbers, first~step addresses and address ranges
+        starting with one of those. Consecutive commands of this kind form a
+        run and for any line number the index tells which commands of a run
+        can be active, so that the interpreter can skip all others without
+        evaluating their addresses. Runs shorter than min_run are not indexed,
+        since evaluating their addresses costs less than the lookup.
+    """
+    min_run = 4
+
+    def __init__(self, first_command):
+        # maps every command of an indexed run to its run and position
+        self.members = {}
+        commands = []
+        command = first_command
+        while command:
+            commands.append(command)
+            command = command.branch if command.function == '{' else command.next
+        for command in commands:
+            if command in self.members or not self.is_indexable(command):
+                continue
+            run = [command]
+            while run[-1].next is not None and self.is_indexable(run[-1].next):
+                run.append(run[-1].next)
+            if len(run) >= self.min_run:
+                line_index_run = LineIndexRun(run)
+                for (pos, member) in enumerate(run):
+                    self.members[member] = (line_index_run, pos)
+
+    @staticmethod
+    def is_indexable(command):
+        addr_range = command.addr_range
+        return (isinstance(addr_range, (AddressRangeFake, AddressRange))
+                and addr_range.active_return
+                and isinstance(addr_range.from_addr, (AddressNum, AddressStep)))
+
+
+class LineIndexRun(object):
+    """ The index of one run of commands with line number addresses. """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.exit = commands[-1].next
+        # line number -> sorted positions of the commands starting on that line
+        self.lines = {}
+        # step -> remainder -> list of (position, first line)
+        self.steps = {}
+        # (position, range index) of the address ranges, that stay
+        # active after their first line and need to be evaluated then
+        self.ranges = []
+        for (pos, command) in enumerate(commands):
+            addr_range = command.addr_range
+            from_addr = addr_range.from_addr
+            if isinstance(from_addr, AddressNum):
+                self.lines.setdefault(from_addr.num, []).append(pos)
+            else:
+                self.steps.setdefault(from_addr.step, {})\
+                    .setdefault(from_addr.num % from_addr.step, [])\
+                    .append((pos, from_addr.num))
+            if isinstance(addr_range, AddressRange):
+                self.ranges.append((pos, addr_range.index))
+
+    def skip(self, state, pos):
+        # returns the first command at or after pos that may be active on
+        # the current line or the command following the run if there is none
+        line_no = state.file_line_no()
+        best = len(self.commands)
+        positions = self.lines.get(line_no)
+        if positions:
+            idx = bisect.bisect_left(positions, pos)
+            if idx < len(positions):
+                best = positions[idx]
+        for (step, remainders) in self.steps.items():
+            for (step_pos, first) in remainders.get(line_no % step, ()):
+                if pos <= step_pos < best and first <= line_no:
+                    best = step_pos
+        for (range_pos, index) in self.ranges:
+            if pos <= range_pos < best and state.ranges[index].active:
+                best = range_pos
+        if best == len(self.commands):
+            return self.exit
+        return self.commands[best]
+
+
+class Governor(object):
+    """ Enforces the resource limits of a run: the number of characters in the
+        pattern and the hold space, the number of commands executed in a cycle
+        and the time a cycle may take. The interpreter checks them after every
+        command executed, so a single regexp search taking long is noticed once
+        it returns. A limit exceeded raises SedLimitExceeded. If a Cancellation
+        is given, it is checked after every command as well, which stops branch
+        loops never reading another line.
+    """
+
+    def __init__(self, max_space, max_commands, max_line_time, cancellation=None):
+        self.max_space = max_space
+        self.max_commands = max_commands
+        self.max_line_time = max_line_time
+        self.cancellation = cancellation
+        self.commands = 0
+        self.deadline = None
+
+    @staticmethod
+    def for_sed(sed, cancellation=None):
+        # returns the Governor for the limits set for sed and the cancellation
+        # or None, if there is nothing to enforce
+        limits = [('max_space', sed.max_space, numbers.Integral),
+                  ('max_commands', sed.max_commands, numbers.Integral),
+                  ('max_line_time', sed.max_line_time, numbers.Real)]
+        for (name, value, kind) in limits:
+            if not isinstance(value, kind) or isinstance(value, bool) or value < 0:
+                raise SedException('', 'Invalid limit {name} {value}, '
+                                       'must be a non-negative number.', name=name, value=value)
+        if cancellation is None and not any(value for (_, value, _) in limits):
+            return None
+        return Governor(sed.max_space, sed.max_commands, sed.max_line_time, cancellation)
+
+    def cycle_start(self):
+        self.commands = 0
+        if self.max_line_time:
+            self.deadline = default_timer() + self.max_line_time
+
+    def check(self, state, command):
+        self.commands += 1
+        if self.max_commands and self.commands > self.max_commands:
+            raise SedLimitExceeded.at(state, command.position, 'More than {} commands executed '
+                                      'in one cycle'.format(self.max_commands))
+        if self.max_space:
+            if state.PS is not None and len(state.PS) > self.max_space:
+                raise SedLimitExceeded.at(state, command.position, 'Pattern space grew beyond '
+                                          '{} characters'.format(self.max_space))
+            if len(state.HS) > self.max_space:
+                raise SedLimitExceeded.at(state, command.position, 'Hold space grew beyond '
+                                          '{} characters'.format(self.max_space))
+        if self.deadline is not None and default_timer() > self.deadline:
+            raise SedLimitExceeded.at(state, command.position, 'Cycle took longer than '
+                                      '{} seconds'.format(self.max_line_time))
+        if self.cancellation is not None:
+            self.cancellation.check(state, command.position)
+
+
+class CancelToken(object):
+    """ Lets another thread stop a call of Sed.apply: pass the token to apply
+        and call its cancel method. Any object with an is_set method, like a
+        threading.Event, can be used as token as well.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_set(self):
+        return self.cancelled
+
+
+class Cancellation(object):
+    """ The cancel token and the deadline (in seconds since the epoch) of a
+        call of Sed.apply. They are checked whenever a line is read and, for
+        scripts with branch loops, after every command by the Governor of the
+        interpreter. Once the token is set or the deadline passed, the run is
+        stopped by raising SedCancelled.
+    """
+
+    def __init__(self, token, deadline):
+        self.token = token
+        self.deadline = deadline
+
+    @staticmethod
+    def create(token, deadline):
+        # returns the Cancellation for the arguments of apply or None if there are none
+        if token is None and deadline is None:
+            return None
+        if deadline is not None and type(deadline) not in (int, float):
+            raise SedException('', 'Invalid deadline {deadline}, '
+                                   'must be a time in seconds since the epoch.', deadline=deadline)
+        return Cancellation(token, deadline)
+
+    def check(self, state, position=''):
+        if self.token is not None and self.token.is_set():
+            raise SedCancelled.at(state, position, 'Run cancelled')
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SedCancelled.at(state, position, 'Deadline of the run passed')
+
+
+class CancellationReader(object):
+    """ Stands in for the reader of a run, which can be cancelled, and checks
+        the Cancellation before every line read. All engines read their lines
+        at the boundaries of the cycles, so they are all stopped there.
+    """
+
+    def __init__(self, reader, state, cancellation):
+        self.reader = reader
+        self.state = state
+        self.cancellation = cancellation
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def readline(self):
+        self.cancellation.check(self.state)
+        return self.reader.readline()
+
+
+class EngineInterpreter(object):
+    """ This engine 'plays' down the linked list of command instances for
+        each cycle by calling their apply_func method. Commands indexed by a
+        LineIndex are skipped on the lines they can not be active on. All runs
+        share one cycle loop, only the commands of a cycle are run differently
+        with a tracer or a Governor.
+    """
+    name = 'interpreter'
+
+    def __init__(self, compiled):
+        self.first_cmd = compiled.first_command
+        self.line_index = LineIndex(compiled.first_command)
+
+    @staticmethod
+    def rejection(planner):  # @UnusedVariable
+        return None
+
+    def run(self, state, cycles=-1):
+        # runs the given number of cycles (-1 for all) and returns the
+        # number of cycles run, state.PS is None if the run is complete
+        tracer = state.tracer
+        governor = state.governor
+        members = self.line_index.members
+        budget = cycles
+        while state.PS is not None:
+            if tracer is not None:
+                last_command = self.run_cycle_traced(state, tracer)
+            else:
+                last_command = self.run_cycle(state, members, governor)
+            last_relevant_command = last_command.function if last_command else ' '
+            if not (state.no_autoprint
+                    or last_relevant_command in 'DQ'
+                    or state.PS is None):
+                state.printline('autop', state.PS)
+            state.flush_append_buffer()
+            cycles -= 1
+            if last_relevant_command in 'qQ':
+                state.exit_code = last_command.exit_code or 0
+                state.PS = None
+                break
+            if last_relevant_command != 'D':
+                state.PS = state.readline()
+            if cycles == 0:
+                break
+        return budget - cycles
+
+    def run_cycle(self, state, members, governor):
+        # runs the commands of one cycle and returns the last one active,
+        # skipping over indexed commands that can not be active and checking
+        # the resource limits after every command
+        last_command = None
+        command = self.first_cmd
+        if governor is not None:
+            governor.cycle_start()
+        while command:
+            if members:
+                member = members.get(command)
+                if member is not None:
+                    command = member[0].skip(state, member[1])
+                    if command is None:
+                        break
+            prev_command = command
+            matched, command = command.apply_func(state)
+            if matched:
+                last_command = prev_command
+            if governor is not None:
+                governor.check(state, prev_command)
+        return last_command
+
+    def run_cycle_traced(self, state, tracer):
+        # same as run_cycle, but with the tracer notified about every step
+        command = self.first_cmd
+        tracer.cycle_start(state)
+        last_command = None
+        while command:
+            if command.addr_range.is_active(state):
+                tracer.command_executed(state, command)
+                last_command = command
+                command = command.apply(state)
+                tracer.command_done(state, last_command)
+            else:
+                tracer.command_skipped(state, command)
+                command = command.next
+        tracer.cycle_end(state, last_command)
+        return last_command
+
+
+class EngineCodegen(object):
+    """ This engine translates the compiled script into the source code of a
+        single Python function running all cycles. Labels and blocks become
+        jumps within a dispatch loop (or plain nested if-statements, where no
+        jump goes into a block), addresses are inlined as comparisons and all
+        regular expressions and other objects needed are bound to local variables.
+        If the generated source can not be compiled by Python (for example
+        because of too deeply nested blocks), the classic interpreter is used.
+    """
+    name = 'codegen'
+    # below this number of lines generating the code costs more than it saves
+    min_lines = 256
+
+    @classmethod
+    def rejection(cls, planner):
+        if planner.tracer is not None:
+            return 'tracing is only supported by the interpreter'
+        engine = planner.compiled.engines.get(cls.name)
+        if engine is not None:
+            if engine.function is None:
+                return 'the generated code could not be compiled'
+        elif (planner.requested == 'auto'
+              and planner.literal_lines is not None
+              and planner.literal_lines < cls.min_lines):
+            return 'generating the code does not pay off for {} lines of input'.format(
+                planner.literal_lines)
+        return None
+
+    def __init__(self, compiled):
+        self.source, constants = CodeGenerator(compiled).generate()
+        self.constants = tuple(value for (_, value) in constants)
+        try:
+            namespace = {}
+            exec(compile(self.source, '<sed script>', 'exec'), namespace)
+            self.function = namespace['run']
+        except (SyntaxError, RuntimeError, MemoryError):
+            self.function = None
+            self.fallback = EngineInterpreter(compiled)
+        if compiled.debug >= 2:
+            DEBUG('{src}', src=self.source)
+
+    def run(self, state, cycles=-1):
+        if self.function is None:
+            return self.fallback.run(state, cycles)
+        return self.function(state, self.constants, cycles)
+
+
+class EngineBatch(object):
+    """ This engine runs line-local scripts on blocks of lines. Instead of
+        running all commands for one line after the other, every command is
+        applied to all lines of the block it is active for, so the overhead of
+        calling a command is paid once per block. The addresses of a command
+        split the lines arriving at it into the ones it is active for and the
+        others. As long as no branch goes backwards, the commands can be run
+        in the order of the script, with the lines jumping forward waiting at
+        their target. The output of each line is collected in a LineBatch and
+        printed in the order of the lines once the block is done.
+    """
+    name = 'batch'
+    block_size = 1000
+
+    @classmethod
+    def rejection(cls, planner):
+        if planner.tracer is not None:
+            return 'tracing is only supported by the interpreter'
+        if not planner.compiled.analysis.line_local:
+            return 'the script is not line-local'
+        if planner.sed.in_place is not None:
+            return 'in-place editing switches output files while reading'
+        for command in cls.program(planner.compiled.first_command):
+            # all commands of line-local scripts can be run in batches
+            if not hasattr(command, 'apply_batch'):  # pragma: no cover
+                return 'command {cmd} at {pos} can not be run in batches'.format(
+                    cmd=command.function, pos=command.position)
+        command = Planner.backward_branch(planner.compiled.first_command)
+        if command is not None:
+            return 'command {cmd} at {pos} branches backwards'.format(
+                cmd=command.function, pos=command.position)
+        return None
+
+    @staticmethod
+    def program(first_command):
+        # the commands in the order of the script, the first command
+        # within a block follows the block command itself
+        commands = []
+        command = first_command
+        while command:
+            commands.append(command)
+            command = command.branch if command.function == '{' else command.next
+        return commands
+
+    def __init__(self, compiled):
+        self.commands = self.program(compiled.first_command)
+        self.positions = dict((id(command), pos)
+                              for (pos, command) in enumerate(self.commands))
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        while state.PS is not None and cycles != 0:
+            size = self.block_size if cycles < 0 else min(self.block_size, cycles)
+            lines = []
+            while state.PS is not None and len(lines) < size:
+                lines.append(state.PS)
+                state.PS = state.readline()
+            self.run_batch(state, LineBatch(state, lines))
+            cycles -= len(lines)
+        return budget - cycles
+
+    def run_batch(self, state, batch):
+        positions = self.positions
+        # the lines waiting at the position of the commands jumped to
+        waiting = {}
+        current = list(range(len(batch.lines)))
+        for (pos, command) in enumerate(self.commands):
+            if pos in waiting:
+                current.extend(waiting.pop(pos))
+            if not current:
+                continue
+            active, inactive = command.addr_range.batch_mask(batch, current)
+            routes = [(command.next, inactive)]
+            if active:
+                routes.extend(command.apply_batch(batch, active))
+            current = []
+            for (target, indexes) in routes:
+                if target is None or not indexes:
+                    # the cycle of these lines has ended
+                    continue
+                target_pos = positions[id(target)]
+                if target_pos == pos + 1:
+                    current.extend(indexes)
+                else:
+                    waiting.setdefault(target_pos, []).extend(indexes)
+        printline = state.writer.printline
+        autoprint = not state.no_autoprint
+        for (line, printed, appended) in zip(batch.lines, batch.printed, batch.appended):
+            for printed_line in printed:
+                printline(printed_line)
+            if autoprint and line is not None:
+                printline(line)
+            for appended_line in appended:
+                printline(appended_line)
+
+
+class LineBatch(object):
+    """ The lines of a block run by an EngineBatch and what happened to each of
+        them so far: the lines printed, the contents of the append buffer and the
+        substitution flag. The line itself is None once it has been deleted.
+    """
+
+    def __init__(self, state, lines):
+        self.state = state
+        self.lines = lines
+        self.printed = [[] for _ in lines]
+        self.appended = [[] for _ in lines]
+        self.subst = [False] * len(lines)
+        # the lines last scanned by the AddressScan and the literals found
+        self.scanned = [None] * len(lines)
+        self.scan_found = [None] * len(lines)
+
+
+class EngineWindow(object):
+    """ This engine runs scripts keeping a sliding window of lines in the pattern
+        space, like $!N;P;D. The pattern space is held as a deque of its lines:
+        N appends to it, D removes its first line and P prints its first line,
+        so none of them copies the whole window like the string operations of
+        the other engines do. The lines are joined into the pattern space string
+        only if another command or a regexp address needs it and the string is
+        split into lines again only after such a command has changed it. If the
+        string was needed in the previous cycle, N and D update it along with
+        the deque instead of joining all lines again.
+    """
+    name = 'window'
+    # commands, that do not use the pattern space
+    ignoring_ps = ':{}btT=aiqQvF'
+
+    @classmethod
+    def rejection(cls, planner):
+        if planner.tracer is not None:
+            return 'tracing is only supported by the interpreter'
+        kinds = set(type(command) for command in
+                    EngineBatch.program(planner.compiled.first_command))
+        if Command_N not in kinds or Command_D not in kinds:
+            return 'the script keeps no window of lines (commands N and D)'
+        return None
+
+    def __init__(self, compiled):
+        self.first_cmd = compiled.first_command
+        # how each command is run: 'N', 'P' and 'D' on the deque, 'ignore'
+        # without the pattern space and 'string' on the pattern space string
+        self.kinds = {}
+        # commands, whose address needs the pattern space string
+        self.reading_address = set()
+        for command in EngineBatch.program(compiled.first_command):
+            if type(command) in (Command_N, Command_P, Command_D):
+                kind = command.function
+            elif command.function in self.ignoring_ps:
+                kind = 'ignore'
+            else:
+                kind = 'string'
+            self.kinds[id(command)] = kind
+            if command.regexps():
+                self.reading_address.add(id(command))
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        kinds = self.kinds
+        reading_address = self.reading_address
+        # the lines of the pattern space, None if they have to be split from
+        # state.PS, otherwise state.PS is only up to date if joined is True
+        window = None
+        joined = True
+        # whether the pattern space string was needed in the previous cycle
+        # and in the current one
+        keep_string = needed = False
+        while state.PS is not None:
+            command = self.first_cmd
+            last_relevant_command = ' '
+            while command:
+                if id(command) in reading_address:
+                    needed = True
+                    if not joined:
+                        state.PS = '\n'.join(window)
+                        joined = True
+                if not command.addr_range.is_active(state):
+                    command = command.next
+                    continue
+                last_relevant_command = command.function
+                prev_command = command
+                kind = kinds[id(command)]
+                if kind == 'N':
+                    if window is None:
+                        window = collections.deque(state.PS.split('\n'))
+                    newline = state.readline()
+                    if newline is None:
+                        command = None
+                    else:
+                        window.append(newline)
+                        if joined and keep_string:
+                            state.PS = state.PS + '\n' + newline
+                        else:
+                            joined = False
+                        command = command.next
+                elif kind == 'P':
+                    if joined:
+                        state.printline('cmd P', state.PS.split('\n', 1)[0])
+                    else:
+                        state.printline('cmd P', window[0])
+                    command = command.next
+                elif kind == 'D':
+                    if window is None:
+                        window = collections.deque(state.PS.split('\n'))
+                    if len(window) > 1:
+                        window.popleft()
+                        if joined and keep_string:
+                            state.PS = state.PS[state.PS.index('\n') + 1:]
+                        else:
+                            joined = False
+                    else:
+                        state.PS = state.readline()
+                        window = None
+                        joined = True
+                    command = None
+                elif kind == 'ignore':
+                    command = command.apply(state)
+                else:
+                    needed = True
+                    if not joined:
+                        state.PS = '\n'.join(window)
+                        joined = True
+                    before = state.PS
+                    command = command.apply(state)
+                    if state.PS is not before:
+                        window = None
+            if not (state.no_autoprint
+                    or last_relevant_command in 'DQ'
+                    or state.PS is None):
+                if not joined:
+                    state.PS = '\n'.join(window)
+                    joined = True
+                state.printline('autop', state.PS)
+            state.flush_append_buffer()
+            cycles -= 1
+            keep_string, needed = needed, False
+            if last_relevant_command in 'qQ':
+                state.exit_code = prev_command.exit_code or 0
+                state.PS = None
+                window = None
+                joined = True
+                break
+            if last_relevant_command != 'D':
+                state.PS = state.readline()
+                window = None
+                joined = True
+            if cycles == 0:
+                break
+        if not joined:
+            # the next engine expects the pattern space as string
+            state.PS = '\n'.join(window)
+        return budget - cycles
+
+
+class Rope(object):
+    """ The text of two parts joined by a newline, each of which is a string or
+        a rope again, as built by G, H and N. Since ropes are never changed, they
+        can be shared between the pattern space and the hold space, so appending
+        to either of them and copying them is done in constant time. The parts
+        are joined into a string only when it is needed, which is then kept
+        instead of the parts.
+    """
+    __slots__ = ('parts', 'text', 'length')
+
+    def __init__(self, left, right):
+        self.parts = (left, right)
+        self.text = None
+        self.length = len(left) + 1 + len(right)
+
+    def __len__(self):
+        return self.length
+
+    def string(self):
+        if self.text is None:
+            # walks the tree without recursion, since it may be as deep as the
+            # number of lines appended
+            chunks = []
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                if type(node) is SpilledText:
+                    chunks.append(node.string())
+                elif type(node) is SpilledRope:
+                    stack.extend(reversed(node.parts))
+                elif type(node) is not Rope:
+                    chunks.append(node)
+                elif node.text is not None:
+                    chunks.append(node.text)
+                else:
+                    stack.extend((node.parts[1], '\n', node.parts[0]))
+            self.text = ''.join(chunks)
+            self.parts = None
+        return self.text
+
+
+class SpilledText(object):
+    """ Text moved to a spill file, held as its place in the file. It takes
+        the place of a string or a rope in the hold or pattern space and is
+        read back whenever the text is needed.
+    """
+    __slots__ = ('spill_file', 'offset', 'size', 'length')
+
+    def __init__(self, spill_file, offset, size, length):
+        self.spill_file = spill_file
+        self.offset = offset
+        self.size = size
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def string(self):
+        return self.spill_file.read(self.offset, self.size)
+
+
+class SpilledRope(object):
+    """ Spilled texts, which are not one after the other in the spill file,
+        concatenated.
+    """
+    __slots__ = ('parts', 'length')
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = sum(len(part) for part in parts)
+
+    def __len__(self):
+        return self.length
+
+    def string(self):
+        return Rope.string(Rope('', self))[1:]
+
+
+class SpillFile(object):
+    """ An anonymous temporary file the rope engine moves the hold space and
+        the pattern space to once they grow beyond the threshold, so a script
+        gathering its input in the hold space is not limited by the memory.
+        The text is appended to the file and read back through a memory map.
+        Text no longer held by either space is left in the file until it makes
+        up half of it, when the text still held is moved to the start of the
+        file and the file is truncated. Text read back for a command is in
+        memory anyway and is likely to be rewritten, so the threshold is
+        raised to twice its length, which keeps scripts editing the whole
+        hold space in every cycle from writing it to the file again and again.
+        The file is removed when it is closed at the end of the run.
+    """
+    # keeps lone surrogates of undecodable input as they are
+    errors = 'strict' if PY2 else 'surrogatepass'
+    # the size of the chunks copied when compacting the file
+    CHUNK = 1 << 20
+
+    def __init__(self, threshold, statistics):
+        self.threshold = threshold
+        self.statistics = statistics
+        self.file = TemporaryFile()
+        self.size = 0
+        self.map = None
+        # the size of the file after it was compacted last
+        self.compacted_size = 0
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def write(self, text):
+        data = text.encode('utf-8', self.errors)
+        self.file.write(data)
+        self.size += len(data)
+        self.statistics.spilled_bytes += len(data)
+        self.statistics.spill_file_size = max(self.statistics.spill_file_size, self.size)
+
+    def read(self, offset, size):
+        if size == 0:
+            return ''
+        return self.read_bytes(offset, size).decode('utf-8', self.errors)
+
+    def read_bytes(self, offset, size):
+        if self.map is None or len(self.map) < offset + size:
+            # the file has grown since it was mapped
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + size]
+
+    def read_back(self, length):
+        # called when a spilled text of the given length is read back for a command
+        self.threshold = max(self.threshold, 2 * length)
+
+    def spill(self, text, other):
+        # writes the strings in a string or a rope to the file and returns the
+        # text spilled, text already spilled is not written again, and a string
+        # following text spilled just before extends it, so appending to a
+        # spilled hold space only writes what is appended. other is the other
+        # space, which keeps its spilled text when the file is compacted
+        spilled = []
+        stack = [text]
+        while stack:
+            part = stack.pop()
+            if type(part) is Rope:
+                if part.text is None:
+                    stack.extend((part.parts[1], '\n', part.parts[0]))
+                    continue
+                part = part.text
+            if type(part) in (SpilledText, SpilledRope):
+                spilled.append(part)
+                continue
+            start, length = self.size, len(part)
+            last = spilled[-1] if spilled else None
+            if type(last) is SpilledText and last.spill_file is self \
+                    and last.offset + last.size == self.size:
+                start, length = last.offset, last.length + length
+                spilled.pop()
+            self.write(part)
+            spilled.append(SpilledText(self, start, self.size - start, length))
+        if len(spilled) == 1:
+            text = spilled[0]
+        else:
+            text = SpilledRope(tuple(spilled))
+        if self.size - self.compacted_size > max(self.compacted_size, self.threshold):
+            self.compact((text, other))
+        return text
+
+    def compact(self, roots):
+        # moves the text held by the roots to the start of the file and
+        # truncates it, the spilled texts are changed to their new places
+        spilled = {}
+        stack = list(roots)
+        while stack:
+            node = stack.pop()
+            if type(node) is SpilledText:
+                spilled[id(node)] = node
+            elif type(node) is SpilledRope:
+                stack.extend(node.parts)
+            elif type(node) is Rope and node.text is None:
+                stack.extend(node.parts)
+        # spilled texts extended by later ones overlap them
+        spilled = sorted(spilled.values(), key=lambda node: (node.offset, -node.size))
+        intervals = []
+        for node in spilled:
+            if intervals and node.offset < intervals[-1][1]:
+                intervals[-1][1] = max(intervals[-1][1], node.offset + node.size)
+            else:
+                intervals.append([node.offset, node.offset + node.size])
+        size = 0
+        index = -1
+        for node in spilled:
+            while index < 0 or node.offset >= intervals[index][1]:
+                index += 1
+                start, end = intervals[index]
+                intervals[index].append(size)
+                # moving the text to the front never overwrites text still to move
+                for chunk in range(start, end, self.CHUNK):
+                    data = self.read_bytes(chunk, min(self.CHUNK, end - chunk))
+                    self.file.seek(size + chunk - start)
+                    self.file.write(data)
+                size += end - start
+            node.offset = intervals[index][2] + node.offset - intervals[index][0]
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.seek(size)
+        self.file.truncate()
+        self.size = self.compacted_size = size
+
+
+class EngineRope(object):
+    """ This engine runs scripts accumulating text in the hold space, like
+        H;$!d;x;s/\n/ /g or G;h;$!d. While running, the pattern space and the
+        hold space may be ropes: G, H and N append to them without copying the
+        text appended to and g, h and x only pass them around. They are joined
+        into strings for the commands and the regexp addresses reading the
+        pattern space and for printing, but not for commands like d or b, so a
+        script appending every line to the hold space no longer copies the hold
+        space for every line. With a spill file, a hold space or pattern space
+        growing beyond its threshold is moved to the file.
+    """
+    name = 'rope'
+    # commands, that do not read the pattern space
+    ignoring_ps = EngineWindow.ignoring_ps + 'd'
+
+    @classmethod
+    def rejection(cls, planner):
+        if planner.tracer is not None:
+            return 'tracing is only supported by the interpreter'
+        functions = set(command.function for command in
+                        EngineBatch.program(planner.compiled.first_command))
+        if 'H' not in functions and not ('G' in functions and functions & set('hx')):
+            return 'the script does not accumulate text in the hold space (commands H or G and h)'
+        return None
+
+    def __init__(self, compiled):
+        self.first_cmd = compiled.first_command
+        # how each command is run: 'G', 'H', 'N' on ropes, 'ignore' without the
+        # pattern space, 'string' on the pattern space string and 'strings' on
+        # the pattern space and hold space strings
+        self.kinds = {}
+        # commands, whose address needs the pattern space string
+        self.reading_address = set()
+        for command in EngineBatch.program(compiled.first_command):
+            if type(command) in (Command_G, Command_H, Command_N):
+                kind = command.function
+            elif command.function in self.ignoring_ps + 'ghx':
+                kind = 'ignore'
+            elif command.function == '@':
+                kind = 'strings'
+            else:
+                kind = 'string'
+            self.kinds[id(command)] = kind
+            if command.regexps():
+                self.reading_address.add(id(command))
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        kinds = self.kinds
+        reading_address = self.reading_address
+        lazy = (Rope, SpilledText, SpilledRope)
+        spill_file = state.spill_file
+
+        def string(text):
+            # the string of a lazy space needed by a command
+            if type(text) is not Rope:
+                spill_file.read_back(len(text))
+            return text.string()
+
+        try:
+            while state.PS is not None:
+                command = self.first_cmd
+                last_relevant_command = ' '
+                while command:
+                    if id(command) in reading_address and type(state.PS) in lazy:
+                        state.PS = string(state.PS)
+                    if not command.addr_range.is_active(state):
+                        command = command.next
+                        continue
+                    last_relevant_command = command.function
+                    prev_command = command
+                    kind = kinds[id(command)]
+                    if kind == 'G':
+                        state.PS = Rope(state.PS, state.HS)
+                        if spill_file is not None and len(state.PS) > spill_file.threshold:
+                            state.PS = spill_file.spill(state.PS, state.HS)
+                        command = command.next
+                    elif kind == 'H':
+                        state.HS = Rope(state.HS, state.PS)
+                        if spill_file is not None and len(state.HS) > spill_file.threshold:
+                            state.HS = spill_file.spill(state.HS, state.PS)
+                        command = command.next
+                    elif kind == 'N':
+                        newline = state.readline()
+                        if newline is None:
+                            command = None
+                        else:
+                            state.PS = Rope(state.PS, newline)
+                            if spill_file is not None and len(state.PS) > spill_file.threshold:
+                                state.PS = spill_file.spill(state.PS, state.HS)
+                            command = command.next
+                    elif kind == 'ignore':
+                        command = command.apply(state)
+                    else:
+                        if type(state.PS) in lazy:
+                            state.PS = string(state.PS)
+                        if kind == 'strings' and type(state.HS) in lazy:
+                            state.HS = string(state.HS)
+                        command = command.apply(state)
+                if not (state.no_autoprint
+                        or last_relevant_command in 'DQ'
+                        or state.PS is None):
+                    if type(state.PS) in lazy:
+                        state.PS = state.PS.string()
+                    state.printline('autop', state.PS)
+                state.flush_append_buffer()
+                cycles -= 1
+                if last_relevant_command in 'qQ':
+                    state.exit_code = prev_command.exit_code or 0
+                    state.PS = None
+                    break
+                if last_relevant_command != 'D':
+                    state.PS = state.readline()
+                if cycles == 0:
+                    break
+        finally:
+            # the other engines expect strings
+            if type(state.PS) in lazy:
+                state.PS = state.PS.string()
+            if type(state.HS) in lazy:
+                state.HS = state.HS.string()
+        return budget - cycles
+
+
+# The following classes implement the kernels: purpose-built implementations of
+# well-known one-liners. A kernel is recognized by the shape of the compiled
+# script, that is the kind and the address of every command, which is compared
+# to the shape of the script the kernel stands in for. Further kernels can be
+# added by deriving from Kernel and appending the class to KERNELS.
+
+
+class Kernel(object):
+    """ Base class of the kernels. A derived class gives its name, the script
+        it stands in for, whether auto print has to be on or off and implements
+        run just like an engine does, leaving the state after every cycle as
+        the script would. The instance is created with the list of the commands
+        of the recognized script.
+    """
+    name = None
+    script = None
+    no_autoprint = False
+
+    def __init__(self, commands):
+        self.commands = commands
+
+    @classmethod
+    def shape(cls):
+        # the shape of the script, computed once
+        if '_shape' not in cls.__dict__:
+            sed = Sed()
+            sed.load_string(cls.script)
+            cls._shape = script_shape(sed.compile())
+        return cls._shape
+
+    def run(self, state, cycles=-1):  # pragma: no cover (abstract)
+        raise NotImplementedError
+
+
+def script_shape(compiled):
+    # the kind and the address of every command of the compiled script, but
+    # nothing of how the script was written
+    shape = []
+    for command in EngineBatch.program(compiled.first_command):
+        addr_range = command.addr_range
+        if isinstance(addr_range, AddressRangeNone):
+            address = None
+        elif isinstance(addr_range, AddressRangeFake):
+            from_addr = addr_range.from_addr
+            if isinstance(from_addr, AddressLast):
+                address = '$'
+            elif isinstance(from_addr, AddressNum):
+                address = from_addr.num
+            elif getattr(from_addr, 'regexp', None) is not None \
+                    and getattr(from_addr.regexp, 'compiled', None) is not None:
+                # the empty regexp has no pattern of its own
+                address = (from_addr.regexp.compiled.pattern, from_addr.regexp.compiled.flags)
+            else:
+                address = type(from_addr).__name__
+            address = (address, addr_range.active_return)
+        else:
+            address = type(addr_range).__name__
+        shape.append((type(command).__name__, address))
+    return shape
+
+
+class KernelCount(Kernel):
+    """ Prints the number of input lines (wc -l). The lines up to the last one
+        are read at once and only counted.
+    """
+    name = 'count'
+    script = '$='
+    no_autoprint = True
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        while state.PS is not None and cycles != 0:
+            if cycles < 0 and not state.is_last_line():
+                # a cycle for every line, that does nothing but reading the next one
+                lines = state.reader.read_to_last_line()
+                if lines and lines[-1] is None:
+                    cycles -= len(lines)
+                    state.PS = None
+                    break
+                cycles -= len(lines)
+            elif not state.is_last_line():
+                cycles -= 1
+                state.PS = state.readline()
+                continue
+            state.printline('cmd =', str(state.reader.line_number))
+            cycles -= 1
+            state.PS = state.readline()
+        return budget - cycles
+
+
+class KernelTac(Kernel):
+    """ Prints the input lines in reverse order (tac). Instead of prepending
+        every line to the ever growing hold space, the lines are collected in a
+        list and joined only to be printed on the last line.
+    """
+    name = 'tac'
+    script = '1!G;h;$!d'
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        not_first = self.commands[0].addr_range
+        # the lines of the hold space, most recent last
+        lines = None
+        while state.PS is not None and cycles != 0:
+            if not not_first.is_active(state):
+                lines = [state.PS]
+            else:
+                if lines is None:
+                    lines = state.HS.split('\n')
+                    lines.reverse()
+                lines.append(state.PS)
+            if state.is_last_line():
+                state.printline('autop', '\n'.join(reversed(lines)))
+            cycles -= 1
+            state.PS = state.readline()
+        if lines is not None:
+            state.HS = '\n'.join(reversed(lines))
+        return budget - cycles
+
+
+class KernelUniq(Kernel):
+    """ Prints the input lines leaving out repeated lines (uniq). Two lines are
+        compared as strings instead of matching a back reference against the
+        pattern space holding both.
+    """
+    name = 'uniq'
+    script = '$!N;/^\\(.*\\)\\n\\1$/!P;D'
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        repeated = self.commands[1].regexps()[0]
+        while state.PS is not None and cycles != 0:
+            cycles -= 1
+            if state.is_last_line():
+                state.last_regexp = repeated
+                state.printline('cmd P', state.PS)
+                state.PS = state.readline()
+                continue
+            newline = state.readline()
+            if newline is None:
+                state.printline('autop', state.PS)
+                state.PS = state.readline()
+                continue
+            state.last_regexp = repeated
+            if state.PS != newline:
+                state.printline('cmd P', state.PS)
+            state.PS = newline
+        return budget - cycles
+
+
+class KernelSqueeze(Kernel):
+    """ Prints the input lines squeezing runs of empty lines into one (cat -s).
+        The lines are compared to the empty string instead of matching regexps.
+    """
+    name = 'squeeze'
+    script = '/^$/N;/\\n$/D'
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        empty, ending_empty = self.commands[0].regexps()[0], self.commands[1].regexps()[0]
+        while state.PS is not None and cycles != 0:
+            cycles -= 1
+            if state.PS == '':
+                newline = state.readline()
+                if newline is None:
+                    state.last_regexp = empty
+                    state.printline('autop', state.PS)
+                    state.PS = state.readline()
+                    continue
+                state.last_regexp = ending_empty
+                if newline == '':
+                    continue
+                state.printline('autop', '\n' + newline)
+            else:
+                state.last_regexp = ending_empty
+                state.printline('autop', state.PS)
+            state.PS = state.readline()
+        return budget - cycles
+
+
+KERNELS = [KernelCount, KernelTac, KernelUniq, KernelSqueeze]
+
+
+class EngineKernel(object):
+    """ This engine runs the kernel for a well-known one-liner, if the script
+        is one of them. The kernels are tried in the order of KERNELS.
+    """
+    name = 'kernel'
+
+    @staticmethod
+    def recognize(compiled, no_autoprint):
+        # returns the kernel class standing in for the script or None
+        shape = script_shape(compiled)
+        for kernel in KERNELS:
+            if kernel.no_autoprint == no_autoprint and kernel.shape() == shape:
+                return kernel
+        return None
+
+    @classmethod
+    def rejection(cls, planner):
+        if planner.tracer is not None:
+            return 'tracing is only supported by the interpreter'
+        if cls.recognize(planner.compiled, planner.sed.no_autoprint) is None:
+            return 'the script is no well-known one-liner'
+        return None
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.commands = list(EngineBatch.program(compiled.first_command))
+
+    def run(self, state, cycles=-1):
+        kernel = self.recognize(self.compiled, state.no_autoprint)
+        state.statistics.kernel = kernel.name
+        return kernel(self.commands).run(state, cycles)
+
+
+ENGINES = {EngineInterpreter.name: EngineInterpreter,
+           EngineCodegen.name: EngineCodegen,
+           EngineBatch.name: EngineBatch,
+           EngineWindow.name: EngineWindow,
+           EngineRope.name: EngineRope,
+           EngineKernel.name: EngineKernel}
+
+# the engines in the order the planner tries them, the interpreter
+# comes last, since it can run every script. An engine added to ENGINES
+# has to be added here as well to be planned
+PLAN_ORDER = [EngineKernel.name, EngineRope.name, EngineCodegen.name, EngineBatch.name,
+              EngineWindow.name, EngineInterpreter.name]
+
+# engines used without sampling the others, since their advantage is not
+# visible in the first cycles or they beat the others in any case
+UNSAMPLED = [EngineKernel.name, EngineRope.name]
+
+
+class Plan(object):
+    """ The result of the planning of a run: the engine to use and for every
+        engine tried the reason for not using it (None for the chosen one).
+    """
+
+    def __init__(self, engine, requested, sampled, shadow, shadow_reason, exhaustion,
+                 exhaustion_reason, line_memo, line_memo_reason, spill, spill_reason, kernel,
+                 governor, inputs, analysis, optimizations, candidates):
+        self.engine = engine
+        self.requested = requested
+        self.sampled = sampled
+        # every how many cycles the engine is checked in shadow mode
+        self.shadow = shadow
+        self.shadow_reason = shadow_reason
+        # (last line any command can start on, indexes of ranges to be inactive)
+        self.exhaustion = exhaustion
+        self.exhaustion_reason = exhaustion_reason
+        # the number of input lines whose output is memoized
+        self.line_memo = line_memo
+        self.line_memo_reason = line_memo_reason
+        # the size beyond which the hold and pattern space are spilled to disk
+        self.spill = spill
+        self.spill_reason = spill_reason
+        # the kernel class the script is recognized as or None
+        self.kernel = kernel
+        # the Governor the interpreter checks after every command or None
+        self.governor = governor
+        self.inputs = inputs
+        self.analysis = analysis
+        self.optimizations = optimizations
+        self.candidates = candidates
+
+    def __str__(self):
+        result = 'engine: {eng} ({req} requested)\n'.format(eng=self.engine,
+                                                            req=self.requested)
+        if self.kernel is not None:
+            result += 'kernel: {name} ({script})\n'.format(name=self.kernel.name,
+                                                          script=self.kernel.script)
+        result += 'input: {}\n'.format(', '.join(
+            '{kind} {name}'.format(kind=kind, name=name) for (kind, name) in self.inputs))
+        if self.analysis.line_local:
+            result += 'script: line-local\n'
+        else:
+            result += 'script: not line-local ({})\n'.format(', '.join(
+                name for (name, _) in self.analysis.PROPERTIES
+                if getattr(self.analysis, name)))
+        result += 'optimizations: {}\n'.format(len(self.optimizations))
+        if self.shadow:
+            result += 'shadow: every {}. cycle checked against the reference interpreter\n'\
+                      .format(self.shadow)
+        elif self.shadow_reason:
+            result += 'shadow: off, {}\n'.format(self.shadow_reason)
+        if self.exhaustion:
+            result += 'early termination: once past line {} with no range active\n'\
+                      .format(self.exhaustion[0])
+        elif self.exhaustion_reason:
+            result += 'early termination: off, {}\n'.format(self.exhaustion_reason)
+        if self.line_memo:
+            result += 'line memo: output of up to {} input lines\n'.format(self.line_memo)
+        elif self.line_memo_reason:
+            result += 'line memo: off, {}\n'.format(self.line_memo_reason)
+        if self.spill:
+            result += 'spill: hold and pattern space beyond {} characters to disk\n'\
+                      .format(self.spill)
+        elif self.spill_reason:
+            result += 'spill: off, {}\n'.format(self.spill_reason)
+        for (name, reason) in self.candidates:
+            if name in self.sampled:
+                result += '  {name}: {what}sampled for {num} cycles\n'.format(
+                    name=name,
+                    what='chosen, ' if name == self.engine else '',
+                    num=EngineAdaptive.sample_cycles)
+            elif reason is None:
+                result += '  {name}: chosen\n'.format(name=name)
+            else:
+                result += '  {name}: rejected, {reason}\n'.format(name=name,
+                                                                  reason=reason)
+        return result
+
+
+class Planner(object):
+    """ Picks the engine running a compiled script on a given input. The
+        engines are tried in the order of PLAN_ORDER and the first one, whose
+        rejection method finds no reason against the script, the options and
+        the kind of input, is used. With engine 'auto' all engines are tried,
+        otherwise only the requested one and the interpreter. If more than one
+        engine can be used with engine 'auto', all of them are sampled at the
+        start of the run by an EngineAdaptive. In shadow mode the chosen engine
+        is checked by an EngineShadow instead and with a line memo it is wrapped
+        by an EngineLineMemo.
+    """
+
+    def __init__(self, sed, compiled, inputs, tracer, cancellation=None):
+        self.sed = sed
+        self.compiled = compiled
+        self.tracer = tracer
+        self.requested = sed.engine
+        if self.requested != 'auto' and self.requested not in PLAN_ORDER:
+            raise SedException('', 'Unknown execution engine {name}. Use one of {names}.',
+                               name=self.requested,
+                               names=', '.join(['auto'] + sorted(PLAN_ORDER)))
+        if inputs is None or inputs == '':
+            inputs = []
+        elif type(inputs) != list:
+            inputs = [inputs]
+        if len(inputs) == 0 or len(inputs) == 1 and not inputs[0]:
+            inputs = ['-']
+        self.inputs = [self.input_kind(inp) for inp in inputs]
+        # branch loops can only be cancelled, if the interpreter checks every command
+        self.governor = Governor.for_sed(sed)
+        self.governed_reason = None
+        if self.governor is not None:
+            self.governed_reason = 'resource limits are enforced by the interpreter only'
+        if cancellation is not None:
+            loop = self.backward_branch(compiled.first_command)
+            if loop is not None:
+                self.governor = Governor.for_sed(sed, cancellation)
+                self.governed_reason = 'the branch loop at {} can only be cancelled by ' \
+                                       'the interpreter'.format(loop.position)
+        # the number of lines is only known, if all inputs are literals
+        self.literal_lines = None
+        if all(type(self.unpack(inp)) == list for inp in inputs):
+            self.literal_lines = sum(len(self.unpack(inp)) for inp in inputs)
+
+    @staticmethod
+    def backward_branch(first_command):
+        # returns the first branch command jumping backwards or None
+        program = EngineBatch.program(first_command)
+        positions = dict((id(command), pos) for (pos, command) in enumerate(program))
+        for (pos, command) in enumerate(program):
+            if (isinstance(command, Command_b) and command.branch
+                    and command.branch.next is not None
+                    and positions[id(command.branch.next)] <= pos):
+                return command
+        return None
+
+    @staticmethod
+    def unpack(inp):
+        # inputs may be given as (encoding, input) tuples
+        return inp[1] if type(inp) == tuple else inp
+
+    def input_kind(self, inp):
+        inp = self.unpack(inp)
+        if type(inp) == list:
+            return 'literal', '({} lines)'.format(len(inp))
+        elif type(inp) == str or PY2 and type(inp) == unicode:
+            if inp in ['-', '/dev/stdin']:
+                return self.stream_kind(sys.stdin), '<stdin>'
+            elif os.path.isfile(inp):
+                return 'file', inp
+            else:
+                return 'pipe', inp
+        else:
+            return self.stream_kind(inp), '<stream>'
+
+    @staticmethod
+    def stream_kind(stream):
+        try:
+            mode = os.fstat(stream.fileno()).st_mode
+        except (AttributeError, IOError, OSError, ValueError):
+            return 'stream'
+        return 'file' if stat.S_ISREG(mode) else 'pipe'
+
+    def plan(self):
+        usable = []
+        candidates = []
+        for name in PLAN_ORDER:
+            if self.requested not in ['auto', name] and name != EngineInterpreter.name:
+                reason = 'engine {} was requested'.format(self.requested)
+            elif self.governor is not None and name != EngineInterpreter.name:
+                reason = self.governed_reason
+            else:
+                # the interpreter is used, if the requested engine is rejected
+                reason = ENGINES[name].rejection(self)
+            if reason is None:
+                usable.append(name)
+            candidates.append((name, reason))
+        chosen = usable[0]
+        shadow, shadow_reason = self.plan_shadow()
+        exhaustion, exhaustion_reason = self.plan_exhaustion(shadow)
+        line_memo, line_memo_reason = self.plan_line_memo(shadow)
+        spill, spill_reason = self.plan_spill(shadow, chosen)
+        kernel = None
+        if chosen == EngineKernel.name:
+            kernel = EngineKernel.recognize(self.compiled, self.sed.no_autoprint)
+        sampled = []
+        if self.requested == 'auto' and len(usable) > 1 and not shadow and not line_memo \
+                and chosen not in UNSAMPLED:
+            sampled = usable
+        candidates = [(name, '{} is preferred'.format(chosen)
+                       if reason is None and name != chosen else reason)
+                      for (name, reason) in candidates]
+        return Plan(chosen, self.requested, sampled, shadow, shadow_reason,
+                    exhaustion, exhaustion_reason, line_memo, line_memo_reason, spill,
+                    spill_reason, kernel, self.governor, self.inputs,
+                    self.compiled.analysis, self.compiled.optimizations, candidates)
+
+    def plan_exhaustion(self, shadow):
+        # returns the exhaustion of the compiled script, if it can be used
+        exhaustion = self.compiled.exhaustion
+        if exhaustion is None:
+            return None, None
+        if self.sed.separate or self.sed.in_place is not None:
+            return None, 'line numbers restart with every input file'
+        if shadow:
+            return None, 'shadow mode needs the cycles to be run'
+        return exhaustion, None
+
+    def plan_line_memo(self, shadow):
+        # returns the size of the line memo, if one can be used
+        size = self.sed.line_memo
+        if not size:
+            return None, None
+        if type(size) != int or size < 0:
+            raise SedException('', 'Invalid line memo size {size}, '
+                                   'must be a positive number of lines.', size=size)
+        if not self.compiled.analysis.line_local:
+            return None, 'the output does not depend on the input line only'
+        if self.tracer is not None:
+            return None, 'tracing needs every cycle to be run'
+        if shadow:
+            return None, 'shadow mode needs the cycles to be run'
+        if self.sed.in_place is not None:
+            return None, 'in-place editing switches output files while reading'
+        return size, None
+
+    def plan_spill(self, shadow, chosen):
+        # returns the threshold for spilling to disk, if it can be done
+        threshold = self.sed.spill_threshold
+        if not threshold:
+            return None, None
+        if type(threshold) != int or threshold < 0:
+            raise SedException('', 'Invalid spill threshold {size}, '
+                                   'must be a positive number of characters.', size=threshold)
+        if chosen != EngineRope.name:
+            return None, 'only the rope engine spills to disk'
+        if shadow:
+            return None, 'shadow mode compares the hold space after every checked cycle'
+        return threshold, None
+
+    def plan_shadow(self):
+        # returns the interval of the checked cycles or the reason for not checking
+        if not self.sed.shadow:
+            return None, None
+        rate = self.sed.shadow_rate
+        if not 0 < rate <= 1:
+            raise SedException('', 'Invalid shadow sampling rate {rate}, '
+                                   'must be greater than 0 and at most 1.', rate=rate)
+        if self.tracer is not None:
+            return None, 'tracing runs the interpreter only'
+        if self.sed.in_place is not None:
+            return None, 'in-place editing switches output files while reading'
+        if self.compiled.analysis.has_side_files:
+            return None, 'the script reads or writes other files'
+        return max(1, int(round(1 / rate))), None
+
+
+class EngineAdaptive(object):
+    """ This engine runs the first cycles of the input with each of the given
+        engines in turn, measures the cycles per second each of them reaches and
+        continues with the fastest one. Since all engines keep the complete state
+        of the run in the ExecutionState, they can take over from each other
+        between any two cycles. The switches are recorded in the run statistics.
+    """
+    name = 'adaptive'
+    sample_cycles = 1000
+
+    def __init__(self, engines):
+        self.engines = engines
+
+    def run(self, state, cycles=-1):  # @UnusedVariable
+        statistics = state.statistics
+        best_engine, best_rate = None, None
+        for engine in self.engines:
+            if state.PS is None:
+                break
+            statistics.switch(engine.name, 'sampling')
+            start = default_timer()
+            done = engine.run(state, self.sample_cycles)
+            elapsed = default_timer() - start
+            statistics.cycles += done
+            rate = done / elapsed if elapsed > 0 else float('inf')
+            if best_rate is None or rate > best_rate:
+                best_engine, best_rate = engine, rate
+        if state.PS is not None:
+            statistics.switch(best_engine.name,
+                              'fastest with {:.0f} cycles/s'.format(best_rate))
+            statistics.cycles += best_engine.run(state)
+        return statistics.cycles
+
+
+class EngineLineMemo(object):
+    """ This engine remembers the output of the cycles run by another engine
+        for the most recently used input lines. It is only used for line-local
+        scripts, whose output depends on nothing but the input line, so a cycle
+        on a line seen before just prints the memoized output again. The
+        append buffer is flushed and the substitution flag is reset before the
+        next line is read, so there is nothing else to remember.
+    """
+    name = 'line memo'
+
+    def __init__(self, engine, size):
+        self.engine = engine
+        self.size = size
+
+    def run(self, state, cycles=-1):
+        budget = cycles
+        statistics = state.statistics
+        memo = collections.OrderedDict()
+        writer = state.writer
+        while state.PS is not None and cycles != 0:
+            line = state.PS
+            output = memo.pop(line, None)
+            if output is not None:
+                statistics.line_memo_hits += 1
+                for printed in output:
+                    writer.printline(printed)
+                state.PS = state.readline()
+            else:
+                statistics.line_memo_misses += 1
+                state.writer = ShadowWriter(writer)
+                try:
+                    self.engine.run(state, 1)
+                finally:
+                    output = state.writer.lines
+                    for printed in output:
+                        writer.printline(printed)
+                    state.writer = writer
+                if len(memo) >= self.size:
+                    memo.popitem(last=False)
+            # (re)inserting the line makes it the most recently used one
+            memo[line] = output
+            cycles -= 1
+        return budget - cycles
+
+
+class EngineShadow(object):
+    """ This engine runs every n-th cycle twice: first with the classic
+        interpreter on the script compiled without optimizations, which is the
+        reference, and then with the engine checked. Both start from the same
+        state and see the same input lines and the output of both is collected
+        and compared. The output of the checked engine is the one printed, while
+        the first difference found is reported on stderr and kept in the run
+        statistics. All other cycles are run by the checked engine only.
+    """
+    name = 'shadow'
+
+    def __init__(self, engine, reference, interval):
+        self.engine = engine
+        self.reference = reference
+        self.interval = interval
+
+    def run(self, state, cycles=-1):  # @UnusedVariable
+        done = 0
+        while state.PS is not None:
+            done += self.check_cycle(state)
+            if state.PS is not None and self.interval > 1:
+                done += self.engine.run(state, self.interval - 1)
+        return done
+
+    def check_cycle(self, state):
+        reader, writer = state.reader, state.writer
+        line_no = reader.line_number
+        snapshot = state.snapshot()
+        shadow_reader = ShadowReader(reader)
+        state.reader = shadow_reader
+        state.writer = ShadowWriter(writer)
+        tracer = state.tracer = ShadowTracer()
+        try:
+            self.reference.run(state, 1)
+            expected = self.outcome(state)
+        except SedException:
+            # the cycle fails, so it is run unchecked by the engine
+            # to fail in exactly the same way with the same output
+            expected = None
+        finally:
+            state.tracer = None
+        state.restore(snapshot)
+        shadow_reader.replay()
+        if expected is None:
+            state.writer = writer
+            return self.engine.run(state, 1)
+        state.writer = ShadowWriter(writer)
+        try:
+            done = self.engine.run(state, 1)
+        finally:
+            for line in state.writer.lines:
+                writer.printline(line)
+            actual = self.outcome(state)
+            state.writer = writer
+        if not shadow_reader.lines:
+            state.reader = reader
+        state.statistics.shadow_checks += 1
+        if actual != expected and state.statistics.divergence is None:
+            state.statistics.divergence = self.describe(line_no, tracer.position,
+                                                        expected, actual)
+            DEBUG('{msg}', msg=state.statistics.divergence.rstrip('\n'))
+        return done
+
+    @staticmethod
+    def outcome(state):
+        return (state.writer.lines, state.PS, state.HS, state.exit_code)
+
+    @staticmethod
+    def describe(line_no, position, expected, actual):
+        result = 'shadow: divergence in the cycle starting at input line {line}'.format(
+            line=line_no)
+        if position:
+            result += ' (last command run by the reference at {pos})'.format(pos=position)
+        result += ':\n'
+        quote = EngineShadow.quote
+        for (title, outcome) in [('reference', expected), ('engine', actual)]:
+            result += '  {title:9s} output [{out}], PS {ps}, HS {hs}, exit code {ec}\n'\
+                      .format(title=title, out=', '.join(quote(line) for line in outcome[0]),
+                              ps=quote(outcome[1]), hs=quote(outcome[2]), ec=outcome[3])
+        return result
+
+    @staticmethod
+    def quote(text):
+        # the string in quotes with the same escapes in Python 2 and 3, where
+        # repr would differ in the prefix u and the escaping of non-ASCII text
+        if text is None:
+            return 'None'
+        return "'{}'".format(text.encode('unicode_escape').decode('ascii').replace("'", "\\'"))
+
+
+class ShadowReader(object):
+    """ Stands in for the reader of a run while a cycle is checked in shadow
+        mode. While the reference runs, the lines read are recorded together
+        with their line number, file name and whether they are the last line,
+        so that the checked engine gets exactly the same lines afterwards. Once
+        they are used up, the lines are read from the original reader again.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.start = (reader.line_number, reader.source_file_name, self.reader_last_line())
+        self.line_number, self.source_file_name, self.last_line = self.start
+        self.recording = True
+        self.lines = []
+
+    def reader_last_line(self):
+        # only the buffered readers know, whether a line is the last one
+        if hasattr(self.reader, 'is_last_line'):
+            return self.reader.is_last_line()
+        return None
+
+    def replay(self):
+        self.recording = False
+        self.line_number, self.source_file_name, self.last_line = self.start
+
+    def readline(self):
+        if not self.recording and self.lines:
+            (line, self.line_number, self.source_file_name, self.last_line) = self.lines.pop(0)
+            return line
+        line = self.reader.readline()
+        self.line_number = self.reader.line_number
+        self.source_file_name = self.reader.source_file_name
+        if self.recording:
+            self.lines.append((line, self.line_number, self.source_file_name,
+                               self.reader_last_line()))
+        return line
+
+    def is_last_line(self):
+        # while recorded lines are left, the current line is one recorded
+        if not self.recording and self.lines:
+            return self.last_line
+        return self.reader.is_last_line()
+
+    def read_to_last_line(self):
+        lines = []
+        while not self.is_last_line():
+            lines.append(self.readline())
+            if lines[-1] is None:
+                break
+        return lines
+
+
+class ShadowWriter(object):
+    """ Collects the lines printed during a cycle checked in shadow mode
+        or memoized by an EngineLineMemo.
+    """
+
+    def __init__(self, writer):
+        self.current_encoding = writer.current_encoding
+        self.lines = []
+
+    def printline(self, line):
+        self.lines.append(line)
+
+    def write_to_file(self, filename, line):  # pragma: no cover (scripts with w are not checked)
+        raise SedException('', 'Writing to file {fle} is not supported in shadow mode.',
+                           fle=filename)
+
+
+class ShadowTracer(Tracer):
+    """ Remembers the last command the reference ran in a checked cycle. """
+
+    def __init__(self):
+        self.position = None
+
+    def command_executed(self, state, command):  # @UnusedVariable
+        self.position = command.position
+
+
+class CodeGenerator(object):
+    """ Translates the linked list of command instances of a compiled script into
+        the source code of a Python function run(state, constants, cycles). Every
+        command and address class contributes its own piece of code through its
+        generate method. Within the generated function the pattern space, the hold
+        space and the substitution flag are kept in the local variables PS, HS and
+        subst and the current line number is available as reader.line_number.
+
+        The commands are split into segments at every jump target. Each segment is
+        guarded by a check of the segment counter pc and a jump is done by setting pc
+        and continuing the dispatch loop. A block that does not contain any jump
+        target is translated into a nested if-statement, all others are translated
+        into a conditional jump behind the block.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.lines = []
+        self.level = 0
+        self.if_starts = []
+        self.constants = []
+        self.constant_names = {}
+        self.segments = {}
+        self.tracks_last_regexp = False
+        self.uses_last_line = False
+        self.range_states = {}
+        self.tmp_idx = 0
+
+    def emit(self, line):
+        self.lines.append('    ' * self.level + line)
+
+    def indent(self):
+        self.level += 1
+
+    def dedent(self):
+        self.level -= 1
+
+    def open_if(self, condition):
+        self.emit('if {}:'.format(condition))
+        self.indent()
+        self.if_starts.append(len(self.lines))
+
+    def close_if(self):
+        if self.if_starts.pop() == len(self.lines):
+            self.emit('pass')
+        self.dedent()
+
+    def constant(self, value, hint):
+        # bound methods are recreated on every attribute access,
+        # so we can not use their id() to detect duplicates
+        key = (id(getattr(value, '__self__', value)),
+               getattr(value, '__name__', None) if hasattr(value, '__self__') else None)
+        name = self.constant_names.get(key)
+        if name is None:
+            name = '{}_{}'.format(hint, len(self.constants))
+            self.constants.append((name, value))
+            self.constant_names[key] = name
+        return name
+
+    def temporary(self, hint):
+        self.tmp_idx += 1
+        return '{}_{}'.format(hint, self.tmp_idx)
+
+    def range_state(self, addr_range):
+        # the state object of an address range is bound to a local
+        # variable when the function starts
+        name = 'range_state_{}'.format(addr_range.index)
+        self.range_states[name] = addr_range.index
+        return name
+
+    def line_number(self):
+        return 'reader.line_number'
+
+    def last_line(self):
+        self.uses_last_line = True
+        return 'is_last_line()'
+
+    def search(self, regexp):
+        # as long as no empty regexp is part of the script, we do
+        # not need to keep track of the last regexp used and can
+        # call the search method of the compiled regexp directly
+        # regexps sharing their pattern with others use the match memo,
+        # regexps with a prefilter count its checks in the statistics
+        # and regexp addresses may be ruled out by the AddressScan
+        if self.tracks_last_regexp or isinstance(regexp, SedRegexpEmpty) \
+           or regexp.memoized or regexp.prefilter is not None or regexp.scan is not None:
+            return self.constant(regexp.matches, 'matches') + '(state, PS)'
+        return self.constant(regexp.search, 'search') + '(PS)'
+
+    def condition(self, addr_range):
+        return addr_range.generate(self)
+
+    def end_cycle(self, end=None):
+        if end is not None:
+            self.emit("end = '{}'".format(end))
+        self.emit('break')
+
+    def jump(self, target):
+        # target is the command to be executed next
+        if target is None:
+            self.end_cycle()
+        else:
+            self.emit('pc = {}'.format(self.segments[target]))
+            self.emit('continue')
+
+    def generate(self):
+        first = self.compiled.first_command
+        commands = []
+        command = first
+        while command:
+            commands.append(command)
+            command = command.branch if command.function == '{' else command.next
+        for command in commands:
+            if any(isinstance(regexp, SedRegexpEmpty) for regexp in command.regexps()):
+                self.tracks_last_regexp = True
+        # find all jump targets and all blocks that contain one
+        targets = set()
+        for command in commands:
+            if isinstance(command, Command_b) and command.branch:
+                targets.add(command.branch.next)
+        index = dict((id(command), idx) for (idx, command) in enumerate(commands))
+        self.block_ends = {}
+        self.flat_blocks = set()
+        for idx, command in enumerate(commands):
+            if command.function == '{':
+                end = (len(commands) if command.next is None
+                       else index[id(command.next)])
+                self.block_ends[id(command)] = end
+                if any(cmd in targets for cmd in commands[idx + 1:end]):
+                    self.flat_blocks.add(id(command))
+                    targets.add(command.next)
+        targets.discard(None)
+        for command in commands:
+            if command in targets or command is first:
+                self.segments[command] = len(self.segments)
+
+        self.level = 1
+        self.emit('while PS is not None:')
+        self.indent()
+        self.emit('end = None')
+        if len(self.segments) > 1:
+            self.emit('pc = 0')
+        self.emit('while True:')
+        self.indent()
+        self.generate_commands(commands, 0, len(commands))
+        self.emit('break')
+        self.dedent()
+        self.emit('if not (no_autoprint or PS is None or end == \'D\' or end == \'Q\'):')
+        self.emit('    printline(PS)')
+        self.emit('if append_buffer:')
+        self.emit('    for line in append_buffer:')
+        self.emit('        printline(line)')
+        self.emit('    del append_buffer[:]')
+        self.emit('cycles -= 1')
+        self.emit('if end is None:')
+        self.emit('    PS = readline()')
+        self.emit('    subst = False')
+        self.emit('elif end != \'D\':')
+        self.emit('    state.exit_code = exit_code')
+        self.emit('    PS = None')
+        self.emit('    break')
+        self.emit('if cycles == 0:')
+        self.emit('    break')
+        self.dedent()
+        self.emit('state.PS, state.HS, state.subst_successful = PS, HS, subst')
+        self.emit('return budget - cycles')
+        body = self.lines
+
+        self.lines = []
+        self.level = 0
+        self.emit('def run(state, constants, cycles):')
+        self.indent()
+        if self.constants:
+            self.emit('({}, ) = constants'.format(', '.join(name for (name, _) in self.constants)))
+        if self.range_states:
+            self.emit('ranges = state.ranges')
+            for (name, index) in sorted(self.range_states.items()):
+                self.emit('{} = ranges[{}]'.format(name, index))
+        self.emit('reader = state.reader')
+        self.emit('readline = reader.readline')
+        if self.uses_last_line:
+            self.emit('is_last_line = reader.is_last_line')
+        self.emit('printline = state.writer.printline')
+        self.emit('write_to_file = state.writer.write_to_file')
+        self.emit('normalize_string = state.normalize_string')
+        self.emit('append_buffer = state.append_buffer')
+        self.emit('no_autoprint = state.no_autoprint')
+        self.emit('sed_compatible = state.sed_compatible')
+        self.emit('line_length = state.line_length')
+        self.emit('PS, HS, subst = state.PS, state.HS, state.subst_successful')
+        self.emit('exit_code = 0')
+        self.emit('budget = cycles')
+        return '\n'.join(self.lines + body) + '\n', self.constants
+
+    def generate_commands(self, commands, start, stop):
+        idx = start
+        dispatch = start == 0 and len(self.segments) > 1
+        if dispatch:
+            self.open_if('pc == 0')
+        while idx < stop:
+            command = commands[idx]
+            segment = self.segments.get(command)
+            if segment and dispatch:
+                # we fall through into the next segment
+                self.emit('pc = {}'.format(segment))
+                self.close_if()
+                self.open_if('pc == {}'.format(segment))
+            if command.function == '{':
+                end = self.block_ends[id(command)]
+                condition = self.condition(command.addr_range)
+                if id(command) in self.flat_blocks:
+                    if condition is not None:
+                        self.open_if('not ({})'.format(condition))
+                        self.jump(command.next)
+                        self.close_if()
+                elif condition is None:
+                    self.generate_commands(commands, idx + 1, end)
+                else:
+                    self.open_if(condition)
+                    self.generate_commands(commands, idx + 1, end)
+                    self.close_if()
+                if id(command) not in self.flat_blocks:
+                    idx = end
+                    continue
+            else:
+                condition = self.condition(command.addr_range)
+                if condition is None:
+                    command.generate(self)
+                else:
+                    self.open_if(condition)
+                    command.generate(self)
+                    self.close_if()
+            idx += 1
+        if dispatch:
+            self.close_if()
+
+
+# The following classes implement the various sed commands. Each command
+# found in the script is translated into an instance of one of those classes
+# and the Sed.apply function that justs 'plays' down the list of these command
+# instances.
+
+
+class Command(object):
+
+    def __init__(self, script, addr_range, function):
+        self.position = script.position
+        self.num = script.command_index()
+        if (function in [':', '}'] and not isinstance(addr_range, AddressRangeNone)):
+            raise SedException(self.position,
+                               'No address can be specified for command {cmd}',
+                               cmd=function)
+        elif (function == 'q'
+              and not (isinstance(addr_range, AddressRangeFake)
+                       or isinstance(addr_range, AddressRangeNone))):
             raise SedException(
                 self.position,
                 'No address range can be specified for command {cmd}',
@@ -1902,22 +4595,27 @@ class Command(object):
                                'Extra characters after command {cmd}',
                                cmd=self.function)
 
-    def apply_func(self, sed):
-        if self.addr_range.is_active():
-            if sed.debug > 0:
-                DEBUG(' =============== executing '.ljust(sed.line_length, '='))
-                DEBUG('{cmd}', cmd=self.toString())
-                cmd = self.apply(sed)
-                sed.write_state('after')
-                return True, cmd
-            else:
-                return True, self.apply(sed)
-        elif sed.debug > 0:
-            DEBUG(' =============== skipping '.ljust(sed.line_length, '='))
-            DEBUG('{cmd}', cmd=self.toString())
-            sed.write_state('current')
+    def apply_func(self, state):
+        if self.addr_range.is_active(state):
+            return True, self.apply(state)
         return False, self.next
 
+    def regexps(self):
+        holders = [self, self.addr_range, getattr(self.addr_range, 'from_addr', None)]
+        return [holder.regexp for holder in holders
+                if getattr(holder, 'regexp', None) is not None]
+
+    def generate(self, gen):
+        # generic code for commands without a specialized code generator:
+        # the state is handed over to the apply method and taken back again
+        apply = gen.constant(self.apply, 'apply')
+        gen.emit('state.PS, state.HS, state.subst_successful = PS, HS, subst')
+        gen.emit('next_cmd = {}(state)'.format(apply))
+        gen.emit('PS, HS, subst = state.PS, state.HS, state.subst_successful')
+        gen.open_if('next_cmd is None')
+        gen.end_cycle()
+        gen.close_if()
+
 
 class Command_block(Command):
 
@@ -1925,11 +4623,14 @@ class Command_block(Command):
         super(Command_block, self).__init__(script, addr_range, function)
         script.register_block_start(self)
 
-    def apply(self, sed):  # @UnusedVariable
+    def apply(self, state):  # @UnusedVariable
         # self.next is the first instruction after block
         # self.branch is the first instruction within block
         return self.branch
 
+    def apply_batch(self, batch, indexes):  # @UnusedVariable
+        return [(self.branch, indexes)]
+
     def parse_arguments(self, script):
         _ = script.get_non_space_char_within_continued_lines()
         # do not check for command end, since it is implicit
@@ -1941,9 +4642,15 @@ class Command_block_end(Command):
         super(Command_block_end, self).__init__(script, addr_range, function)
         script.process_block_end(self)
 
-    def apply(self, sed):  # @UnusedVariable
+    def apply(self, state):  # @UnusedVariable
         return self.next
 
+    def apply_batch(self, batch, indexes):  # @UnusedVariable
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        pass
+
 
 class _Command_with_label(Command):
 
@@ -1969,19 +4676,33 @@ class Command_label(_Command_with_label):
             raise SedException(self.position, 'Missing label for command :')
         script.define_label(self)
 
-    def apply(self, sed):  # @UnusedVariable
+    def apply(self, state):  # @UnusedVariable
         return self.next
 
+    def apply_batch(self, batch, indexes):  # @UnusedVariable
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        pass
+
 
 class Command_a(Command):
 
     def parse_arguments(self, script):
         self.text = script.get_to_line_end()
 
-    def apply(self, sed):
-        sed.append_buffer.append(self.text)
+    def apply(self, state):
+        state.append_buffer.append(self.text)
         return self.next
 
+    def apply_batch(self, batch, indexes):
+        for idx in indexes:
+            batch.appended[idx].append(self.text)
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit('append_buffer.append({})'.format(gen.constant(self.text, 'text')))
+
     def str_arguments(self):  # pragma: no cover (only debug code)
         return ' ' + self.text
 
@@ -1993,88 +4714,152 @@ class Command_b(_Command_with_label):
         if self.label:
             script.reference_to_label(self)
 
-    def apply(self, sed):  # @UnusedVariable
+    def apply(self, state):  # @UnusedVariable
         # if label was omitted, self.branch is None and will finish the cycle
         if self.branch:
             return self.branch.next
         else:
             return None
 
+    def apply_batch(self, batch, indexes):  # @UnusedVariable
+        return [(self.branch.next if self.branch else None, indexes)]
+
+    def generate(self, gen):
+        gen.jump(self.branch.next if self.branch else None)
+
 
 class Command_c(Command_a):
 
-    def apply(self, sed):
-        if self.addr_range.first_line:
-            sed.printline('cmd c', self.text)
-        sed.PS = None
+    def apply(self, state):
+        if self.addr_range.is_first_line(state):
+            state.printline('cmd c', self.text)
+        state.PS = None
         return None
 
+    def apply_batch(self, batch, indexes):
+        first_line = self.addr_range.is_first_line(batch.state)
+        for idx in indexes:
+            if first_line:
+                batch.printed[idx].append(self.text)
+            batch.lines[idx] = None
+        return [(None, indexes)]
+
+    def generate(self, gen):
+        gen.open_if(self.addr_range.generate_first_line(gen))
+        gen.emit('printline({})'.format(gen.constant(self.text, 'text')))
+        gen.close_if()
+        gen.emit('PS = None')
+        gen.end_cycle()
+
 
 class Command_d(Command):
 
-    def apply(self, sed):
-        sed.PS = None
+    def apply(self, state):
+        state.PS = None
         return None
 
+    def apply_batch(self, batch, indexes):
+        for idx in indexes:
+            batch.lines[idx] = None
+        return [(None, indexes)]
+
+    def generate(self, gen):
+        gen.emit('PS = None')
+        gen.end_cycle()
+
 
 class Command_D(Command):
 
-    def apply(self, sed):
-        if '\n' in sed.PS:
-            sed.PS = sed.PS[sed.PS.index('\n') + 1:]
+    def apply(self, state):
+        if '\n' in state.PS:
+            state.PS = state.PS[state.PS.index('\n') + 1:]
         else:
-            sed.PS = sed.readline()
+            state.PS = state.readline()
         return None
 
+    def generate(self, gen):
+        gen.emit("if '\\n' in PS:")
+        gen.emit("    PS = PS[PS.index('\\n') + 1:]")
+        gen.emit('else:')
+        gen.emit('    PS = readline()')
+        gen.emit('    subst = False')
+        gen.end_cycle('D')
+
 
 class Command_equal(Command):
 
-    def apply(self, sed):
-        sed.printline('cmd =', str(sed.reader.line_number))
+    def apply(self, state):
+        state.printline('cmd =', str(state.reader.line_number))
         return self.next
 
+    def generate(self, gen):
+        gen.emit('printline(str({}))'.format(gen.line_number()))
+
 
 class Command_F(Command):
 
-    def apply(self, sed):
-        sed.printline('cmd F', sed.reader.source_file_name)
+    def apply(self, state):
+        state.printline('cmd F', state.reader.source_file_name)
         return self.next
 
+    def generate(self, gen):
+        gen.emit('printline(reader.source_file_name)')
+
 
 class Command_g(Command):
 
-    def apply(self, sed):
-        sed.PS = sed.HS
+    def apply(self, state):
+        state.PS = state.HS
         return self.next
 
+    def generate(self, gen):
+        gen.emit("PS = HS")
+
 
 class Command_G(Command):
 
-    def apply(self, sed):
-        sed.PS += '\n' + sed.HS
+    def apply(self, state):
+        state.PS += '\n' + state.HS
         return self.next
 
+    def generate(self, gen):
+        gen.emit("PS += '\\n' + HS")
+
 
 class Command_h(Command):
 
-    def apply(self, sed):
-        sed.HS = sed.PS
+    def apply(self, state):
+        state.HS = state.PS
         return self.next
 
+    def generate(self, gen):
+        gen.emit("HS = PS")
+
 
 class Command_H(Command):
 
-    def apply(self, sed):
-        sed.HS += '\n' + sed.PS
+    def apply(self, state):
+        state.HS += '\n' + state.PS
         return self.next
 
+    def generate(self, gen):
+        gen.emit("HS += '\\n' + PS")
+
 
 class Command_i(Command_a):
 
-    def apply(self, sed):
-        sed.printline('cmd i', self.text)
+    def apply(self, state):
+        state.printline('cmd i', self.text)
         return self.next
 
+    def apply_batch(self, batch, indexes):
+        for idx in indexes:
+            batch.printed[idx].append(self.text)
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit('printline({})'.format(gen.constant(self.text, 'text')))
+
 
 class Command_l(Command):
 
@@ -2089,59 +4874,149 @@ class Command_l(Command):
                 script.position,
                 'Only an integer number can follow command l as parameter')
 
-    def apply(self, sed):
+    def apply(self, state):
         if self.line_length:
             line_length = self.line_length
         else:
-            line_length = sed.line_length
-        for lne in sed.normalize_string(sed.PS, line_length):
-            sed.printline('cmd l', lne)
+            line_length = state.line_length
+        for lne in state.normalize_string(state.PS, line_length):
+            state.printline('cmd l', lne)
         return self.next
 
+    def apply_batch(self, batch, indexes):
+        line_length = self.line_length or batch.state.line_length
+        for idx in indexes:
+            batch.printed[idx].extend(
+                batch.state.normalize_string(batch.lines[idx], line_length))
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit('for lne in normalize_string(PS, {}):'.format(
+            self.line_length if self.line_length else 'line_length'))
+        gen.emit('    printline(lne)')
+
     def str_arguments(self):  # pragma: no cover (only debug code)
         return ' ' + str(self.line_length) if self.line_length else ''
 
 
 class Command_n(Command):
 
-    def apply(self, sed):
-        if not sed.no_autoprint:
-            sed.printline('cmd n', sed.PS)
-        sed.PS = sed.readline()
-        if sed.PS is None:
+    def apply(self, state):
+        if not state.no_autoprint:
+            state.printline('cmd n', state.PS)
+        state.PS = state.readline()
+        if state.PS is None:
             return None
         else:
             return self.next
 
+    def generate(self, gen):
+        gen.emit('if not no_autoprint:')
+        gen.emit('    printline(PS)')
+        gen.emit('PS = readline()')
+        gen.emit('subst = False')
+        gen.open_if('PS is None')
+        gen.end_cycle()
+        gen.close_if()
+
 
 class Command_N(Command):
 
-    def apply(self, sed):
-        newline = sed.readline()
+    def apply(self, state):
+        newline = state.readline()
         if newline is None:
             return None
         else:
-            sed.PS = sed.PS + '\n' + newline
+            state.PS = state.PS + '\n' + newline
+            return self.next
+
+    def generate(self, gen):
+        gen.emit('newline = readline()')
+        gen.emit('subst = False')
+        gen.open_if('newline is None')
+        gen.end_cycle()
+        gen.close_if()
+        gen.emit("PS = PS + '\\n' + newline")
+
+
+class Command_slurp(Command_N):
+    """ Stands in for a loop appending all lines up to the last one to the
+        pattern space with N. It is created by the Optimizer instead of being
+        parsed. Rather than running a cycle of the loop for every line, which
+        copies the ever growing pattern space each time, the lines are read at
+        once and joined. If the N of the loop is not restricted to lines other
+        than the last one, it is run at least once, which ends the cycle if there
+        is no next line.
+    """
+
+    def __init__(self, command, checks_last_line):
+        self.position = command.position
+        self.num = command.num
+        self.function = command.function
+        self.addr_range = AddressRangeNone()
+        self.checks_last_line = checks_last_line
+        self.next = None
+        self.branch = None
+
+    def apply(self, state):
+        if not self.checks_last_line:
+            # the N of the loop is run at least once, even on the
+            # last line (of a file, if the inputs are separate)
+            newline = state.readline()
+            if newline is None:
+                return None
+            state.PS = state.PS + '\n' + newline
+        if state.is_last_line():
             return self.next
+        state.subst_successful = False
+        lines = state.reader.read_to_last_line()
+        if lines and lines[-1] is None:
+            # the input ended before the last line was found
+            state.PS = '\n'.join([state.PS] + lines[:-1])
+            return None
+        state.PS = '\n'.join([state.PS] + lines)
+        return self.next
+
+    # the code generated for N would run the loop line by line again
+    generate = Command.generate
+
+    def str_arguments(self):  # pragma: no cover (only debug code)
+        return ' (to last line)'
 
 
 class Command_p(Command):
 
-    def apply(self, sed):
-        sed.printline('cmd p', sed.PS)
+    def apply(self, state):
+        state.printline('cmd p', state.PS)
         return self.next
 
+    def apply_batch(self, batch, indexes):
+        for idx in indexes:
+            batch.printed[idx].append(batch.lines[idx])
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit('printline(PS)')
+
 
 class Command_P(Command):
 
-    def apply(self, sed):
-        n = sed.PS.find('\n')
+    def apply(self, state):
+        n = state.PS.find('\n')
         if n < 0:
-            sed.printline('cmd P', sed.PS)
+            state.printline('cmd P', state.PS)
         else:
-            sed.printline('cmd P', sed.PS[:n])
+            state.printline('cmd P', state.PS[:n])
         return self.next
 
+    def apply_batch(self, batch, indexes):
+        for idx in indexes:
+            batch.printed[idx].append(batch.lines[idx].split('\n', 1)[0])
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit("printline(PS.split('\\n', 1)[0])")
+
 
 class Command_q(Command):
 
@@ -2157,18 +5032,22 @@ class Command_q(Command):
                 'Only an integer number can follow command {cmd} as parameter'
                 .format(self.function))
 
-    def apply(self, sed):  # @UnusedVariable
-        # handled in sed.apply
+    def apply(self, state):  # @UnusedVariable
+        # handled in state.apply
         return None
 
+    def generate(self, gen):
+        gen.emit('exit_code = {}'.format(self.exit_code or 0))
+        gen.end_cycle(self.function)
+
     def str_arguments(self):  # pragma: no cover (only debug code)
         return ' ' + str(self.exit_code) if self.exit_code else ''
 
 
 class Command_Q(Command_q):
 
-    def apply(self, sed):  # @UnusedVariable
-        # handled in sed.apply
+    def apply(self, state):  # @UnusedVariable
+        # handled in state.apply
         return None
 
 
@@ -2182,12 +5061,12 @@ class Command_r(Command):
                                cmd=self.function)
         self.filename = self.filename
 
-    def apply(self, sed):
+    def apply(self, state):
         # https://groups.yahoo.com/neo/groups/sed-users/conversations/topics/9096
         try:
-            with open(self.filename, 'rt', encoding=sed.encoding) as f:
+            with open(self.filename, 'rt', encoding=state.encoding) as f:
                 for line in f:
-                    sed.append_buffer.append(
+                    state.append_buffer.append(
                         line[:-1] if line.endswith('\n') else line)
         except IOError:
             # if filename cannot be read, it is treated as if it were an empty
@@ -2195,16 +5074,20 @@ class Command_r(Command):
             pass
         return self.next
 
+    def generate(self, gen):
+        # reading the file only touches the append buffer
+        gen.emit('{}(state)'.format(gen.constant(self.apply, 'apply')))
+
     def str_arguments(self):  # pragma: no cover (only debug code)
         return ' ' + self.filename
 
 
 class Command_R(Command_r):
 
-    def apply(self, sed):
-        line = sed.reader.readline_from_file(self.filename)
+    def apply(self, state):
+        line = state.reader.readline_from_file(self.filename)
         if line:
-            sed.append_buffer.append(
+            state.append_buffer.append(
                 line[:-1] if line.endswith('\n') else line)
         return self.next
 
@@ -2246,15 +5129,8 @@ class Command_s(Command):
                     raise SedException(
                         script.position,
                         'Missing file name for command s option w')
-                try:
-                    script.sed.writer.add_write_file(self.filename)
-                except IOError as e:
-                    raise SedException(
-                        script.position,
-                        'Unable to open file {file} for output from ' +
-                        'command s with option w: {err}',
-                        file=self.filename,
-                        err=make_unicode(str(e), script.sed.encoding))
+                self.filename_position = script.position
+                script.register_write_file(self)
             elif char == 'p':
                 if self.printit:
                     raise SedException(
@@ -2319,26 +5195,63 @@ class Command_s(Command):
             repl=self.repl.string,
             flags=flags)
 
-    def apply(self, sed):
+    def apply(self, state):
         # pattern, repl, count, printit, inplace, write, filename = self.args
         # managing ampersand is done when converting to python format
-        success, sed.PS = self.regexp.subn(
-            self.repl, sed.PS, self.globally, self.count, sed.sed_compatible)
-        sed.subst_successful = sed.subst_successful or success
+        success, state.PS = self.regexp.subn(
+            state, self.repl, state.PS, self.globally, self.count)
+        state.subst_successful = state.subst_successful or success
         if success:
             if self.printit:
-                sed.printline('cmd s', sed.PS)
+                state.printline('cmd s', state.PS)
             if self.filename:
-                sed.writer.write_to_file(self.filename, sed.PS)
+                state.writer.write_to_file(self.filename, state.PS)
         return self.next
 
+    def apply_batch(self, batch, indexes):
+        # scripts with a w flag are not line-local, so they are never run in batches
+        lines, subst, state = batch.lines, batch.subst, batch.state
+        for idx in indexes:
+            success, lines[idx] = self.regexp.subn(
+                state, self.repl, lines[idx], self.globally, self.count)
+            if success:
+                subst[idx] = True
+                if self.printit:
+                    batch.printed[idx].append(lines[idx])
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit('success, PS = {}(state, {}, PS, {}, {})'.format(
+            gen.constant(self.regexp.subn, 'subn'),
+            gen.constant(self.repl, 'repl'),
+            self.globally,
+            self.count))
+        gen.open_if('success')
+        gen.emit('subst = True')
+        if self.printit:
+            gen.emit('printline(PS)')
+        if self.filename:
+            gen.emit('write_to_file({}, PS)'.format(gen.constant(self.filename, 'filename')))
+        gen.close_if()
+
+    def open_write_file(self, writer, encoding):
+        try:
+            writer.add_write_file(self.filename)
+        except IOError as e:
+            raise SedException(
+                self.filename_position,
+                'Unable to open file {file} for output from ' +
+                'command s with option w: {err}',
+                file=self.filename,
+                err=make_unicode(str(e), encoding))
+
 
 class Command_t(Command_b):
 
-    def apply(self, sed):
+    def apply(self, state):
         # if label was omitted, self.branch is None and will end the cycle
-        if sed.subst_successful:
-            sed.subst_successful = False
+        if state.subst_successful:
+            state.subst_successful = False
             if self.branch:
                 return self.branch.next
             else:
@@ -2346,25 +5259,70 @@ class Command_t(Command_b):
         else:
             return self.next
 
+    def apply_batch(self, batch, indexes):
+        subst = batch.subst
+        taken, not_taken = [], []
+        for idx in indexes:
+            if subst[idx]:
+                subst[idx] = False
+                taken.append(idx)
+            else:
+                not_taken.append(idx)
+        return [(self.branch.next if self.branch else None, taken),
+                (self.next, not_taken)]
+
+    def generate(self, gen):
+        gen.open_if('subst')
+        gen.emit('subst = False')
+        gen.jump(self.branch.next if self.branch else None)
+        gen.close_if()
+
 
 class Command_T(Command_b):
 
-    def apply(self, sed):
+    def apply(self, state):
         # if label was omitted, self.branch is None and will end the cycle
-        if sed.subst_successful:
-            sed.subst_successful = False
+        if state.subst_successful:
+            state.subst_successful = False
             return self.next
         elif self.branch:
             return self.branch.next
         else:
             return None
 
+    def apply_batch(self, batch, indexes):
+        subst = batch.subst
+        taken, not_taken = [], []
+        for idx in indexes:
+            if subst[idx]:
+                subst[idx] = False
+                not_taken.append(idx)
+            else:
+                taken.append(idx)
+        return [(self.branch.next if self.branch else None, taken),
+                (self.next, not_taken)]
+
+    def generate(self, gen):
+        gen.open_if('subst')
+        gen.emit('subst = False')
+        gen.close_if()
+        gen.emit('else:')
+        gen.indent()
+        gen.jump(self.branch.next if self.branch else None)
+        gen.dedent()
+
 
 class Command_v(Command):
 
-    def apply(self, sed):  # @UnusedVariable
+    def apply(self, state):  # @UnusedVariable
         return self.next
 
+    def apply_batch(self, batch, indexes):  # @UnusedVariable
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        pass
+
     def parse_arguments(self, script):
         _, self.version = script.get_name(
             'version', alpha_only=False, skip_space=True)
@@ -2395,36 +5353,49 @@ class Command_v(Command):
 
 class Command_w(Command_r):
 
-    def apply(self, sed):
-        sed.writer.write_to_file(self.filename, sed.PS)
+    def apply(self, state):
+        state.writer.write_to_file(self.filename, state.PS)
         return self.next
 
+    def generate(self, gen):
+        gen.emit('write_to_file({}, PS)'.format(gen.constant(self.filename, 'filename')))
+
     def parse_arguments(self, script):
         super(Command_w, self).parse_arguments(script)
+        script.register_write_file(self)
+
+    def open_write_file(self, writer, encoding):
         try:
-            script.sed.writer.add_write_file(self.filename)
+            writer.add_write_file(self.filename)
         except IOError as e:
             raise SedException(
                 self.position,
                 'Unable to open file {f} for output for command {c}: {e}',
                 f=self.filename,
                 c=self.function,
-                e=make_unicode(str(e), script.sed.encoding))
+                e=make_unicode(str(e), encoding))
 
 
 class Command_W(Command_w):
 
-    def apply(self, sed):
-        sed.writer.write_to_file(self.filename, sed.PS.split('\n', 1)[0])
+    def apply(self, state):
+        state.writer.write_to_file(self.filename, state.PS.split('\n', 1)[0])
         return self.next
 
+    def generate(self, gen):
+        gen.emit("write_to_file({}, PS.split('\\n', 1)[0])".format(
+            gen.constant(self.filename, 'filename')))
+
 
 class Command_x(Command):
 
-    def apply(self, sed):
-        sed.PS, sed.HS = sed.HS, sed.PS
+    def apply(self, state):
+        state.PS, state.HS = state.HS, state.PS
         return self.next
 
+    def generate(self, gen):
+        gen.emit('PS, HS = HS, PS')
+
 
 class Command_y(Command):
 
@@ -2472,17 +5443,78 @@ class Command_y(Command):
                    left=self.left_strg,
                    right=self.right_strg)
 
-    def apply(self, sed):
-        sed.PS = sed.PS.translate(self.translate_table)
+    def apply(self, state):
+        state.PS = state.PS.translate(self.translate_table)
+        return self.next
+
+    def apply_batch(self, batch, indexes):
+        lines, table = batch.lines, self.translate_table
+        for idx in indexes:
+            lines[idx] = lines[idx].translate(table)
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit('PS = PS.translate({})'.format(gen.constant(self.translate_table, 'table')))
+
+
+class Command_callback(Command):
+    """ Calls the Python function registered in Sed.callbacks under the name
+        following the command character @, like in /^[0-9]/@double. The function
+        is called with the pattern space and the hold space and returns either
+        the new pattern space or a tuple of the new pattern space and the new
+        hold space.
+    """
+
+    def parse_arguments(self, script):
+        _, self.name = script.get_name('command', alpha_only=False, skip_space=True)
+        if not self.name:
+            raise SedException(self.position, 'Missing name for command @')
+        if not script.script_line.is_end_of_cmd():
+            raise SedException(self.position,
+                               'Command @ can not have any arguments after the name')
+        self.callback = script.sed.callbacks.get(self.name)
+        if self.callback is None:
+            raise SedException(self.position, 'Unknown callback command {name}',
+                               name=self.name)
+
+    def apply(self, state):
+        try:
+            result = self.callback(state.PS, state.HS)
+        except SedException:
+            raise
+        except Exception as e:
+            raise SedException(self.position, 'Callback command {name} failed: {err}',
+                               name=self.name, err=e)
+        if type(result) == tuple and len(result) == 2:
+            PS, HS = result
+        else:
+            PS, HS = result, state.HS
+        for text in (PS, HS):
+            if not (type(text) == str or PY2 and type(text) == unicode):
+                raise SedException(self.position,
+                                   'Callback command {name} must return strings, not {type}',
+                                   name=self.name, type=type(text).__name__)
+        state.PS, state.HS = PS, HS
         return self.next
 
+    def str_arguments(self):  # pragma: no cover (only debug code)
+        return ' ' + self.name
+
 
 class Command_z(Command):
 
-    def apply(self, sed):
-        sed.PS = ''
+    def apply(self, state):
+        state.PS = ''
         return self.next
 
+    def apply_batch(self, batch, indexes):
+        for idx in indexes:
+            batch.lines[idx] = ''
+        return [(self.next, indexes)]
+
+    def generate(self, gen):
+        gen.emit("PS = ''")
+
 
 COMMANDS = {'{': Command_block,
             '}': Command_block_end,
@@ -2516,7 +5548,8 @@ COMMANDS = {'{': Command_block,
             'W': Command_W,
             'x': Command_x,
             'y': Command_y,
-            'z': Command_z}
+            'z': Command_z,
+            '@': Command_callback}
 
 
 class Replacement(object):
@@ -2551,6 +5584,8 @@ class Replacement(object):
     def __init__(self):
         self.string = ''
         self.cases = [CaseSetter(self.CASE_ASIS, self.CASE_FLIP_NONE)]
+        # the result of constant once known, False before
+        self.constant_string = False
 
     def __str__(self):  # pragma: no cover (only for debugging)
         return self.string
@@ -2591,6 +5626,18 @@ class Replacement(object):
             result += case.expand(match)
         return result
 
+    def constant(self):
+        # returns the replacement string, if it does not depend on the match, or None
+        if self.constant_string is False:
+            case = self.cases[0]
+            if len(self.cases) != 1 or case.case_set != self.CASE_ASIS \
+               or case.case_flip != self.CASE_FLIP_NONE \
+               or any(type(part) == int for part in case.parts):
+                self.constant_string = None
+            else:
+                self.constant_string = ''.join(case.parts)
+        return self.constant_string
+
 
 class CaseSetter(object):
 
@@ -2652,6 +5699,72 @@ class CaseSetter(object):
 # substitution of those used in the s command.
 
 
+class RegexpCache(object):
+    """ A cache shared by all Sed instances of the process, holding the Python
+        patterns the regexps of scripts were translated to and the compiled
+        patterns. Loading the same script again, for example one rule file used
+        by many short-lived Sed instances, then neither translates nor compiles
+        its regexps again. Translations are keyed by the text of the regexp,
+        delimiter, encoding and the options regexp_extended and sed_compatible,
+        so the same regexp in different lines or scripts shares one entry, and
+        compiled patterns by the Python pattern including its flags. Once size
+        entries are held, the least recently used one is evicted. A size of 0
+        switches the cache off.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return 'regexp cache: {len} of {size} entries, {hits} hits, {misses} misses, ' \
+               '{evictions} evictions'.format(len=len(self), size=self.size, hits=self.hits,
+                                              misses=self.misses, evictions=self.evictions)
+
+    def get(self, key):
+        # returns the value cached for key or None
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if self.size <= 0:
+                return
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def compile(self, py_pattern):
+        key = ('compiled', py_pattern)
+        compiled = self.get(key)
+        if compiled is None:
+            compiled = re.compile(py_pattern)
+            self.put(key, compiled)
+        return compiled
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+REGEXP_CACHE = RegexpCache()
+
+
 class SedRegexpEmpty(object):
 
     def __init__(self, position, delim, address=True):
@@ -2660,18 +5773,18 @@ class SedRegexpEmpty(object):
         self.pattern = ''
         self.address = address
 
-    def matches(self, strg):
-        if SedRegexp.last_regexp is None:
+    def matches(self, state, strg):
+        if state.last_regexp is None:
             raise SedException(self.position,
                                'No regexp to match in place of empty regexp')
-        return SedRegexp.last_regexp.matches(strg)
+        return state.last_regexp.matches(state, strg)
 
-    def subn(self, replacement, strng, globally, count, sed_compatible):
-        if SedRegexp.last_regexp is None:
+    def subn(self, state, replacement, strng, globally, count):
+        if state.last_regexp is None:
             raise SedException(self.position,
                                'No regexp to match in place of empty regexp')
-        return SedRegexp.last_regexp.subn(
-            replacement, strng, globally, count, sed_compatible)
+        return state.last_regexp.subn(
+            state, replacement, strng, globally, count)
 
     def __str__(self):  # pragma: no cover (only for debugging)
         return self.toString()
@@ -2698,7 +5811,6 @@ class SedRegexpEmpty(object):
 
 
 class SedRegexp(object):
-    last_regexp = None
 
     def __init__(self, position, delim, pattern,
                  py_pattern, dollars, address=True):
@@ -2712,6 +5824,17 @@ class SedRegexp(object):
         self.ignore_case = False
         self.flags = ''
         self.compiled = None
+        # a LiteralPattern standing in for compiled, if the pattern is a literal
+        self.literal = None
+        # the search method of literal or compiled
+        self.search = None
+        # the RequiredLiterals checked before searching with compiled or None
+        self.prefilter = None
+        # the AddressScan searching for this and the other regexp addresses at once
+        self.scan = None
+        self.scan_literals = None
+        # set by Script.share_regexps if the pattern is used more than once
+        self.memoized = False
 
     def __str__(self):  # pragma: no cover (only for debugging)
         return self.toString()
@@ -2760,7 +5883,7 @@ class SedRegexp(object):
                 self.py_pattern = (self.py_pattern[0:dollar] + '\\Z'
                                    + self.py_pattern[dollar + 1:])
         try:
-            self.compiled = re.compile(self.flags + self.py_pattern)
+            self.compiled = REGEXP_CACHE.compile(self.flags + self.py_pattern)
         except re.error as e:
             raise SedException(
                 self.position,
@@ -2771,12 +5894,35 @@ class SedRegexp(object):
                 pattern=self.pattern,
                 py_pattern=self.flags + self.py_pattern,
                 err=str(e))
-
-    def matches(self, strng):
-        SedRegexp.last_regexp = self
+        self.literal = LiteralPattern.parse(self.py_pattern, self.multi_line,
+                                            self.ignore_case, self.compiled)
+        self.search = (self.compiled if self.literal is None else self.literal).search
+        if self.literal is None:
+            self.prefilter = RequiredLiterals.extract(self.py_pattern, self.ignore_case)
+
+    def matches(self, state, strng):
+        state.last_regexp = self
+        if self.scan is not None:
+            if state.scanned is not strng:
+                self.scan.run(state, strng)
+            if not self.scan_literals <= state.scan_found:
+                return False
+        if self.memoized:
+            # the pattern space is a string and every command changing
+            # it assigns a new one, so the identity of the string tells
+            # whether the memoized result is still valid
+            memo = state.match_memo.get(self.compiled)
+            if memo is not None and memo[0] is strng:
+                state.statistics.memo_hits += 1
+                return memo[1]
         try:
-            match = self.compiled.search(strng)
-            return match is not None
+            if self.prefilter is not None and not self.prefilter.check(state, strng):
+                match = False
+            else:
+                match = bool(self.search(strng))
+            if self.memoized:
+                state.match_memo[self.compiled] = (strng, match)
+            return match
         except Exception as e:
             raise SedException(
                 self.position,
@@ -2788,48 +5934,27 @@ class SedRegexp(object):
                 py_pattern=self.flags + self.py_pattern,
                 err=str(e))
 
-    def subn(self, replacement, strng, globally, count, sed_compatible):
+    def subn(self, state, replacement, strng, globally, count):
         # re.sub() extended:
         # - an unmatched group returns an empty string rather than None
         #   (http://gromgull.net/blog/2012/10/python-regex-unicode-and-brokenness/)
         # - the nth occurrence is replaced rather than the nth first ones
         #   (https://mail.python.org/pipermail/python-list/2008-December/475132.html)
-        SedRegexp.last_regexp = self
-
-        class Nth(object):
-
-            def __init__(self):
-                self.matches = 0
-                self.prevmatch_end = -1
-
-            def __call__(self, matchobj):
-                try:
-                    # check for 'empty match' that should not been replaced
-                    if sed_compatible \
-                       and matchobj.group(0) == '' \
-                       and matchobj.start(0) == self.prevmatch_end:
-                        # with sed compatablilty this is not really a match
-                        # thus we do not insert the replacement string.
-                        return ''
-                    else:
-                        self.matches += 1
-                        if self.matches == count \
-                           or globally and self.matches > count:
-                            # if this is a match we want to replace, calculate the
-                            # replacement string for the current match and return it
-                            return replacement.expand(matchobj)
-                        else:
-                            # otherwise just return what was matched instead,
-                            # without any changes
-                            return matchobj.group(0)
-                finally:
-                    # remember this match's end position for our
-                    # 'empty match'-check the next time around.
-                    self.prevmatch_end = matchobj.end(0)
-
+        state.last_regexp = self
+        if self.memoized:
+            memo = state.match_memo.get(self.compiled)
+            if memo is not None and memo[0] is strng and not memo[1]:
+                state.statistics.memo_hits += 1
+                return False, strng
+        sed_compatible = state.sed_compatible
+        if self.literal is not None and self.literal.applies(strng):
+            return self.literal.subn(replacement, strng, globally, count, sed_compatible)
+        if self.prefilter is not None and not self.prefilter.check(state, strng):
+            return False, strng
         try:
             strng_res, nsubst = self.compiled.subn(
-                Nth(), strng, 0 if globally or sed_compatible else count)
+                NthMatch(replacement, globally, count, sed_compatible),
+                strng, 0 if globally or sed_compatible else count)
         except re.error as e:
             raise SedException(
                 self.position,
@@ -2845,6 +5970,461 @@ class SedRegexp(object):
         return (nsubst >= count), strng_res
 
 
+class NthMatch(object):
+    """ The function called by re.subn() for every match of the regexp of an s
+        command: it returns the replacement for the matches to be replaced and
+        the match itself for all others. It is a class of its own rather than
+        being defined within SedRegexp.subn(), since creating a class on every
+        call of the s command costs more than the substitution itself.
+    """
+
+    def __init__(self, replacement, globally, count, sed_compatible):
+        self.replacement = replacement
+        self.globally = globally
+        self.count = count
+        self.sed_compatible = sed_compatible
+        self.matches = 0
+        self.prevmatch_end = -1
+
+    def __call__(self, matchobj):
+        try:
+            # check for 'empty match' that should not been replaced
+            if self.sed_compatible \
+               and matchobj.group(0) == '' \
+               and matchobj.start(0) == self.prevmatch_end:
+                # with sed compatablilty this is not really a match
+                # thus we do not insert the replacement string.
+                return ''
+            else:
+                self.matches += 1
+                if self.matches == self.count \
+                   or self.globally and self.matches > self.count:
+                    # if this is a match we want to replace, calculate the
+                    # replacement string for the current match and return it
+                    return self.replacement.expand(matchobj)
+                else:
+                    # otherwise just return what was matched instead,
+                    # without any changes
+                    return matchobj.group(0)
+        finally:
+            # remember this match's end position for our
+            # 'empty match'-check the next time around.
+            self.prevmatch_end = matchobj.end(0)
+
+
+class LiteralPattern(object):
+    """ Stands in for the compiled pattern of a regexp without any special
+        characters apart from a ^ at its start and a $ at its end (translated
+        to \\Z), like /ERROR/, /^prefix/ or s/foo/bar/g. It searches and
+        substitutes with the methods of str instead of module re and finds
+        the same matches. With flag I both the literal and the searched string
+        are compared in lower case, which is only done for ASCII, since other
+        characters may match ignoring case without being equal in lower case.
+        Strings it can not handle are left to the compiled pattern.
+    """
+
+    ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a'}
+
+    def __init__(self, text, at_start, at_end, ignore_case, compiled):
+        self.text = text = text.lower() if ignore_case else text
+        self.at_start = at_start
+        self.at_end = at_end
+        self.ignore_case = ignore_case
+        self.compiled = compiled
+        # the test of a string as fast as possible
+        if at_start and at_end:
+            self.test = text.__eq__
+        elif at_start:
+            self.test = lambda strng: strng.startswith(text)
+        elif at_end:
+            self.test = lambda strng: strng.endswith(text)
+        else:
+            self.test = lambda strng: text in strng
+        if not ignore_case:
+            self.search = self.test
+
+    @staticmethod
+    def parse(py_pattern, multi_line, ignore_case, compiled):
+        # returns the LiteralPattern for the translated pattern or None,
+        # if it is no literal
+        text = []
+        at_start = at_end = False
+        pos = 0
+        end = len(py_pattern)
+        if py_pattern.startswith('^') and not multi_line:
+            at_start = True
+            pos = 1
+        while pos < end:
+            char = py_pattern[pos]
+            if char == '\\':
+                char = py_pattern[pos + 1:pos + 2]
+                if char == 'Z' and pos + 2 == end:
+                    at_end = True
+                elif char in LiteralPattern.ESCAPES:
+                    text.append(LiteralPattern.ESCAPES[char])
+                elif char == '' or char.isalnum() or char == '_':
+                    # classes, back references, anchors and other escapes
+                    return None
+                else:
+                    text.append(char)
+                pos += 2
+            elif char in '.^$*+?{}[]()|':
+                return None
+            else:
+                text.append(char)
+                pos += 1
+        text = ''.join(text)
+        if not text and not (at_start and at_end):
+            return None
+        if ignore_case and not (STR_ISASCII and STR_ISASCII(text)):
+            return None
+        return LiteralPattern(text, at_start, at_end, ignore_case, compiled)
+
+    def applies(self, strng):
+        return not self.ignore_case or STR_ISASCII(strng)
+
+    def search(self, strng):
+        # replaced by test in __init__ unless ignoring case
+        if not STR_ISASCII(strng):
+            return self.compiled.search(strng)
+        return self.test(strng.lower())
+
+    def occurrences(self, strng):
+        # returns the start positions of the non-overlapping occurrences
+        # from left to right, which are the matches of the pattern
+        text = self.text
+        if self.at_start:
+            found = strng == text if self.at_end else strng.startswith(text)
+            return [0] if found else []
+        elif self.at_end:
+            return [len(strng) - len(text)] if strng.endswith(text) else []
+        starts = []
+        pos = strng.find(text)
+        while pos >= 0:
+            starts.append(pos)
+            pos = strng.find(text, pos + len(text))
+        return starts
+
+    def subn(self, replacement, strng, globally, count, sed_compatible):
+        # does the same as SedRegexp.subn with the compiled pattern
+        text = self.text
+        constant = replacement.constant()
+        if constant is not None and not (self.ignore_case or self.at_start or self.at_end):
+            # the most common cases like s/literal/string/ and s/literal/string/g
+            pos = strng.find(text)
+            while pos >= 0 and count > 1:
+                pos = strng.find(text, pos + len(text))
+                count -= 1
+            if pos < 0:
+                return False, strng
+            if globally:
+                return True, strng[:pos] + strng[pos:].replace(text, constant)
+            return True, strng[:pos] + constant + strng[pos + len(text):]
+        starts = self.occurrences(strng.lower() if self.ignore_case else strng)
+        if not (globally or sed_compatible):
+            starts = starts[:count]
+        if len(starts) < count:
+            return False, strng
+        parts = []
+        last = 0
+        if constant is not None:
+            for start in starts[count - 1:] if globally else [starts[count - 1]]:
+                parts.append(strng[last:start])
+                parts.append(constant)
+                last = start + len(text)
+        else:
+            nth_match = NthMatch(replacement, globally, count, sed_compatible)
+            for start in starts:
+                parts.append(strng[last:start])
+                last = start + len(text)
+                parts.append(nth_match(LiteralMatch(strng, start, last)))
+        parts.append(strng[last:])
+        return True, ''.join(parts)
+
+
+class AddressScan(object):
+    """ Finds in a single search which regexp addresses of a script can match
+        the pattern space. Scripts with many regexp addresses, like routing
+        tables, mostly have lines matching none of them, and checking the
+        required literals of every address on its own still takes a pass over
+        the line for each of them. The required literals of all addresses are
+        combined into one pattern shaped like a trie, as module re has no
+        automaton for sets of strings but stops early on a common prefix, and
+        every position of the pattern space is tried once for the longest of
+        them. The addresses missing one of theirs do not match, the others are
+        searched on their own. The scan is run once for every pattern space by
+        the first address asking and its result is kept in the ExecutionState.
+        Addresses without literals or ignoring case are not part of the scan.
+    """
+
+    # the number of distinct regexps needed for a scan
+    MIN_REGEXPS = 8
+    # the length literals are cut to, their beginning is required as well
+    MAX_LENGTH = 64
+
+    def __init__(self, members, literals):
+        # the compiled patterns of the members -> the literals they require
+        self.members = members
+        # the literals found with a literal include the literals it starts with
+        self.prefixes = dict((literal, [other for other in literals if literal.startswith(other)])
+                             for literal in literals)
+        self.finditer = re.compile('(?=({}))'.format(AddressScan.trie_pattern(literals))).finditer
+
+    @staticmethod
+    def build(commands):
+        # sets up the scan for the regexp addresses of the commands, if worth it
+        regexps = []
+        members = {}
+        for command in commands:
+            addr_range = command.addr_range
+            for holder in [addr_range, getattr(addr_range, 'from_addr', None)]:
+                regexp = getattr(holder, 'regexp', None)
+                literals = AddressScan.required(regexp)
+                if literals:
+                    regexps.append(regexp)
+                    members[regexp.compiled] = frozenset(lit[:AddressScan.MAX_LENGTH]
+                                                         for lit in literals)
+        if len(members) < AddressScan.MIN_REGEXPS:
+            return None
+        scan = AddressScan(members, set(lit for literals in members.values() for lit in literals))
+        for regexp in regexps:
+            regexp.scan = scan
+            regexp.scan_literals = members[regexp.compiled]
+        return scan
+
+    @staticmethod
+    def required(regexp):
+        # returns the literals every match of the regexp contains or None
+        if not isinstance(regexp, SedRegexp):
+            return None
+        if regexp.literal is not None:
+            if regexp.literal.ignore_case or not regexp.literal.text:
+                return None
+            return [regexp.literal.text]
+        if regexp.prefilter is None or regexp.prefilter.ignore_case:
+            return None
+        return regexp.prefilter.literals
+
+    @staticmethod
+    def trie_pattern(literals):
+        # returns a pattern matching the longest of the literals at a position
+        trie = {}
+        for literal in literals:
+            node = trie
+            for char in literal:
+                node = node.setdefault(char, {})
+            node[''] = None
+
+        def pattern(node):
+            alternatives = [re.escape(char) + pattern(node[char])
+                            for char in sorted(node) if char]
+            if '' in node:
+                # longer literals first
+                alternatives.append('')
+            if len(alternatives) == 1:
+                return alternatives[0]
+            return '(?:{})'.format('|'.join(alternatives))
+
+        return pattern(trie)
+
+    def run(self, state, strng):
+        # keeps the literals found in strng in the state for all members
+        state.statistics.address_scans += 1
+        found = set()
+        for match in self.finditer(strng):
+            found.update(self.prefixes[match.group(1)])
+        if not found:
+            state.statistics.address_scan_misses += 1
+        state.scanned = strng
+        state.scan_found = found
+        return found
+
+    def batch_filter(self, batch, indexes, literals):
+        # returns the indexes of the lines containing the literals and the others
+        lines = batch.lines
+        scanned = batch.scanned
+        scan_found = batch.scan_found
+        possible, impossible = [], []
+        for idx in indexes:
+            if scanned[idx] is not lines[idx]:
+                scan_found[idx] = self.run(batch.state, lines[idx])
+                scanned[idx] = lines[idx]
+            if literals <= scan_found[idx]:
+                possible.append(idx)
+            else:
+                impossible.append(idx)
+        return possible, impossible
+
+
+class RequiredLiterals(object):
+    """ The literal strings every match of a regexp contains, like 'user=' and
+        ' action=delete' for user=[a-z]+ action=delete. They are extracted from
+        the runs of literal characters of the translated pattern outside of
+        groups, character sets and alternatives, and a string not containing all
+        of them is rejected before searching it with module re at all. Patterns
+        with an alternative at the top or inline flags get no prefilter.
+    """
+
+    QUANTIFIER = re.compile(r'\{\d*(,\d*)?\}')
+    # the digits of an octal escape after the backslash, like module re reads them
+    OCTAL = re.compile(r'0|[0-7]{3}')
+    # the number of literals checked at most, the longest ones
+    MAX_LITERALS = 3
+
+    def __init__(self, literals, ignore_case):
+        self.literals = literals
+        self.ignore_case = ignore_case
+
+    @staticmethod
+    def extract(py_pattern, ignore_case):
+        # returns the RequiredLiterals of the translated pattern or None, if no
+        # literal is required or the pattern is not understood
+        if '(?' in py_pattern:
+            return None
+        runs = [[]]
+        pos = 0
+        end = len(py_pattern)
+        literal = False
+        while pos < end:
+            char = py_pattern[pos]
+            pos += 1
+            if char == '\\':
+                char = py_pattern[pos:pos + 1]
+                pos += 1
+                if char in LiteralPattern.ESCAPES:
+                    char = LiteralPattern.ESCAPES[char]
+                elif char in 'xuUN' or RequiredLiterals.OCTAL.match(py_pattern, pos - 1):
+                    # the characters following the escape are part of it
+                    return None
+                elif char.isdigit():
+                    # back reference of up to two digits
+                    if py_pattern[pos:pos + 1].isdigit():
+                        pos += 1
+                    char = None
+                elif char == '' or char.isalnum() or char == '_':
+                    # classes, anchors, back references and other escapes
+                    char = None
+            elif char in '*?+{':
+                if char == '{':
+                    match = RequiredLiterals.QUANTIFIER.match(py_pattern, pos - 1)
+                    if match is None:
+                        return None
+                    pos = match.end()
+                if literal and char != '+':
+                    # the last character may be missing
+                    runs[-1].pop()
+                if py_pattern[pos:pos + 1] in ['?', '+']:
+                    pos += 1
+                char = None
+            elif char == '[':
+                pos = RequiredLiterals.skip_set(py_pattern, pos)
+                char = None
+            elif char == '(':
+                pos = RequiredLiterals.skip_group(py_pattern, pos)
+                char = None
+            elif char in ')|':
+                return None
+            elif char in '.^$':
+                char = None
+            if pos is None:
+                return None
+            literal = char is not None
+            if literal:
+                runs[-1].append(char)
+            elif runs[-1]:
+                runs.append([])
+        literals = []
+        for run in runs:
+            if run and ''.join(run) not in literals:
+                literals.append(''.join(run))
+        # longest first, in the order of the pattern otherwise
+        literals.sort(key=len, reverse=True)
+        if not literals:
+            return None
+        if ignore_case:
+            literals = [lit.lower() for lit in literals]
+            if not (STR_ISASCII and all(STR_ISASCII(lit) for lit in literals)):
+                return None
+        return RequiredLiterals(literals[:RequiredLiterals.MAX_LITERALS], ignore_case)
+
+    @staticmethod
+    def skip_set(py_pattern, pos):
+        # returns the position after the character set starting before pos or None
+        if py_pattern[pos:pos + 1] == '^':
+            pos += 1
+        if py_pattern[pos:pos + 1] == ']':
+            pos += 1
+        while pos < len(py_pattern):
+            char = py_pattern[pos]
+            if char == ']':
+                return pos + 1
+            pos += 2 if char == '\\' else 1
+        return None
+
+    @staticmethod
+    def skip_group(py_pattern, pos):
+        # returns the position after the group starting before pos or None
+        depth = 1
+        while pos is not None and pos < len(py_pattern):
+            char = py_pattern[pos]
+            if char == '\\':
+                pos += 2
+            elif char == '[':
+                pos = RequiredLiterals.skip_set(py_pattern, pos + 1)
+            else:
+                pos += 1
+                if char == '(':
+                    depth += 1
+                elif char == ')':
+                    depth -= 1
+                    if depth == 0:
+                        return pos
+        return None
+
+    def test(self, strng):
+        # returns False, if strng can not match
+        if self.ignore_case:
+            if not STR_ISASCII(strng):
+                return True
+            strng = strng.lower()
+        for literal in self.literals:
+            if literal not in strng:
+                return False
+        return True
+
+    def check(self, state, strng):
+        # same as test, counting the checks and rejections in the run statistics
+        statistics = state.statistics
+        statistics.prefilter_checks += 1
+        if self.test(strng):
+            return True
+        statistics.prefilter_rejections += 1
+        return False
+
+
+class LiteralMatch(object):
+    """ The match of a LiteralPattern passed to NthMatch and Replacement in
+        place of the match object of module re.
+    """
+    __slots__ = ('string', 'begin', 'finish')
+
+    def __init__(self, string, begin, finish):
+        self.string = string
+        self.begin = begin
+        self.finish = finish
+
+    def group(self, num):
+        if num != 0:
+            raise IndexError('no such group')
+        return self.string[self.begin:self.finish]
+
+    def start(self, num):  # @UnusedVariable
+        return self.begin
+
+    def end(self, num):  # @UnusedVariable
+        return self.finish
+
+
 # The following classes implement the various forms of addresses and address ranges.
 # There is a specialized class for each kind of address range to avoid unneccessary
 # if-elif-cascades during processing of the input to optimise runtime.
@@ -2852,17 +6432,17 @@ class SedRegexp(object):
 
 class AddressLast(object):
 
-    def __init__(self, sed):
-        self.sed = sed
-
     def __str__(self):  # pragma: no cover (only for debugging)
         return '$'
 
     def __repr__(self):  # pragma: no cover (only for debugging)
         return self.__str__()
 
-    def matches(self):
-        return self.sed.is_last_line()
+    def matches(self, state):
+        return state.is_last_line()
+
+    def generate(self, gen):
+        return gen.last_line()
 
 
 class AddressZero(object):
@@ -2872,9 +6452,6 @@ class AddressZero(object):
         AddressRangeZeroToRegexp which is the only valid application of a 0-address.
     """
 
-    def __init__(self, sed):
-        self.sed = sed
-
     def __str__(self):  # pragma: no cover (only for debugging)
         return '0'
 
@@ -2883,7 +6460,7 @@ class AddressZero(object):
 
     # AddressZero objects only exists during compilation and are
     # never actually used and thus don't need a method matches()
-    # def matches(self):
+    # def matches(self, state):
     #     return True
 
 
@@ -2892,8 +6469,7 @@ class AddressRegexp(object):
         against the pattern space.
     """
 
-    def __init__(self, sed, regexp):
-        self.sed = sed
+    def __init__(self, regexp):
         self.regexp = regexp
 
     def __str__(self):  # pragma: no cover (only for debugging)
@@ -2902,8 +6478,28 @@ class AddressRegexp(object):
     def __repr__(self):  # pragma: no cover (only for debugging)
         return self.__str__()
 
-    def matches(self):
-        return self.regexp.matches(self.sed.PS)
+    def matches(self, state):
+        return self.regexp.matches(state, state.PS)
+
+    def batch_matches(self, batch, indexes):
+        lines = batch.lines
+        search = self.regexp.search
+        prefilter = self.regexp.prefilter
+        matched, unmatched = [], []
+        if self.regexp.scan is not None:
+            indexes, unmatched = self.regexp.scan.batch_filter(batch, indexes,
+                                                               self.regexp.scan_literals)
+        for idx in indexes:
+            if prefilter is not None and not prefilter.check(batch.state, lines[idx]):
+                unmatched.append(idx)
+            elif search(lines[idx]):
+                matched.append(idx)
+            else:
+                unmatched.append(idx)
+        return matched, unmatched
+
+    def generate(self, gen):
+        return gen.search(self.regexp)
 
 
 class AddressNum(object):
@@ -2912,8 +6508,7 @@ class AddressNum(object):
         are processed separately).
     """
 
-    def __init__(self, sed, num):
-        self.sed = sed
+    def __init__(self, num):
         self.num = num
 
     def __str__(self):  # pragma: no cover (only for debugging)
@@ -2922,8 +6517,11 @@ class AddressNum(object):
     def __repr__(self):  # pragma: no cover (only for debugging)
         return self.__str__()
 
-    def matches(self):
-        return self.sed.file_line_no() == self.num
+    def matches(self, state):
+        return state.file_line_no() == self.num
+
+    def generate(self, gen):
+        return '{} == {}'.format(gen.line_number(), self.num)
 
 
 class AddressStep(object):
@@ -2934,8 +6532,7 @@ class AddressStep(object):
         on 5, 8, 11, 14, ...
     """
 
-    def __init__(self, sed, num, step):
-        self.sed = sed
+    def __init__(self, num, step):
         self.num = num
         self.step = step
 
@@ -2945,24 +6542,37 @@ class AddressStep(object):
     def __repr__(self):  # pragma: no cover (only for debugging)
         return self.__str__()
 
-    def matches(self):
-        line_no = self.sed.file_line_no()
+    def matches(self, state):
+        line_no = state.file_line_no()
         if line_no < self.num:
             return False
         return (line_no - self.num) % self.step == 0
 
+    def generate(self, gen):
+        return '({ln} >= {num} and ({ln} - {num}) % {step} == 0)'.format(
+            ln=gen.line_number(), num=self.num, step=self.step)
+
 
 class AddressRangeNone(object):
     """ This address range implements a 'alway-active' dummy range and is used for
         all commands that do not have an address associated with it.
     """
 
-    def __init__(self):
-        self.first_line = True
+    def is_active(self, state):  # @UnusedVariable
+        return True
 
-    def is_active(self):
+    def is_first_line(self, state):  # @UnusedVariable
         return True
 
+    def batch_mask(self, batch, indexes):  # @UnusedVariable
+        return indexes, []
+
+    def generate(self, gen):  # @UnusedVariable
+        return None
+
+    def generate_first_line(self, gen):  # @UnusedVariable
+        return 'True'
+
     def __str__(self):  # pragma: no cover (only for debugging)
         return ''
 
@@ -2987,19 +6597,38 @@ class AddressRangeFake(object):
 
     def __init__(self, from_addr):
         self.from_addr = from_addr
-        self.first_line = True
         self.set_negate(False)
 
     def set_negate(self, negate):
         self.active_return = not negate
         self.inactive_return = negate
 
-    def is_active(self):
-        if self.from_addr.matches():
+    def is_active(self, state):
+        if self.from_addr.matches(state):
             return self.active_return
         else:
             return self.inactive_return
 
+    def is_first_line(self, state):  # @UnusedVariable
+        return True
+
+    def batch_mask(self, batch, indexes):
+        # returns the indexes of the lines the range is active for and the others
+        matched, unmatched = self.from_addr.batch_matches(batch, indexes)
+        if self.active_return:
+            return matched, unmatched
+        else:
+            return unmatched, matched
+
+    def generate(self, gen):
+        if self.active_return:
+            return self.from_addr.generate(gen)
+        else:
+            return 'not ({})'.format(self.from_addr.generate(gen))
+
+    def generate_first_line(self, gen):  # @UnusedVariable
+        return 'True'
+
     def __str__(self):  # pragma: no cover (only for debugging)
         return str(self.from_addr) + self.negated_as_str()
 
@@ -3019,6 +6648,23 @@ class AddressRangeFake(object):
             return '!'
 
 
+class RangeState(object):
+    """ The state of an address range during a run. The range objects themselves
+        are part of the compiled script and thus never changed while running.
+    """
+    __slots__ = ('active', 'first_line', 'last_line_no', 'next_first_line')
+
+    def copy(self):
+        other = RangeState()
+        other.restore(self)
+        return other
+
+    def restore(self, other):
+        for name in self.__slots__:
+            if hasattr(other, name):
+                setattr(self, name, getattr(other, name))
+
+
 class AddressRange(object):
     """ This is the abstract base-class of the other address range classes.
         No instance of this class is ever created.
@@ -3026,14 +6672,12 @@ class AddressRange(object):
 
     def __init__(self, from_addr, exclude):
         self.from_addr = from_addr
-        self.sed = self.from_addr.sed
         self.exclude = exclude
-        self.active = False
+        self.index = None
         self.set_negate(False)
 
     def set_negate(self, negate):
         self.first_line_default = negate
-        self.first_line = self.first_line_default
         self.exclude_return = self.exclude == negate
         self.active_return = not negate
         self.inactive_return = negate
@@ -3046,6 +6690,47 @@ class AddressRange(object):
     def __repr__(self):  # pragma: no cover (only for debugging)
         return self.__str__()
 
+    def new_state(self):
+        range_state = RangeState()
+        range_state.active = False
+        range_state.first_line = self.first_line_default
+        return range_state
+
+    def is_first_line(self, state):
+        return state.ranges[self.index].first_line
+
+    def generate(self, gen):
+        # the state of the range stays in the range state object,
+        # the generated code just inlines the logic of is_active
+        rng = gen.range_state(self)
+        active = gen.temporary('active')
+        gen.emit('if {}.active:'.format(rng))
+        gen.indent()
+        self.generate_active(gen, rng, active)
+        gen.dedent()
+        gen.emit('elif {}:'.format(self.from_addr.generate(gen)))
+        gen.emit('    {}.first_line = True'.format(rng))
+        self.generate_activate(gen, rng)
+        gen.emit('    {}.active = True'.format(rng))
+        gen.emit('    {} = {}'.format(active, self.active_return))
+        gen.emit('else:')
+        gen.emit('    {} = {}'.format(active, self.inactive_return))
+        return active
+
+    def generate_activate(self, gen, rng):  # @UnusedVariable
+        pass
+
+    def generate_end(self, gen, rng, active, end_condition):
+        gen.emit('{}.first_line = {}'.format(rng, self.first_line_default))
+        gen.emit('if {}:'.format(end_condition))
+        gen.emit('    {}.active = False'.format(rng))
+        gen.emit('    {} = {}'.format(active, self.exclude_return))
+        gen.emit('else:')
+        gen.emit('    {} = {}'.format(active, self.active_return))
+
+    def generate_first_line(self, gen):
+        return gen.range_state(self) + '.first_line'
+
     def from_as_str(self):  # pragma: no cover (only for debugging)
         return str(self.from_addr)
 
@@ -3073,31 +6758,53 @@ class AddressRangeToNum(AddressRange):
     def __init__(self, from_addr, num, exclude):
         super(AddressRangeToNum, self). __init__(from_addr, exclude)
         self.num = num
-        self.last_line_no = 0
-
-    def is_active(self):
-        if self.active:
-            self.first_line = self.first_line_default
-            curr_line_no = self.sed.file_line_no()
-            if self.last_line_no < curr_line_no:
-                self.active = False
+
+    def new_state(self):
+        range_state = super(AddressRangeToNum, self).new_state()
+        range_state.last_line_no = 0
+        return range_state
+
+    def is_active(self, state):
+        range_state = state.ranges[self.index]
+        if range_state.active:
+            range_state.first_line = self.first_line_default
+            curr_line_no = state.file_line_no()
+            if range_state.last_line_no < curr_line_no:
+                range_state.active = False
                 return self.inactive_return
-            elif self.last_line_no == curr_line_no:
-                self.active = False
+            elif range_state.last_line_no == curr_line_no:
+                range_state.active = False
                 return self.exclude_return
             else:
                 return self.active_return
-        elif self.from_addr.matches():
-            self.first_line = True
-            self.last_line_no = self.calc_last_line()
-            self.active = True
+        elif self.from_addr.matches(state):
+            range_state.first_line = True
+            range_state.last_line_no = self.calc_last_line(state)
+            range_state.active = True
             return self.active_return
         else:
             return self.inactive_return
 
-    def calc_last_line(self):  # num
+    def calc_last_line(self, state):  # @UnusedVariable
         return self.num
 
+    def generate_active(self, gen, rng, active):
+        gen.emit('{}.first_line = {}'.format(rng, self.first_line_default))
+        gen.emit('if {}.last_line_no < {}:'.format(rng, gen.line_number()))
+        gen.emit('    {}.active = False'.format(rng))
+        gen.emit('    {} = {}'.format(active, self.inactive_return))
+        gen.emit('elif {}.last_line_no == {}:'.format(rng, gen.line_number()))
+        gen.emit('    {}.active = False'.format(rng))
+        gen.emit('    {} = {}'.format(active, self.exclude_return))
+        gen.emit('else:')
+        gen.emit('    {} = {}'.format(active, self.active_return))
+
+    def generate_activate(self, gen, rng):
+        gen.emit('    {}.last_line_no = {}'.format(rng, self.generate_last_line(gen)))
+
+    def generate_last_line(self, gen):  # @UnusedVariable
+        return str(self.num)
+
     def to_as_str(self):  # pragma: no cover (only for debugging)
         return self.exclude_as_str() + str(self.num)
 
@@ -3107,8 +6814,11 @@ class AddressRangeToCount(AddressRangeToNum):
         a given from-address and ends after a certain number of lines from the input.
     """
 
-    def calc_last_line(self):  # count
-        return self.sed.file_line_no() + self.num
+    def calc_last_line(self, state):
+        return state.file_line_no() + self.num
+
+    def generate_last_line(self, gen):
+        return '{} + {}'.format(gen.line_number(), self.num)
 
     def to_as_str(self):  # pragma: no cover (only for debugging)
         return self.exclude_as_str() + '+' + str(self.num)
@@ -3121,10 +6831,13 @@ class AddressRangeToMultiple(AddressRangeToNum):
         It implements address ranges of the kind <from-addr>,~<multiple>
     """
 
-    def calc_last_line(self):
-        line_no = self.sed.file_line_no()
+    def calc_last_line(self, state):
+        line_no = state.file_line_no()
         return line_no + self.num - (line_no % self.num)
 
+    def generate_last_line(self, gen):
+        return '{ln} + {num} - ({ln} % {num})'.format(ln=gen.line_number(), num=self.num)
+
     def to_as_str(self):  # pragma: no cover (only for debugging)
         return self.exclude_as_str() + '~' + str(self.num)
 
@@ -3134,21 +6847,25 @@ class AddressRangeToLastLine(AddressRange):
         a given from-address and ends once in input reaches the last line.
     """
 
-    def is_active(self):
-        if self.active:
-            self.first_line = self.first_line_default
-            if self.sed.is_last_line():
-                self.active = False
+    def is_active(self, state):
+        range_state = state.ranges[self.index]
+        if range_state.active:
+            range_state.first_line = self.first_line_default
+            if state.is_last_line():
+                range_state.active = False
                 return self.exclude_return
             else:
                 return self.active_return
-        elif self.from_addr.matches():
-            self.first_line = True
-            self.active = True
+        elif self.from_addr.matches(state):
+            range_state.first_line = True
+            range_state.active = True
             return self.active_return
         else:
             return self.inactive_return
 
+    def generate_active(self, gen, rng, active):
+        self.generate_end(gen, rng, active, gen.last_line())
+
     def to_as_str(self):  # pragma: no cover (only for debugging)
         return self.exclude_as_str() + '$'
 
@@ -3166,22 +6883,43 @@ class AddressRangeZeroToRegexp(AddressRange):
     def __init__(self, from_addr, regexp, exclude):
         super(AddressRangeZeroToRegexp, self). __init__(from_addr, exclude)
         self.regexp = regexp
-        self.active = True
-        self.next_first_line = True
-
-    def is_active(self):
-        if self.active:
-            self.first_line = self.next_first_line
-            self.next_first_line = False
-            if self.regexp.matches(self.sed.PS):
-                self.active = False
+
+    def new_state(self):
+        range_state = super(AddressRangeZeroToRegexp, self).new_state()
+        range_state.active = True
+        range_state.next_first_line = True
+        return range_state
+
+    def is_active(self, state):
+        range_state = state.ranges[self.index]
+        if range_state.active:
+            range_state.first_line = range_state.next_first_line
+            range_state.next_first_line = False
+            if self.regexp.matches(state, state.PS):
+                range_state.active = False
                 return self.exclude_return
             else:
                 return self.active_return
         else:
-            self.first_line = True
+            range_state.first_line = True
             return self.inactive_return
 
+    def generate(self, gen):
+        rng = gen.range_state(self)
+        active = gen.temporary('active')
+        gen.emit('if {}.active:'.format(rng))
+        gen.emit('    {rng}.first_line = {rng}.next_first_line'.format(rng=rng))
+        gen.emit('    {}.next_first_line = False'.format(rng))
+        gen.emit('    if {}:'.format(gen.search(self.regexp)))
+        gen.emit('        {}.active = False'.format(rng))
+        gen.emit('        {} = {}'.format(active, self.exclude_return))
+        gen.emit('    else:')
+        gen.emit('        {} = {}'.format(active, self.active_return))
+        gen.emit('else:')
+        gen.emit('    {}.first_line = True'.format(rng))
+        gen.emit('    {} = {}'.format(active, self.inactive_return))
+        return active
+
     def to_as_str(self):  # pragma: no cover (only for debugging)
         return self.exclude_as_str() + str(self.regexp)
 
@@ -3196,21 +6934,25 @@ class AddressRangeToRegexp(AddressRange):
         super(AddressRangeToRegexp, self). __init__(from_addr, exclude)
         self.regexp = regexp
 
-    def is_active(self):
-        if self.active:
-            self.first_line = self.first_line_default
-            if self.regexp.matches(self.sed.PS):
-                self.active = False
+    def is_active(self, state):
+        range_state = state.ranges[self.index]
+        if range_state.active:
+            range_state.first_line = self.first_line_default
+            if self.regexp.matches(state, state.PS):
+                range_state.active = False
                 return self.exclude_return
             else:
                 return self.active_return
-        elif self.from_addr.matches():
-            self.first_line = True
-            self.active = True
+        elif self.from_addr.matches(state):
+            range_state.first_line = True
+            range_state.active = True
             return self.active_return
         else:
             return self.inactive_return
 
+    def generate_active(self, gen, rng, active):
+        self.generate_end(gen, rng, active, gen.search(self.regexp))
+
     def to_as_str(self):  # pragma: no cover (only for debugging)
         return self.exclude_as_str() + str(self.regexp)
 
@@ -3233,6 +6975,36 @@ class SedException(Exception):
         return self.message
 
 
+class SedRunStopped(SedException):
+    """ Base class of the errors stopping a run before its input is processed.
+        The input line reached is kept in line_number and source_file_name.
+    """
+
+    def __init__(self, position, line_number, source_file_name, message):
+        self.line_number = line_number
+        self.source_file_name = source_file_name
+        super(SedRunStopped, self).__init__(
+            position, '{msg} on input line {line} of {file}.',
+            msg=message, line=line_number, file=source_file_name)
+        # Python 2 leaves args empty, which is needed to pickle the exception
+        self.args = (position, line_number, source_file_name, message)
+
+    @classmethod
+    def at(cls, state, position, message):
+        # the exception keeps where the run stopped, but not the state itself
+        return cls(position, state.reader.line_number, state.reader.source_file_name, message)
+
+
+class SedCancelled(SedRunStopped):
+    """ Raised when a run is stopped by its cancel token or deadline.
+    """
+
+
+class SedLimitExceeded(SedRunStopped):
+    """ Raised when a run exceeds one of the resource limits of Sed.
+    """
+
+
 # -- Main -------------------------------------------
 
 
@@ -3360,6 +7132,76 @@ the script, as if it had been prefixed with -e.
             type=int,
             default=0,
             dest='debug')
+        self.parser.add_argument(
+            '--engine',
+            help='execution engine running the script',
+            choices=['auto'] + sorted(ENGINES),
+            default='auto',
+            dest='engine')
+        self.parser.add_argument(
+            '--explain',
+            help='show the execution plan instead of processing the input',
+            action='store_true',
+            default=False,
+            dest='explain')
+        self.parser.add_argument(
+            '--no-optimize',
+            help='execute the script without simplifying it first',
+            action='store_false',
+            default=True,
+            dest='optimize')
+        self.parser.add_argument(
+            '--shadow',
+            help='check the engine against the reference interpreter '
+                 'on the given fraction of cycles (default 0.01)',
+            nargs='?',
+            type=float,
+            const=0.01,
+            default=None,
+            metavar='RATE',
+            dest='shadow')
+        self.parser.add_argument(
+            '--line-memo',
+            help='memoize the output of a line-local script for the given '
+                 'number of distinct input lines (default 4096)',
+            nargs='?',
+            type=int,
+            const=4096,
+            default=0,
+            metavar='SIZE',
+            dest='line_memo')
+        self.parser.add_argument(
+            '--spill-threshold',
+            help='move the hold space and the pattern space to a temporary file '
+                 'once they grow beyond the given number of characters',
+            type=int,
+            default=0,
+            metavar='SIZE',
+            dest='spill_threshold')
+        self.parser.add_argument(
+            '--max-space',
+            help='stop with an error once the pattern or the hold space grows '
+                 'beyond the given number of characters',
+            type=int,
+            default=0,
+            metavar='SIZE',
+            dest='max_space')
+        self.parser.add_argument(
+            '--max-commands',
+            help='stop with an error once a cycle executes more than the given '
+                 'number of commands',
+            type=int,
+            default=0,
+            metavar='COUNT',
+            dest='max_commands')
+        self.parser.add_argument(
+            '--max-line-time',
+            help='stop with an error once a cycle takes longer than the given '
+                 'number of seconds',
+            type=float,
+            default=0,
+            metavar='SECONDS',
+            dest='max_line_time')
         self.parser.add_argument(
             'targets',
             nargs='*',
@@ -3430,6 +7272,16 @@ def main():
         sed.debug = args.debug
         sed.separate = args.separate
         sed.sed_compatible = args.sed_compatible
+        sed.engine = args.engine
+        sed.optimize = args.optimize
+        if args.shadow is not None:
+            sed.shadow = True
+            sed.shadow_rate = args.shadow
+        sed.line_memo = args.line_memo
+        sed.spill_threshold = args.spill_threshold
+        sed.max_space = args.max_space
+        sed.max_commands = args.max_commands
+        sed.max_line_time = args.max_line_time
         targets = args.targets
         scripts = args.scripts
         if len(scripts) == 0:
@@ -3444,6 +7296,9 @@ def main():
             else:
                 sed.load_string(script.literal, encoding=script.encoding)
         targets = list((target.encoding, target.filename) for target in targets)
+        if args.explain:
+            sed.explain(targets, output=sys.stdout)
+            return 0
         sed.apply(targets, output=sys.stdout)
         exit_code = sed.exit_code
         return exit_code
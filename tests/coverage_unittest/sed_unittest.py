@@ -139,6 +139,9 @@ class PythonSedTestCase(unittest.TestCase):
             python_syntax=False,  # use python syntax for regex (-p option)
             extended=False,       # use extended regex syntax (-E option)
             line_length=70,       # default line length for l command
+            engine='interpreter',  # execution engine to run the script with
+            tracer=None,          # tracer to be notified about the execution
+            optimize=True,        # simplify the compiled script before running it
             scripts=[],           # literal script strings (as list) and file names (as string)
             inputs=[],            # literal input strings (as list) and file names (as string)
             output=None,          # write output to this stream/filename (None defaults to stdout)
@@ -157,7 +160,10 @@ class PythonSedTestCase(unittest.TestCase):
                             separate=separate,
                             sed_compatible=not python_syntax,
                             regexp_extended=extended,
-                            line_length=line_length)
+                            line_length=line_length,
+                            engine=engine,
+                            tracer=tracer,
+                            optimize=optimize)
 
         output_stdout = []
         with Capture(stdin) as capture:
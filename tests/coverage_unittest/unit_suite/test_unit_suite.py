@@ -2,7 +2,12 @@
 
 from __future__ import unicode_literals
 from io import StringIO, open as open
+import pickle
 import sys
+import threading
+import time
+
+import PythonSed
 
 from tests.coverage_unittest.sed_unittest import PythonSedTestCase
 
@@ -3459,3 +3464,899 @@ abcabc2
             stderr=None,  # we do not check the debug output!!!
             exit_code=0,
             )
+
+    def test_171_engine_codegen_branches_and_blocks(self):
+        self.run_test_against_object(  # noqa: E122
+            debug=0,
+            engine='codegen',
+            scripts=[[
+""":a
+/x$/ { N; s/x\\n//; ta }
+2,/e/ { s/^/> /; /c/b end }
+$!{ y/abc/ABC/ }
+:end
+3,+1c\\
+changed
+"""]],
+            inputs=[[
+"""ax
+b
+c
+d
+e
+f
+"""]],
+            stdout=(
+"""> AB
+changed
+> e
+f
+"""),
+            stderr='',
+            exit_code=0,
+            )
+
+    def test_172_engine_codegen_multiline_and_quit(self):
+        self.run_test_against_main(  # noqa: E122
+            debug=0,
+            encoding=ENCODING,
+            options=['--engine=codegen', '-n'],
+            scripts=[["$!N;/4/{=;l;q5}"], ["P;D"]],
+            inputs=[],
+            stdin=(
+"""1
+2
+3
+4
+5
+"""),
+            stdout=(
+"""1
+2
+4
+3\\n4$
+"""),
+            stderr='',
+            exit_code=5)
+
+    def test_173_unknown_engine(self):
+        self.run_test_against_object(  # noqa: E122
+            debug=0,
+            engine='compiler',
+            scripts=[["p"]],
+            inputs=[],
+            stdin='1\n',
+            stdout=None,
+            stderr='sed.py error: Unknown execution engine compiler. Use one of auto, batch, codegen, interpreter, kernel, rope, window.\n',
+            exit_code=1,
+            )
+
+    def test_174_custom_tracer(self):
+
+        class CountingTracer(PythonSed.Tracer):
+            def __init__(self):
+                self.events = []
+
+            def cycle_start(self, state):
+                self.events.append('cycle')
+
+            def command_executed(self, state, command):
+                self.events.append(command.function)
+
+            def cycle_end(self, state, last_command):
+                self.events.append('end ' + (last_command.function if last_command else '-'))
+
+            def printing(self, state, source, line):
+                self.events.append(source + ' ' + line)
+
+        tracer = CountingTracer()
+        self.run_test_against_object(  # noqa: E122
+            debug=0,
+            engine='codegen',     # tracing always uses the interpreter
+            tracer=tracer,
+            scripts=[["2d;s/a/x/;3q"]],
+            inputs=[["a", "b", "a"]],
+            stdout=(
+"""x
+x
+"""),
+            stderr='',
+            exit_code=0,
+            )
+        self.assertEqual(tracer.events,
+                         ['cycle', 's', 'end s', 'autop x',
+                          'cycle', 'd', 'end d',
+                          'cycle', 's', 'q', 'end q', 'autop x'])
+
+    def test_175_apply_twice_with_range_and_write_file(self):
+        output_file = self.create_tempfile(ENCODING, 'output.', '')
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('/b/,/d/d\nw ' + output_file)
+        self.assertEqual(sed.apply(StringIO('a\nb\nc\n'), output=None), ['a\n'])
+        # the range must not be active anymore and the file must be written again
+        self.assertEqual(sed.apply(StringIO('a\nb\nc\nd\ne\n'), output=None), ['a\n', 'e\n'])
+        self.assertEqual(sed.exit_code, 0)
+        with open(output_file, 'rt', encoding=ENCODING) as f:
+            self.assertEqual(f.read(), 'a\ne\n')
+
+    def test_176_compiled_script_shared_by_threads(self):
+        sed = PythonSed.Sed(encoding=ENCODING, engine='codegen')
+        sed.load_string('/start/,/end/{//!d}\ns//[&]/')
+        sed.compile()
+        inputs = ['start\n{i}\nend\n{i}\n'.format(i=i) * 50 for i in range(8)]
+        results = [None] * len(inputs)
+
+        def run(idx):
+            results[idx] = sed.apply(StringIO(inputs[idx]), output=None)
+
+        threads = [threading.Thread(target=run, args=(idx,)) for idx in range(len(inputs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for idx in range(len(inputs)):
+            self.assertEqual(results[idx],
+                             ['[start]\n', '[end]\n', '{i}\n'.format(i=idx)] * 50)
+
+    def test_177_optimizer(self):
+        script = ':a\n/x/{b b;p}\n{s/a/b/;tc}\nb a\n:b\nb c\nd\n:c\n$!{}\np'
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string(script)
+        self.assertEqual(sed.compile().optimizations, [
+            '-e #1 line 1 char 1: dropped label a',
+            '-e #1 line 2 char 9: removed unreachable command p',
+            '-e #1 line 2 char 10: dropped block end',
+            '-e #1 line 3 char 1: flattened block without address',
+            '-e #1 line 3 char 11: dropped block end',
+            '-e #1 line 5 char 1: dropped label b',
+            '-e #1 line 5 char 1: threaded jumps to label b to command p at -e #1 line 10 char 1',
+            '-e #1 line 6 char 1: removed unreachable command b',
+            '-e #1 line 7 char 1: removed unreachable command d',
+            '-e #1 line 8 char 1: dropped label c',
+            '-e #1 line 9 char 3: removed empty block',
+            '-e #1 line 9 char 4: dropped block end',
+            ])
+        # the debug listing shows every command as written
+        sed = PythonSed.Sed(encoding=ENCODING, debug=1)
+        sed.load_string(script)
+        listing = str(sed.compile()).splitlines()
+        self.assertEqual(len(listing), 29)
+        self.assertEqual(listing[0], '|001|002|   |                      : a')
+        self.assertEqual(listing[-1], 'optimized -e #1 line 9 char 4: dropped block end')
+        unoptimized = PythonSed.Sed(encoding=ENCODING, optimize=False)
+        unoptimized.load_string(script)
+        self.assertEqual(listing[:17], str(unoptimized.compile()).splitlines())
+        for engine in ['interpreter', 'codegen']:
+            for optimize in [True, False]:
+                self.run_test_against_object(  # noqa: E122
+                    engine=engine,
+                    optimize=optimize,
+                    scripts=[[script]],
+                    inputs=[["x1", "aa", "x2"]],
+                    stdout='x1\nx1\nba\nba\nx2\nx2\n',
+                    stderr='',
+                    exit_code=0,
+                    )
+
+    def test_178_no_optimize_option(self):
+        self.run_test_against_main(  # noqa: E122
+            debug=0,
+            encoding=ENCODING,
+            options=['--no-optimize', '-n'],
+            scripts=[[":a;$!{N;ba};s/\\n/+/g;p"]],
+            inputs=[],
+            stdin='1\n2\n3\n',
+            stdout='1+2+3\n',
+            stderr='',
+            exit_code=0)
+
+    def test_179_script_analysis(self):
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('s/a/b/g;/x/!d;y/abc/xyz/;tl;p;:l;a\\\nappended')
+        analysis = sed.script.analysis
+        self.assertTrue(analysis.line_local)
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('1d;$!N;h;/a/,/b/{q};5~2w /dev/null\n//p')
+        analysis = sed.script.analysis
+        self.assertFalse(analysis.line_local)
+        self.assertEqual([(name, getattr(analysis, name))
+                          for (name, _) in analysis.PROPERTIES],
+                         [('uses_hold_space', True),
+                          ('multi_line', True),
+                          ('line_number_dependent', True),
+                          ('uses_last_line', True),
+                          ('has_range_state', True),
+                          ('has_early_exit', True),
+                          ('has_side_files', True),
+                          ('uses_empty_regexp', True)])
+        self.assertEqual(analysis.reasons['line_number_dependent'],
+                         ['-e #1 line 1 char 2', '-e #1 line 1 char 24'])
+
+    def test_180_explain(self):
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string(':a;/x/ba;h')
+        output = StringIO()
+        plan = sed.explain([['a', 'b']], output)
+        self.assertEqual(plan.engine, 'interpreter')
+        self.assertEqual(output.getvalue(),
+                         'engine: interpreter (auto requested)\n'
+                         'input: literal (2 lines)\n'
+                         'script: not line-local (uses_hold_space)\n'
+                         'optimizations: 1\n'
+                         '  kernel: rejected, the script is no well-known one-liner\n'
+                         '  rope: rejected, the script does not accumulate text in the hold space '
+                         '(commands H or G and h)\n'
+                         '  codegen: rejected, generating the code does not pay off for 2 lines of input\n'
+                         '  batch: rejected, the script is not line-local\n'
+                         '  window: rejected, the script keeps no window of lines (commands N and D)\n'
+                         '  interpreter: chosen\n')
+        self.assertEqual(sed.explain([list(range(300))], None).engine, 'codegen')
+        sed.engine = 'codegen'
+        sed.tracer = PythonSed.Tracer()
+        self.assertEqual(sed.explain([list(range(300))], None).candidates,
+                         [('kernel', 'engine codegen was requested'),
+                          ('rope', 'engine codegen was requested'),
+                          ('codegen', 'tracing is only supported by the interpreter'),
+                          ('batch', 'engine codegen was requested'),
+                          ('window', 'engine codegen was requested'),
+                          ('interpreter', None)])
+
+    def test_181_explain_option(self):
+        self.run_test_against_main(  # noqa: E122
+            debug=0,
+            encoding=ENCODING,
+            options=['--explain', '--engine', 'interpreter'],
+            scripts=[["p"]],
+            inputs=[],
+            stdin='1\n',
+            stdout='engine: interpreter (interpreter requested)\n'
+                   'input: stream <stdin>\n'
+                   'script: line-local\n'
+                   'optimizations: 0\n'
+                   '  kernel: rejected, engine interpreter was requested\n'
+                   '  rope: rejected, engine interpreter was requested\n'
+                   '  codegen: rejected, engine interpreter was requested\n'
+                   '  batch: rejected, engine interpreter was requested\n'
+                   '  window: rejected, engine interpreter was requested\n'
+                   '  interpreter: chosen\n',
+            stderr='',
+            exit_code=0)
+
+    def test_182_adaptive_engine(self):
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('$!N;s/\\n/+/')
+        output = StringIO()
+        sed.explain(StringIO('1\n'), output)
+        self.assertEqual(output.getvalue().splitlines()[-4:],
+                         ['  codegen: chosen, sampled for 1000 cycles',
+                          '  batch: rejected, the script is not line-local',
+                          '  window: rejected, the script keeps no window of lines (commands N and D)',
+                          '  interpreter: sampled for 1000 cycles'])
+        saved = PythonSed.sed.EngineAdaptive.sample_cycles
+        PythonSed.sed.EngineAdaptive.sample_cycles = 1
+        try:
+            self.assertEqual(sed.apply(StringIO('1\n2\n3\n4\n5\n6\n7\n8\n9\n'), output=None),
+                             ['1+2\n', '3+4\n', '5+6\n', '7+8\n', '9\n'])
+            self.assertEqual(sed.exit_code, 0)
+            statistics = sed.statistics
+            self.assertEqual(statistics.cycles, 5)
+            self.assertEqual([switch[:2] for switch in statistics.switches],
+                             [(0, 'codegen'), (1, 'interpreter'), (2, statistics.engine)])
+            self.assertTrue(statistics.switches[2][2].startswith('fastest with'))
+            self.assertEqual(sed.apply(StringIO('1\n'), output=None), ['1\n'])
+            self.assertEqual(sed.statistics.switches, [(0, 'codegen', 'sampling')])
+        finally:
+            PythonSed.sed.EngineAdaptive.sample_cycles = saved
+
+    def test_183_shadow(self):
+        class EngineBroken(PythonSed.sed.EngineInterpreter):
+            name = 'broken'
+
+            def run(self, state, cycles=-1):
+                if state.PS is not None:
+                    state.PS = state.PS.replace('3', 'x')
+                return super(EngineBroken, self).run(state, cycles)
+
+        sed = PythonSed.Sed(encoding=ENCODING, shadow=True, shadow_rate=1)
+        sed.load_string('$!N;s/\\n/+/;h')
+        self.assertEqual(sed.apply([['1', '2', '3', '4', '5']], output=None),
+                         ['1+2\n', '3+4\n', '5\n'])
+        self.assertEqual(sed.statistics.shadow_checks, 3)
+        self.assertIsNone(sed.statistics.divergence)
+        PythonSed.sed.ENGINES['broken'] = EngineBroken
+        PythonSed.sed.PLAN_ORDER.insert(-1, 'broken')
+        try:
+            sed.engine = 'broken'
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                self.assertEqual(sed.apply([['1', '2', '3', '4', '5']], output=None),
+                                 ['1+2\n', 'x+4\n', '5\n'])
+            finally:
+                sys.stderr = stderr
+            self.assertEqual(sed.statistics.shadow_checks, 3)
+            self.assertEqual(sed.statistics.divergence,
+                             'shadow: divergence in the cycle starting at input line 3 '
+                             '(last command run by the reference at -e #1 line 1 char 13):\n'
+                             "  reference output ['3+4'], PS '5', HS '3+4', exit code 0\n"
+                             "  engine    output ['x+4'], PS '5', HS 'x+4', exit code 0\n")
+        finally:
+            del PythonSed.sed.ENGINES['broken']
+            PythonSed.sed.PLAN_ORDER.remove('broken')
+        sed.load_string('w /dev/null')
+        output = StringIO()
+        sed.engine = 'auto'
+        sed.explain([['1']], output)
+        self.assertIn('shadow: off, the script reads or writes other files\n', output.getvalue())
+        sed.shadow_rate = 2
+        self.assertRaises(PythonSed.SedException, sed.explain, [['1']], None)
+        # the state left by an engine quitting with -n is checked as well
+        for engine in ['window', 'auto']:
+            sed = PythonSed.Sed(encoding=ENCODING, engine=engine, no_autoprint=True,
+                                shadow=True, shadow_rate=1)
+            sed.load_string(':a;$q;N;4,$D;ba')
+            self.assertEqual(sed.apply([['a', 'b']], output=None), [])
+            self.assertEqual(sed.statistics.engine, 'window')
+            self.assertEqual(sed.statistics.shadow_checks, 1)
+            self.assertIsNone(sed.statistics.divergence)
+
+    def test_184_line_index(self):
+        script = '2p;4~3s/^/>/;3,5{s/$/</};7,~4d;9p;1~4!s/^/-/'
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string(script)
+        line_index = sed.compile().get_engine('interpreter').line_index
+        self.assertEqual(sorted(pos for (_, pos) in line_index.members.values()),
+                         [0, 1, 2, 3, 4])
+        for engine in ['interpreter', 'codegen']:
+            self.run_test_against_object(  # noqa: E122
+                engine=engine,
+                scripts=[[script]],
+                inputs=[[str(line_no) for line_no in range(1, 14)]],
+                stdout='1\n2\n-2\n-3<\n->4<\n5<\n-6\n9\n9\n->10\n-11\n-12\n>13\n',
+                stderr='',
+                exit_code=0,
+                )
+
+    def test_185_early_termination(self):
+        inputs = [str(line_no) for line_no in range(1, 11)]
+        sed = PythonSed.Sed(encoding=ENCODING, no_autoprint=True)
+        sed.load_string('3,4p;0,/2/s/^/x/p')
+        self.assertEqual(sed.compile().exhaustion, (3, [0, 1]))
+        self.assertEqual(sed.apply([inputs], output=None), ['x1\n', 'x2\n', '3\n', '4\n'])
+        self.assertEqual(sed.statistics.exhausted_at, 5)
+        sed.no_autoprint = False
+        self.assertEqual(sed.apply([inputs], output=None),
+                         ['x1\n', 'x1\n', 'x2\n', 'x2\n', '3\n', '3\n', '4\n', '4\n',
+                          '5\n', '6\n', '7\n', '8\n', '9\n', '10\n'])
+        self.assertEqual(sed.statistics.exhausted_at, 5)
+        sed.separate = True
+        output = StringIO()
+        sed.explain([inputs], output)
+        self.assertIn('early termination: off, line numbers restart with every input file\n',
+                      output.getvalue())
+        self.assertEqual(len(sed.apply([inputs], output=None)), 14)
+        self.assertIsNone(sed.statistics.exhausted_at)
+        for script in ['3p;/x/p', '3!p', '3{N;p}']:
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string(script)
+            self.assertIsNone(sed.compile().exhaustion)
+
+    def test_186_match_memo(self):
+        script = '/^a/I{/x/s/x/y/;/x/s/^/-/};/x/s/x/z/'
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string(script)
+        commands = sed.compile().first_command
+        self.assertFalse(commands.regexps()[0].memoized)
+        self.assertTrue(commands.branch.regexps()[0].memoized)
+        for engine in ['interpreter', 'codegen']:
+            sed.engine = engine
+            self.assertEqual(sed.apply([['ax', 'Ab', 'x', 'b']], output=None),
+                             ['ay\n', 'Ab\n', 'z\n', 'b\n'])
+            self.assertEqual(sed.statistics.memo_hits, 3)
+
+    def test_187_line_memo(self):
+        inputs = ['ab', 'ab', 'c', 'ab', 'd', 'e', 'ab', 'ab']
+        sed = PythonSed.Sed(encoding=ENCODING, line_memo=2)
+        sed.load_string('s/a/X/g;/X/{p;a\\\napp\n};y/b/B/')
+        for engine in ['interpreter', 'codegen']:
+            sed.engine = engine
+            self.assertEqual(sed.apply([inputs], output=None),
+                             ['Xb\n', 'XB\n', 'app\n'] * 2 + ['c\n'] + ['Xb\n', 'XB\n', 'app\n']
+                             + ['d\n', 'e\n'] + ['Xb\n', 'XB\n', 'app\n'] * 2)
+            self.assertEqual(sed.statistics.line_memo_hits, 3)
+            self.assertEqual(sed.statistics.line_memo_misses, 5)
+        sed.load_string('$p')
+        output = StringIO()
+        sed.explain([inputs], output)
+        self.assertIn('line memo: off, the output does not depend on the input line only\n',
+                      output.getvalue())
+        sed.line_memo = -1
+        self.assertRaises(PythonSed.SedException, sed.explain, [inputs], None)
+
+    def test_188_line_memo_option(self):
+        self.run_test_against_main(  # noqa: E122
+            debug=0,
+            encoding=ENCODING,
+            options=['--line-memo', '2', '-n'],
+            scripts=[["s/1/x/p"]],
+            inputs=[],
+            stdin='1\n2\n1\n1\n',
+            stdout='x\nx\nx\n',
+            stderr='',
+            exit_code=0)
+
+    def test_189_batch_engine(self):
+        script = ('/^#/d;/c/c\\\nchanged\n/^i/i\\\ninserted\n/a/!{y/b/B/;bend};s/a/A/gp;'
+                  '/^A/a\\\nappended\ntx;s/^/-/;:x;s/q/Q/;Tend;P;l;/z/z;:end')
+        inputs = ['ab', '#x', 'bb', 'ccc', 'iaq', 'baz', 'q', 'aqz']
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string(script)
+        sed.engine = 'interpreter'
+        expected = sed.apply([inputs], output=None)
+        saved = PythonSed.sed.EngineBatch.block_size
+        PythonSed.sed.EngineBatch.block_size = 2
+        try:
+            sed.engine = 'batch'
+            self.assertEqual(sed.apply([inputs], output=None), expected)
+            self.assertEqual(sed.statistics.engine, 'batch')
+            self.assertEqual(sed.statistics.cycles, 8)
+        finally:
+            PythonSed.sed.EngineBatch.block_size = saved
+        sed = PythonSed.Sed(encoding=ENCODING, engine='batch')
+        sed.load_string(':a;s/x/y/;ta')
+        self.assertEqual(sed.explain([['x']], None).candidates[3],
+                         ('batch', 'command t at -e #1 line 1 char 11 branches backwards'))
+        self.assertEqual(sed.apply([['xx']], output=None), ['yy\n'])
+
+    def test_190_slurp_loop(self):
+        inputs = [[['1']], [['1', '2', 'x', '4']], [['1', '2'], [], ['3']], [['1'], []]]
+        for script in [':a;N;$!ba;s/\\n/+/g', ':a;$!N;$!ba;s/\\n/+/g', '2d;/x/{:a;$!{N;ba}};s/\\n/+/g;=']:
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string(script)
+            self.assertIn('replaced loop reading the rest of the input with N by reading it at once',
+                          ' '.join(sed.compile().optimizations))
+            for inp in inputs:
+                sed.optimize = False
+                sed.engine = 'interpreter'
+                expected = sed.apply(list(inp), output=None)
+                sed.optimize = True
+                for engine in ['interpreter', 'codegen']:
+                    sed.engine = engine
+                    self.assertEqual(sed.apply(list(inp), output=None), expected)
+        sed = PythonSed.Sed(encoding=ENCODING, separate=True, shadow=True, shadow_rate=1)
+        sed.load_string(':a;N;$!ba;s/\\n/+/g')
+        self.assertEqual(sed.apply([['1', '2'], ['3', '4', '5']], output=None), ['1+2\n', '3+4+5\n'])
+        self.assertIsNone(sed.statistics.divergence)
+        self.assertEqual(sed.statistics.cycles, 2)
+        self.assertEqual(sed.apply([['1'], ['2', '3']], output=None), ['1+2+3\n'])
+
+    def test_191_window_engine(self):
+        lines = ['1', '2', 'x', '2', '2', 'y', '3']
+        for script in ['$!N;P;D', ':a;$q;N;4,$D;ba', '$!N;/^\\(.*\\)\\n\\1$/!P;D',
+                       '1{N;N};$!N;/x/s/\\n/+/;P;D', '$!N;3q;P;D']:
+            sed = PythonSed.Sed(encoding=ENCODING, engine='interpreter')
+            sed.load_string(script)
+            expected = sed.apply([list(lines)], output=None)
+            sed.engine = 'window'
+            self.assertEqual(sed.explain([list(lines)], None).engine, 'window')
+            self.assertEqual(sed.apply([list(lines)], output=None), expected)
+            self.assertEqual(sed.exit_code, 0)
+        sed = PythonSed.Sed(encoding=ENCODING, engine='window', shadow=True, shadow_rate=1)
+        sed.load_string('$!N;P;D')
+        self.assertEqual(sed.apply([list(lines)], output=None), [line + '\n' for line in lines])
+        self.assertIsNone(sed.statistics.divergence)
+        sed = PythonSed.Sed(encoding=ENCODING, engine='window')
+        sed.load_string('$!N;P')
+        self.assertEqual(sed.explain([list(lines)], None).candidates[4],
+                         ('window', 'the script keeps no window of lines (commands N and D)'))
+        # quitting with -n must not leave the window to the engine sampled next
+        numbers = [str(idx) for idx in range(60)]
+        sed = PythonSed.Sed(encoding=ENCODING, no_autoprint=True)
+        sed.load_string('$!N;P;31q;D')
+        self.assertEqual(sed.apply([list(numbers)], output=None),
+                         [number + '\n' for number in numbers[:30]])
+        self.assertEqual(sed.statistics.switches, [(0, 'window', 'sampling')])
+
+    def test_192_kernels(self):
+        inputs = [['a', 'a', '', '', 'b', 'b'], ['', 'c']]
+        for (script, no_autoprint, name) in [('$=', True, 'count'),
+                                             ('1!G\nh\n$!d', False, 'tac'),
+                                             ('$!N; /^\\(.*\\)\\n\\1$/ !P; D', False, 'uniq'),
+                                             ('/^$/N;/\\n$/D', False, 'squeeze')]:
+            for separate in [False, True]:
+                sed = PythonSed.Sed(encoding=ENCODING, engine='interpreter',
+                                    no_autoprint=no_autoprint, separate=separate)
+                sed.load_string(script)
+                expected = sed.apply([list(inp) for inp in inputs], output=None)
+                sed.engine = 'auto'
+                self.assertEqual(sed.apply([list(inp) for inp in inputs], output=None), expected)
+                self.assertEqual(sed.statistics.engine, 'kernel')
+                self.assertEqual(sed.statistics.kernel, name)
+                sed.shadow = True
+                sed.shadow_rate = 0.5
+                self.assertEqual(sed.apply([list(inp) for inp in inputs], output=None), expected)
+                self.assertIsNone(sed.statistics.divergence)
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('1!G;h;$!d')
+        output = StringIO()
+        sed.explain([['1', '2']], output)
+        self.assertEqual(output.getvalue().splitlines()[:2],
+                         ['engine: kernel (auto requested)', 'kernel: tac (1!G;h;$!d)'])
+        sed.no_autoprint = True
+        self.assertEqual(sed.explain([['1', '2']], None).candidates[0],
+                         ('kernel', 'the script is no well-known one-liner'))
+
+    def test_193_rope_engine(self):
+        lines = ['a', 'b', '', 'c', 'x', '', 'd']
+        for script in ['H;$!d;x;s/\\n/ /g', '/./{H;$!d};x;s/\\n/+/g', 'G;h;$!d', '1h;1!H;$!d;g;s/b/B/',
+                       '/x/{x;p;x};H;N;G;3q']:
+            sed = PythonSed.Sed(encoding=ENCODING, engine='interpreter')
+            sed.load_string(script)
+            expected = sed.apply([list(lines)], output=None)
+            sed.engine = 'auto'
+            self.assertEqual(sed.explain([list(lines)], None).engine, 'rope')
+            self.assertEqual(sed.apply([list(lines)], output=None), expected)
+            self.assertEqual(sed.statistics.switches, [])
+            sed.shadow = True
+            sed.shadow_rate = 0.5
+            self.assertEqual(sed.apply([list(lines)], output=None), expected)
+            self.assertIsNone(sed.statistics.divergence)
+        rope = PythonSed.sed.Rope(PythonSed.sed.Rope('a', 'b'), 'c')
+        self.assertEqual(PythonSed.sed.Rope(rope, rope).string(), 'a\nb\nc\na\nb\nc')
+        self.assertEqual(rope.string(), 'a\nb\nc')
+        self.assertIsNone(rope.parts)
+        sed = PythonSed.Sed(encoding=ENCODING, engine='rope')
+        sed.load_string('G')
+        self.assertEqual(sed.explain([list(lines)], None).candidates[1],
+                         ('rope', 'the script does not accumulate text in the hold space '
+                                  '(commands H or G and h)'))
+
+    def test_194_spill(self):
+        lines = ['a', 'b', '', 'c', 'x', '', 'd']
+        for script in ['H;$!d;x;s/\\n/ /g', '/./{H;$!d};x;s/\\n/+/g', 'G;h;$!d', 'N;G;h;x;/x/p;x']:
+            sed = PythonSed.Sed(encoding=ENCODING, engine='interpreter')
+            sed.load_string(script)
+            expected = sed.apply([list(lines)], output=None)
+            sed.engine = 'auto'
+            sed.spill_threshold = 3
+            self.assertEqual(sed.apply([list(lines)], output=None), expected)
+            self.assertEqual(sed.statistics.engine, 'rope')
+            self.assertGreater(sed.statistics.spilled_bytes, 0)
+        output = StringIO()
+        sed.explain([list(lines)], output)
+        self.assertIn('spill: hold and pattern space beyond 3 characters to disk\n', output.getvalue())
+        sed.shadow = True
+        self.assertEqual(sed.explain([list(lines)], None).spill_reason,
+                         'shadow mode compares the hold space after every checked cycle')
+        sed = PythonSed.Sed(encoding=ENCODING, spill_threshold=3)
+        sed.load_string('p')
+        self.assertEqual(sed.explain([list(lines)], None).spill_reason,
+                         'only the rope engine spills to disk')
+        sed.spill_threshold = -1
+        self.assertEqual(sed.apply([list(lines)], output=None), [])
+        self.assertEqual(sed.exit_code, 1)
+
+    def test_195_spill_option(self):
+        self.run_test_against_main(  # noqa: E122
+            debug=0,
+            encoding=ENCODING,
+            options=['--spill-threshold', '2'],
+            scripts=[["H;$!d;x;s/\\n/+/g"]],
+            inputs=[],
+            stdin='1\n2\n3\n',
+            stdout='+1+2+3\n',
+            stderr='',
+            exit_code=0)
+
+    def test_196_callback_command(self):
+        def double(PS, HS):  # @UnusedVariable
+            return str(int(PS) * 2)
+
+        def swap(PS, HS):
+            return HS, PS
+
+        script = '/^[0-9]/@double\n/x/ { @swap ; }\nH;$!d;x'
+        for engine in ['interpreter', 'codegen', 'rope', 'auto']:
+            sed = PythonSed.Sed(encoding=ENCODING, engine=engine,
+                                callbacks={'double': double, 'swap': swap})
+            sed.load_string(script)
+            self.assertEqual(sed.apply([['1', 'x', '3']], output=None), ['x\n', '\n', '2\n', '6\n'])
+            self.assertEqual(sed.exit_code, 0)
+        self.assertFalse(sed.compile().analysis.line_local)
+        for (script, callbacks, message) in [
+                ('@', {}, 'Missing name for command @'),
+                ('@nope', {}, 'Unknown callback command nope'),
+                ('@a x', {'a': double}, 'Command @ can not have any arguments after the name'),
+                ('@a', {'a': lambda PS, HS: 1 / 0}, 'Callback command a failed: '),
+                ('@a', {'a': lambda PS, HS: None},
+                 'Callback command a must return strings, not NoneType')]:
+            sed = PythonSed.Sed(encoding=ENCODING, callbacks=callbacks)
+            sed.load_string(script)
+            stderr = StringIO()
+            saved = sys.stderr
+            sys.stderr = stderr
+            try:
+                self.assertEqual(sed.apply([['1']], output=None), [])
+            finally:
+                sys.stderr = saved
+            self.assertEqual(sed.exit_code, 1)
+            self.assertIn('-e #1 line 1 char 1: ' + message, stderr.getvalue())
+
+    def test_197_resource_limits(self):
+        lines = ['0123456789', 'a', 'x', 'b']
+        for (limits, script, output, message) in [
+                ({'max_commands': 50}, ':a;s/x/x/;ta', ['0123456789\n', 'a\n'],
+                 'char 4: More than 50 commands executed in one cycle on input line 3'),
+                ({'max_space': 12}, 'H;$!d;x', [],
+                 'char 1: Hold space grew beyond 12 characters on input line 2'),
+                ({'max_space': 12}, 'N;N', [],
+                 'char 3: Pattern space grew beyond 12 characters on input line 3'),
+                ({'max_line_time': 0.01}, '/b/{:a;ba}', ['0123456789\n', 'a\n', 'x\n'],
+                 'char 8: Cycle took longer than 0.01 seconds on input line 4')]:
+            sed = PythonSed.Sed(encoding=ENCODING, **limits)
+            sed.load_string(script)
+            stderr = StringIO()
+            saved = sys.stderr
+            sys.stderr = stderr
+            try:
+                self.assertEqual(sed.apply([list(lines)], output=None), output)
+            finally:
+                sys.stderr = saved
+            self.assertEqual(sed.exit_code, 1)
+            self.assertIsInstance(sed.error, PythonSed.SedLimitExceeded)
+            self.assertEqual(sed.error.line_number, int(message[-1]))
+            self.assertEqual(sed.error.args[1:3], (sed.error.line_number, '<literal[1]>'))
+            error = pickle.loads(pickle.dumps(sed.error))
+            self.assertEqual((error.message, error.line_number),
+                             (sed.error.message, sed.error.line_number))
+            self.assertIn('-e #1 line 1 ' + message, stderr.getvalue())
+        sed = PythonSed.Sed(encoding=ENCODING, max_space=100, max_commands=10, max_line_time=1)
+        sed.load_string('H;$!d;x;s/\\n/+/g')
+        self.assertEqual(sed.apply([list(lines)], output=None), ['+0123456789+a+x+b\n'])
+        self.assertIsNone(sed.error)
+        self.assertEqual(sed.statistics.engine, 'interpreter')
+        self.assertIn(('rope', 'resource limits are enforced by the interpreter only'),
+                      sed.explain([list(lines)], None).candidates)
+        sed.max_commands = -1
+        stderr = StringIO()
+        saved = sys.stderr
+        sys.stderr = stderr
+        try:
+            self.assertEqual(sed.apply([list(lines)], output=None), [])
+        finally:
+            sys.stderr = saved
+        self.assertEqual(sed.exit_code, 1)
+        self.assertIn('Invalid limit max_commands -1, must be a non-negative number.', stderr.getvalue())
+        sed.max_commands = True
+        self.assertRaises(PythonSed.SedException, PythonSed.sed.Governor.for_sed, sed)
+        sed.max_commands = long(10) if PY2 else 10  # noqa: F821
+        self.assertEqual(PythonSed.sed.Governor.for_sed(sed).max_commands, 10)
+
+    def test_198_resource_limit_options(self):
+        self.run_test_against_main(  # noqa: E122
+            debug=0,
+            encoding=ENCODING,
+            options=['--max-space', '6', '--max-commands', '10', '--max-line-time', '1'],
+            scripts=[["H;$!d;x;s/\\n/+/g"]],
+            inputs=[],
+            stdin='1\n2\n3\n',
+            stdout='+1+2+3\n',
+            stderr='',
+            exit_code=0)
+
+    def test_199_cancellation(self):
+        def run(sed, lines, **kwargs):
+            stderr = StringIO()
+            saved = sys.stderr
+            sys.stderr = stderr
+            try:
+                output = sed.apply([list(lines)], output=None, **kwargs)
+            finally:
+                sys.stderr = saved
+            return output, stderr.getvalue()
+
+        token = PythonSed.CancelToken()
+
+        def stop(PS, HS):  # @UnusedVariable
+            token.cancel()
+            return PS
+
+        lines = ['a', 'b', 'stop', 'c', 'd']
+        for engine in ['interpreter', 'codegen', 'rope', 'auto']:
+            token.cancelled = False
+            sed = PythonSed.Sed(encoding=ENCODING, engine=engine, callbacks={'stop': stop})
+            sed.load_string('/stop/@stop\ns/$/!/')
+            output, stderr = run(sed, lines, cancel_token=token)
+            self.assertEqual(output, ['a!\n', 'b!\n', 'stop!\n'])
+            self.assertEqual(sed.exit_code, 1)
+            self.assertIsInstance(sed.error, PythonSed.SedCancelled)
+            self.assertIsInstance(sed.error, PythonSed.SedRunStopped)
+            self.assertEqual((sed.error.line_number, sed.error.source_file_name),
+                             (3, '<literal[1]>'))
+            self.assertEqual(stderr, 'sed.py error: Run cancelled on input line 3 of <literal[1]>.\n')
+            self.assertEqual(sed.error.args, ('', 3, '<literal[1]>', 'Run cancelled'))
+            error = pickle.loads(pickle.dumps(sed.error))
+            self.assertEqual((error.message, error.source_file_name),
+                             (sed.error.message, sed.error.source_file_name))
+        token.cancelled = False
+        sed = PythonSed.Sed(encoding=ENCODING, callbacks={'stop': stop})
+        sed.load_string('/stop/{@stop\n:a;ba}')
+        output, stderr = run(sed, lines, cancel_token=token)
+        self.assertEqual(output, ['a\n', 'b\n'])
+        self.assertEqual(stderr, 'sed.py error: -e #1 line 1 char 8: '
+                                 'Run cancelled on input line 3 of <literal[1]>.\n')
+        self.assertEqual(sed.statistics.engine, 'interpreter')
+        output, stderr = run(sed, lines, deadline=0)
+        self.assertEqual(output, [])
+        self.assertEqual(stderr, 'sed.py error: Deadline of the run passed on input line 0 of <literal[1]>.\n')
+        output, stderr = run(sed, lines, deadline='soon')
+        self.assertIn('Invalid deadline soon, must be a time in seconds since the epoch.', stderr)
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('s/a/b/')
+        output, stderr = run(sed, lines, cancel_token=threading.Event(), deadline=time.time() + 60)
+        self.assertEqual(output, ['b\n', 'b\n', 'stop\n', 'c\n', 'd\n'])
+        self.assertIsNone(sed.error)
+
+    def test_200_regexp_cache(self):
+        cache = PythonSed.sed.REGEXP_CACHE
+        script = '/a\\+b/s/y$/[&]/\n\\,b+,s,c+,&&,'
+        lines = ['aab xy', 'a+b xy', 'b+ c+', 'bb cc']
+        expected = {False: ['aab x[y]\n', 'a+b xy\n', 'b+ c+c+\n', 'bb cc\n'],
+                    True: ['aab xy\n', 'a+b x[y]\n', 'b+ cc+\n', 'bb cccc\n']}
+        for extended in [False, True, False, True]:
+            sed = PythonSed.Sed(encoding=ENCODING, regexp_extended=extended)
+            sed.load_string(script)
+            self.assertEqual(sed.apply([list(lines)], output=None), expected[extended])
+        hits = cache.hits
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string(script)
+        sed.compile()
+        # the translations and compiled patterns of all four regexps are found in the cache
+        self.assertEqual(cache.hits - hits, 8)
+        # the same regexp in another line of another script shares the entries
+        hits = cache.hits
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('p\n  /a\\+b/ {s,c+,&&,}')
+        sed.compile()
+        self.assertEqual(cache.hits - hits, 4)
+        # a character set containing the delimiter is translated again every time
+        for _ in range(2):
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string('s/[/]/|/')
+            self.assertEqual(sed.apply([['a/b']], output=None), ['a|b\n'])
+        size = cache.size
+        try:
+            cache.size = 2
+            evictions = cache.evictions
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string('/1/p;/2/p;/3/p')
+            self.assertEqual(sed.apply([['1', '3']], output=None), ['1\n', '1\n', '3\n', '3\n'])
+            self.assertEqual(len(cache), 2)
+            self.assertGreater(cache.evictions, evictions)
+            cache.size = 0
+            cache.clear()
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string(script)
+            self.assertEqual(sed.apply([list(lines)], output=None), expected[False])
+            self.assertEqual((len(cache), cache.hits), (0, 0))
+            self.assertIn('regexp cache: 0 of 0 entries, 0 hits', str(cache))
+        finally:
+            cache.size = size
+
+    def test_201_literal_patterns(self):
+        def regexp(script):
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string(script)
+            return sed.compile().first_command.regexps()[0]
+
+        for (script, literal) in [('/ERROR/p', ('ERROR', False, False)),
+                                  ('/^pre\\.fix/p', ('pre.fix', True, False)),
+                                  ('/a\\nb$/p', ('a\nb', False, True)),
+                                  ('/^$/p', ('', True, True)),
+                                  ('s/AbC/x/I', ('abc', False, False)),
+                                  ('s/x/y/M', ('x', False, False)),
+                                  ('/a.b/p', None), ('/^x/Mp', None), ('/x*/p', None),
+                                  ('/\\(x\\)/p', None), ('/é/Ip', None)]:
+            found = regexp(script).literal
+            if PY2 and script.endswith('I'):
+                # flag I is left to module re without str.isascii
+                continue
+            self.assertEqual(found and (found.text, found.at_start, found.at_end), literal)
+        lines = ['foo foo foo', 'FoO x fOO', '', 'xfoo', 'K\u212a k', 'ab']
+        for script in ['s/foo/bar/', 's/foo/bar/g', 's/foo/bar/2', 's/foo/[&]/3g', 's/foo/\\U&/g',
+                       's/^foo/-/g', 's/foo$/-/', 's/foo/-/gI', 's/FOO/&&/2I', 's/^$/empty/',
+                       's/k/_/Ig', '/xfoo/d', '/^ab$/s/b/\\n/', 's/o/0/3p', 's/\\(o\\)/0/g']:
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string(script)
+            output = sed.apply([list(lines)], output=None)
+            sed = PythonSed.Sed(encoding=ENCODING)
+            sed.load_string(script)
+            for regexp in sed.compile().first_command.regexps():
+                regexp.literal = None
+                regexp.search = regexp.compiled.search
+            self.assertEqual(output, sed.apply([list(lines)], output=None), script)
+
+    def test_202_prefilter(self):
+        extract = PythonSed.sed.RequiredLiterals.extract
+        for (pattern, literals) in [('user=[a-z]+ action=delete', [' action=delete', 'user=']),
+                                    ('ab*c', ['a', 'c']), ('ab+c', ['ab', 'c']),
+                                    ('a{2}bc\\.', ['bc.']), ('(foo)bar', ['bar']),
+                                    ('[]x]yz$', ['yz']), ('a\\dbcd', ['bcd', 'a']),
+                                    ('x|y', None), ('(?i)abc', None), ('a{b', None),
+                                    ('.*', None)]:
+            found = extract(pattern, False)
+            self.assertEqual(found and found.literals, literals, pattern)
+        lines = ['12 user=bob action=delete', '13 user=ann action=read', '14 user=Bob Action=Delete']
+        for engine in ['interpreter', 'codegen', 'batch']:
+            for (script, output, rejections) in [
+                    ('s/[0-9]\\+ user=[a-z]* action=delete/X/', ['X\n', lines[1] + '\n', lines[2] + '\n'], 2),
+                    ('/[a-z]=bob action=delete/Id', [lines[1] + '\n'], 1)]:
+                if PY2 and script.endswith('Id'):
+                    # flag I is left to module re without str.isascii
+                    continue
+                sed = PythonSed.Sed(encoding=ENCODING, engine=engine)
+                sed.load_string(script)
+                self.assertEqual(sed.apply([list(lines)], output=None), output)
+                self.assertEqual((sed.statistics.prefilter_checks,
+                                  sed.statistics.prefilter_rejections), (3, rejections))
+                self.assertIn('prefilter: {} of 3 searches rejected\n'.format(rejections),
+                              str(sed.statistics))
+
+    def test_203_address_scan(self):
+        trie_pattern = PythonSed.sed.AddressScan.trie_pattern
+        self.assertEqual(trie_pattern(['ab', 'abc', 'b.']), '(?:ab(?:c|)|b\\.)')
+        lines = ['route_3=abc', 'route_4=123', 'nothing to route', 'route_10=x']
+        script = '\n'.join(['/route_{}=[a-z]/p'.format(idx) for idx in range(8)] +
+                           ['/^route_1/s/$/ range/', '/NOTHING/Id', '/=123$/p'])
+        for engine in ['interpreter', 'codegen', 'batch']:
+            sed = PythonSed.Sed(encoding=ENCODING, engine=engine)
+            sed.load_string(script)
+            self.assertEqual(sed.apply([list(lines)], output=None),
+                             ['route_3=abc\n', 'route_3=abc\n', 'route_4=123\n',
+                              'route_4=123\n', 'route_10=x range\n'])
+            # the last line is scanned again after the substitution
+            self.assertEqual((sed.statistics.address_scans,
+                              sed.statistics.address_scan_misses), (5, 1))
+            self.assertIn('address scans: 5 (1 matching no address)\n', str(sed.statistics))
+        sed = PythonSed.Sed(encoding=ENCODING)
+        sed.load_string('\n'.join(script.split('\n')[1:8]))
+        sed.apply([list(lines)], output=None)
+        self.assertEqual(sed.statistics.address_scans, 0)
+
+    def test_204_prefilter_escapes(self):
+        extract = PythonSed.sed.RequiredLiterals.extract
+        for (pattern, literals) in [('\\101', None), ('b\\0', None), ('a\\x42c', None),
+                                    ('\\u0041bc', None), ('\\N{DIGIT ONE}ab', None),
+                                    ('(a)\\1xy', ['xy']), ('(a)\\12', None)]:
+            found = extract(pattern, False)
+            self.assertEqual(found and found.literals, literals, pattern)
+        lines = ['oA', 'A1', 'B1', 'x']
+        scripts = [('s/\\101/X/', ['oX\n', 'X1\n', 'B1\n', 'x\n']),
+                   ('/\\101\\061/p', ['A1\n']),
+                   ('s/\\x41\\x31/X/', ['oA\n', 'X\n', 'B1\n', 'x\n']),
+                   ('/\\x42\\x31/p', ['B1\n'])]
+        if sys.version_info >= (3, 8):
+            scripts += [('s/\\N{LATIN CAPITAL LETTER A}1/X/', ['oA\n', 'X\n', 'B1\n', 'x\n']),
+                        ('/\\N{LATIN CAPITAL LETTER B}\\N{DIGIT ONE}/p', ['B1\n'])]
+        for engine in ['interpreter', 'codegen', 'batch']:
+            for (script, output) in scripts:
+                sed = PythonSed.Sed(encoding=ENCODING, engine=engine, sed_compatible=False,
+                                    no_autoprint=script.endswith('p'))
+                sed.load_string(script)
+                self.assertEqual(sed.apply([list(lines)], output=None), output, script)
+
+    def test_205_spill_file_bounded(self):
+        lines = ['{:010d}'.format(idx) for idx in range(4000)]
+        for (script, file_size, spilled_bytes) in [('H;x;s/\\n/|/;x;$!d;x', 60000, 100000),
+                                                   ('G;s/^/>/;h;$!d', 60000, 100000),
+                                                   ('0~100{s/.*/-/;h};H;$!d;x', 3000, 50000)]:
+            sed = PythonSed.Sed(encoding=ENCODING, engine='interpreter')
+            sed.load_string(script)
+            expected = sed.apply([list(lines)], output=None)
+            sed.engine = 'rope'
+            sed.spill_threshold = 30
+            self.assertEqual(sed.apply([list(lines)], output=None), expected)
+            self.assertLess(sed.statistics.spill_file_size, file_size, script)
+            self.assertLess(sed.statistics.spilled_bytes, spilled_bytes, script)
+            self.assertIn('spilled: {} bytes (file size at most {} bytes)\n'.format(
+                sed.statistics.spilled_bytes, sed.statistics.spill_file_size), str(sed.statistics))
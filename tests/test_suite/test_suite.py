@@ -68,12 +68,13 @@ class BaseTest:
         self.current_dir = None
         self.error_expected = False
 
-    def run(self, binary=None, debug=False):
+    def run(self, binary=None, debug=False, engine='interpreter'):
 
         if binary is None:
             self.run_output = run_python_sed(self.scriptname, self.inputname,
                                              self.no_autoprint,
-                                             self.regexp_extended, debug)
+                                             self.regexp_extended, debug,
+                                             engine)
         else:
             self.run_output = run_binary_sed(self.scriptname, self.inputname,
                                              self.no_autoprint,
@@ -229,11 +230,13 @@ class FolderTest(BaseTest):
 # -- Helpers -----------------------------------------------------------------
 
 
-def run_python_sed(scriptname, inputfile, no_autoprint, regexp_extended, debug):
+def run_python_sed(scriptname, inputfile, no_autoprint, regexp_extended, debug,
+                   engine='interpreter'):
     sed = Sed()
     sed.no_autoprint = no_autoprint
     sed.regexp_extended = regexp_extended
     sed.encoding = 'latin-1'
+    sed.engine = engine
     if debug:
         sed.debug = 2
 
@@ -497,7 +500,8 @@ def load_testsuite_batch(testsuite):
 # -- Running tests suite -----------------------------------------------------
 
 
-def run_testsuite(tests, target, binary, exclude, elapsed_only, debug):
+def run_testsuite(tests, target, binary, exclude, elapsed_only, debug,
+                  engine='interpreter'):
     start = time.time()
     result = True
     debug = debug or target is not None
@@ -515,7 +519,7 @@ def run_testsuite(tests, target, binary, exclude, elapsed_only, debug):
                 n_ignored += 1
             else:
                 if test.prepare():
-                    test.run(binary, debug=debug)
+                    test.run(binary, debug=debug, engine=engine)
                     if elapsed_only:
                         pass
                     else:
@@ -588,6 +592,12 @@ def parse_command_line():
     parser.add_argument("-d", "--debug",
                         help='switch on debugging output',
                         action="store_true")
+    parser.add_argument("--engine",
+                        help='execution engine of pythonsed to use',
+                        action="store",
+                        dest="engine",
+                        default='interpreter',
+                        metavar='<engine name>')
     parser.add_argument("file",
                         metavar="<file>",
                         help='test specifications to load')
@@ -626,7 +636,8 @@ def main():
             exclude = list()
 
         all_tests = load_testsuite(testsuite)
-        run_testsuite(all_tests, target, args.binary, exclude, args.elapsed_only, args.debug)
+        run_testsuite(all_tests, target, args.binary, exclude, args.elapsed_only, args.debug,
+                      args.engine)
 
     finally:
         os.chdir(current_dir)